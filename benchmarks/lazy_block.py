@@ -0,0 +1,117 @@
+# This script compares decoding blocks eagerly with `Block` and lazily with
+# `LazyBlock`, for an indexer that only reads the block header and events.
+# It also reports the memory retained by the fields decoded by `LazyBlock`.
+#
+# The script exits with an error if `LazyBlock` is slower than eager decoding
+# for either access pattern, so that it can guard against regressions.
+#
+# Example:
+#
+#   python benchmarks/lazy_block.py --transactions 2000 --events 1000
+
+import random
+import sys
+import timeit
+from argparse import ArgumentParser
+
+from apibara.starknet import Block, LazyBlock, felt
+from apibara.starknet.indexer import decode_block
+from apibara.starknet.proto.starknet_pb2 import BlockHeader
+
+
+def random_felt():
+    return felt.from_int(random.getrandbits(250))
+
+
+def synthetic_block(num_transactions: int, num_events: int, num_diffs: int) -> bytes:
+    """Returns a block with transactions, receipts, events and state diffs."""
+    block = Block(header=BlockHeader(block_number=1, block_hash=random_felt()))
+
+    for _ in range(num_transactions):
+        tx = block.transactions.add()
+        tx.transaction.meta.hash.CopyFrom(random_felt())
+        tx.transaction.invoke_v1.sender_address.CopyFrom(random_felt())
+        tx.transaction.invoke_v1.calldata.extend([random_felt() for _ in range(20)])
+        tx.receipt.transaction_hash.CopyFrom(random_felt())
+        for _ in range(3):
+            event = tx.receipt.events.add()
+            event.from_address.CopyFrom(random_felt())
+            event.keys.extend([random_felt()])
+            event.data.extend([random_felt(), random_felt()])
+
+    for _ in range(num_events):
+        event = block.events.add()
+        event.event.from_address.CopyFrom(random_felt())
+        event.event.keys.extend([random_felt()])
+        event.event.data.extend([random_felt(), random_felt()])
+
+    for _ in range(num_diffs):
+        diff = block.state_update.state_diff.storage_diffs.add()
+        diff.contract_address.CopyFrom(random_felt())
+        for _ in range(5):
+            entry = diff.storage_entries.add()
+            entry.key.CopyFrom(random_felt())
+            entry.value.CopyFrom(random_felt())
+
+    return block.SerializeToString()
+
+
+def use_block(block):
+    """Access the fields used by a typical events indexer."""
+    block_number = block.header.block_number
+    count = 0
+    for event in block.events:
+        if event.event.from_address.lo_lo > 0:
+            count += 1
+    return block_number, count
+
+
+def retained_size(raw: bytes) -> int:
+    """Returns the size of the fields decoded by `LazyBlock` in `use_block`."""
+    block = LazyBlock(raw)
+    use_block(block)
+    return sum(message.ByteSize() for message in block._fields.values())
+
+
+def main(argv):
+    parser = ArgumentParser()
+    parser.add_argument("--transactions", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--diffs", type=int, default=500)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    raw = synthetic_block(args.transactions, args.events, args.diffs)
+    print(f"block size: {len(raw) / 1024 / 1024:.2f} MiB")
+
+    benchmarks = [
+        (
+            "header and events",
+            lambda: use_block(decode_block(raw)),
+            lambda: use_block(LazyBlock(raw)),
+        ),
+        (
+            "header only",
+            lambda: decode_block(raw).header.block_number,
+            lambda: LazyBlock(raw).header.block_number,
+        ),
+    ]
+    regressions = []
+    for name, eager, lazy in benchmarks:
+        eager_time = timeit.timeit(eager, number=args.iterations) / args.iterations
+        lazy_time = timeit.timeit(lazy, number=args.iterations) / args.iterations
+        print(f"{'eager (' + name + ')':>28}: {eager_time * 1000:8.3f} ms/block")
+        print(f"{'lazy (' + name + ')':>28}: {lazy_time * 1000:8.3f} ms/block")
+        if lazy_time >= eager_time:
+            regressions.append(name)
+
+    size = retained_size(raw)
+    print(f"{'lazy retained':>28}: {size / 1024 / 1024:8.3f} MiB")
+
+    if regressions:
+        print(f"LazyBlock is slower than eager decoding: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,61 @@
+# This script measures how many messages per second go through `StreamIter`,
+# comparing the watchdog timeout with one `asyncio.wait_for` per message.
+#
+# Example:
+#
+#   python benchmarks/stream_iter.py --messages 200000
+
+import asyncio
+import sys
+import time
+from argparse import ArgumentParser
+
+from apibara.protocol.client import StreamIter, _Context
+from apibara.protocol.proto.stream_pb2 import Data, StreamDataResponse
+
+
+class WaitForStreamIter(StreamIter):
+    """StreamIter with a timeout for each message, as in previous versions."""
+
+    async def __anext__(self):
+        while True:
+            value = await asyncio.wait_for(
+                self._iter.__anext__(), timeout=self._timeout
+            )
+            if value.stream_id == self._ctx.stream_id:
+                return value
+
+
+class InnerStream:
+    def __init__(self, count: int) -> None:
+        self._count = count
+        self._message = StreamDataResponse(stream_id=0, data=Data(data=[b"block"]))
+
+    async def __aiter__(self):
+        for i in range(self._count):
+            # let the event loop run every few messages, like a network stream.
+            if i % 8 == 0:
+                await asyncio.sleep(0)
+            yield self._message
+
+
+async def run(stream_cls, count: int) -> float:
+    stream = stream_cls(_Context(), InnerStream(count), 45.0)
+    start = time.perf_counter()
+    async for _ in stream:
+        pass
+    return count / (time.perf_counter() - start)
+
+
+async def main(argv):
+    parser = ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100_000)
+    args = parser.parse_args(argv)
+
+    for name, stream_cls in [("wait_for", WaitForStreamIter), ("watchdog", StreamIter)]:
+        rate = await run(stream_cls, args.messages)
+        print(f"{name:>10}: {rate:12,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -13,6 +13,10 @@
 #     --start-block 17990
 #     --end-block 18000
 #     --batch-size=1
+#
+# Add `--archive /tmp/archive` to store the raw blocks in a binary archive
+# instead of printing them as JSON. Read the archive with
+# `apibara.protocol.ArchiveReader`.
 
 import asyncio
 import sys
@@ -23,7 +27,7 @@ from google.protobuf.json_format import MessageToJson, Parse
 from grpc import ssl_channel_credentials
 from grpc.aio import secure_channel
 
-from apibara.protocol import StreamService
+from apibara.protocol import ArchiveWriter, StreamService
 from apibara.protocol.proto.stream_pb2 import DataFinality
 from apibara.starknet import Block, EventFilter, Filter, felt
 from apibara.starknet.cursor import starknet_cursor
@@ -83,15 +87,26 @@ async def stream_data(args):
         cursor=cursor,
     )
 
-    block = Block()
-    async for message in stream:
-        if message.data is not None:
-            if message.data.end_cursor.order_key > args.end_block:
-                return
+    archive = None
+    if args.archive:
+        archive = ArchiveWriter(args.archive)
+
+    try:
+        block = Block()
+        async for message in stream:
+            if message.data is not None:
+                if message.data.end_cursor.order_key > args.end_block:
+                    return
 
-            for batch in message.data.data:
-                block.ParseFromString(batch)
-                print(MessageToJson(block))
+                for batch in message.data.data:
+                    block.ParseFromString(batch)
+                    if archive is not None:
+                        archive.append(block.header.block_number, batch)
+                    else:
+                        print(MessageToJson(block))
+    finally:
+        if archive is not None:
+            archive.close()
 
 
 async def main(argv):
@@ -112,6 +127,9 @@ async def main(argv):
         "--end-block", help="End block number (inclusive)", type=int, required=True
     )
     stream_parser.add_argument("--batch-size", help="Batch size", type=int, default=10)
+    stream_parser.add_argument(
+        "--archive", help="Store blocks in a binary archive in this directory"
+    )
     finality_group = stream_parser.add_mutually_exclusive_group()
     finality_group.add_argument(
         "--finalized", help="Stream finalized data", action="store_true"
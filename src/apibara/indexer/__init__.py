@@ -1,4 +1,8 @@
+from .backend import BaseIndexerStorage, BaseStorage, DocumentCursor
+from .cache import CacheStats
+from .decoder import ProcessPoolDecoder
 from .indexer import Indexer, IndexerConfiguration
 from .info import Info, UserContext
-from .runner import IndexerRunner, IndexerRunnerConfiguration
+from .memory import InMemoryIndexerStorage
+from .runner import IndexerRunner, IndexerRunnerConfiguration, IndexerRunnerMetrics
 from .storage import IndexerStorage, ReadOnlyStorage, Storage
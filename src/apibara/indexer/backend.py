@@ -0,0 +1,364 @@
+import itertools
+import logging
+from abc import ABCMeta, abstractmethod
+from collections import deque
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    ContextManager,
+    Deque,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+)
+
+import apibara.cursor as cursor_utils
+from apibara.indexer.cache import CacheStats
+from apibara.indexer.configuration import IndexerConfiguration
+from apibara.protocol.proto.stream_pb2 import Cursor
+
+Document = Dict[str, Any]
+DocumentFilter = Dict[str, Any]
+Update = Dict[str, Any]
+Projection = Dict[str, Any]
+
+Filter = TypeVar("Filter")
+T = TypeVar("T")
+
+DEFAULT_FIND_BATCH_SIZE = 100
+
+
+logger = logging.getLogger(__name__)
+
+
+def _chain_filter(as_of: Optional[int] = None) -> DocumentFilter:
+    """Returns the filter of the documents valid at block `as_of`.
+
+    If `as_of` is `None`, returns the filter of the current documents.
+    """
+    if as_of is None:
+        return {"_chain.valid_to": None}
+    # documents are valid from `valid_from` (included) to `valid_to` (excluded),
+    # `$not` also matches the current documents, with `valid_to = None`.
+    return {
+        "_chain.valid_from": {"$lte": as_of},
+        "_chain.valid_to": {"$not": {"$lte": as_of}},
+    }
+
+
+class BaseIndexerStorage(Generic[Filter], metaclass=ABCMeta):
+    """Storage used by `IndexerRunner`.
+
+    It stores the indexer configuration and cursor, and creates the
+    `BaseStorage` passed to the indexer handlers.
+    """
+
+    _indexer_id: str
+
+    @abstractmethod
+    def create_storage_for_block(self, cursor: Cursor) -> ContextManager["BaseStorage"]:
+        """Returns the storage used to handle data at `cursor`."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def create_storage_for_data(
+        self, cursor: Cursor, *, finalized: bool = False
+    ) -> ContextManager["BaseStorage"]:
+        """Returns the storage used to handle data, the indexer cursor is
+        updated when the context exits."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def create_storage_for_invalidate(
+        self, cursor: Cursor
+    ) -> ContextManager["BaseStorage"]:
+        """Returns the storage used to handle an invalidation."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def create_storage_for_pending(
+        self, cursor: Cursor
+    ) -> ContextManager["BaseStorage"]:
+        """Returns the storage used to handle pending data."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def invalidate(self, cursor: Cursor, session: Any = None):
+        """Invalidates all data generate after `cursor`."""
+        raise NotImplementedError()
+
+    def discard_pending(self, cursor: Cursor, session: Any = None):
+        """Discard the changes made by pending data received after `cursor`."""
+        self.invalidate(cursor, session=session)
+
+    @abstractmethod
+    def drop_database(self):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _read_configuration(self) -> Optional[Document]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _write_configuration(self, configuration: Document):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _update_filter(self, filter: Filter, session: Any = None):
+        """Set the indexer filter, overriding the previous filter."""
+        raise NotImplementedError()
+
+    def commit(self):
+        """Commit the open transaction, if any."""
+
+    def abort(self):
+        """Abort the open transaction, if any, discarding its changes."""
+
+    def cache_stats(self) -> Dict[str, CacheStats]:
+        """Returns the document cache statistics, by collection."""
+        return {}
+
+    async def _run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Call `fn`, a blocking method of the storage."""
+        return fn(*args, **kwargs)
+
+    def _initialize_configuration(self, configuration: IndexerConfiguration[Filter]):
+        existing = self._read_configuration()
+        if existing is not None:
+            return
+
+        logger.debug("writing initial configuration to storage")
+
+        cursor = None
+        if configuration.starting_cursor is not None:
+            cursor = cursor_utils.to_json(configuration.starting_cursor)
+
+        if configuration.filter is None:
+            raise RuntimeError("configuration filter must be defined")
+
+        filter = configuration.filter.encode()
+
+        self._write_configuration(
+            {
+                "indexer_id": self._indexer_id,
+                "cursor": cursor,
+                "filter": filter,
+            }
+        )
+
+    def update_with_stored_configuration(
+        self,
+        initial: IndexerConfiguration[Filter],
+        *,
+        ignore_filter: Optional[bool] = None,
+    ):
+        logger.debug("update config with stored version")
+
+        stored = self._read_configuration()
+        if stored is None:
+            self._initialize_configuration(initial)
+            return False
+
+        if not ignore_filter:
+            logger.debug("loading filter from storage")
+            encoded_filter = stored.get("filter")
+            if encoded_filter is None:
+                raise RuntimeError("indexer filter is missing")
+            initial.filter.parse(encoded_filter)
+        else:
+            logger.debug("using filter from script")
+
+        cursor = stored.get("cursor")
+        if cursor is not None:
+            initial.starting_cursor = cursor_utils.from_json(cursor)
+
+        return True
+
+
+class BaseStorage(metaclass=ABCMeta):
+    """Chain-aware document storage, passed to the indexer handlers.
+
+    Documents are versioned with the block they're valid from and the block
+    they're replaced or deleted at. Reads only return the current version.
+    """
+
+    _cursor: Cursor
+    # database session passed to `BaseIndexerStorage.invalidate`, if any.
+    _session: Any = None
+
+    @abstractmethod
+    async def find_one(
+        self, collection: str, filter: DocumentFilter, *, as_of: Optional[int] = None
+    ) -> Optional[Document]:
+        """Find the first document in `collection` matching `filter`.
+
+        If `as_of` is set, the document is searched in the documents as
+        they were at block `as_of`.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def find(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        sort: Optional[Dict[str, int]] = None,
+        projection: Optional[Projection] = None,
+        skip: int = 0,
+        limit: int = 0,
+        *,
+        as_of: Optional[int] = None,
+        batch_size: Optional[int] = None,
+    ) -> "DocumentCursor":
+        """Find all documents in `collection` matching `filter`.
+
+        If `as_of` is set, the documents are searched in the documents as
+        they were at block `as_of`. Documents are fetched `batch_size` at a
+        time when the result is iterated with `async for`.
+        """
+        raise NotImplementedError()
+
+    async def aggregate(
+        self,
+        collection: str,
+        pipeline: List[Document],
+        *,
+        as_of: Optional[int] = None,
+        allow_disk_use: bool = False,
+        batch_size: Optional[int] = None,
+    ) -> "DocumentCursor":
+        """Run the aggregation `pipeline` on the current documents of `collection`.
+
+        If `as_of` is set, the pipeline runs on the documents as they were at
+        block `as_of`.
+        """
+        raise NotImplementedError("aggregation is not supported by this storage")
+
+    @abstractmethod
+    async def insert_one(self, collection: str, doc: Document):
+        """Insert `doc` into `collection`."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def insert_many(self, collection: str, docs: Iterable[Document]):
+        """Insert multiple `docs` into `collection`."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def delete_one(self, collection: str, filter: DocumentFilter):
+        """Delete the first document in `collection` matching `filter`."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def delete_many(self, collection: str, filter: DocumentFilter):
+        """Delete all documents in `collection` matching `filter`."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def find_one_and_replace(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        replacement: Document,
+        upsert: bool = False,
+    ):
+        """Replace the first document in `collection` matching `filter` with `replacement`."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def find_one_and_update(
+        self, collection: str, filter: DocumentFilter, update: Update
+    ):
+        """Update the first document in `collection` matching `filter` with `update`."""
+        raise NotImplementedError()
+
+    async def prefetch(self, collection: str, key_field: str, values: Iterable[Any]):
+        """Fetch the current documents of `collection` with `key_field` in `values`."""
+
+    async def flush(self):
+        """Send the queued writes to the storage."""
+
+
+class DocumentCursor:
+    """The documents returned by `find`.
+
+    Iterate it with `async for` to fetch the documents in batches of
+    `batch_size`, each batch is fetched with `run`, for example in the
+    storage executor. Iterating it with `for` fetches the documents in the
+    event loop.
+
+    Other attributes are the attributes of the underlying cursor, for
+    example `explain` of a pymongo `Cursor`.
+
+    Close the cursor, or use it as an async context manager, to release the
+    server cursor when not all documents are read.
+    """
+
+    def __init__(
+        self,
+        cursor: Iterator[Document],
+        *,
+        batch_size: Optional[int] = None,
+        run: Optional[Callable[..., Awaitable[Any]]] = None,
+    ) -> None:
+        self._cursor = cursor
+        self._batch_size = batch_size or DEFAULT_FIND_BATCH_SIZE
+        self._run = run
+        self._batch: Deque[Document] = deque()
+        self._exhausted = False
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._cursor, name)
+
+    def __iter__(self) -> Iterator[Document]:
+        while self._batch:
+            yield self._batch.popleft()
+        if not self._exhausted:
+            yield from self._cursor
+
+    def __aiter__(self) -> "DocumentCursor":
+        return self
+
+    async def __anext__(self) -> Document:
+        if not self._batch:
+            if not self._exhausted:
+                batch = await self._fetch()
+                # a short batch is the last one.
+                self._exhausted = len(batch) < self._batch_size
+                self._batch.extend(batch)
+            if not self._batch:
+                raise StopAsyncIteration
+        return self._batch.popleft()
+
+    async def to_list(self) -> List[Document]:
+        """Fetch all the remaining documents."""
+        return [doc async for doc in self]
+
+    def close(self):
+        """Close the cursor, the remaining documents are discarded."""
+        self._exhausted = True
+        self._batch.clear()
+        close = getattr(self._cursor, "close", None)
+        if close is not None:
+            close()
+
+    async def __aenter__(self) -> "DocumentCursor":
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def _fetch(self) -> List[Document]:
+        if self._run is None:
+            return self._next_batch()
+        return await self._run(self._next_batch)
+
+    def _next_batch(self) -> List[Document]:
+        return list(itertools.islice(self._cursor, self._batch_size))
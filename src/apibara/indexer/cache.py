@@ -0,0 +1,100 @@
+import copy
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+Document = Dict[str, Any]
+
+NO_KEY = object()
+"""Returned by `DocumentCache.key_of` for filters that are not by primary key."""
+
+
+@dataclass
+class CacheStats:
+    """Document cache statistics."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+
+class DocumentCache:
+    """LRU cache of the current version of documents, by primary key.
+
+    Entries are either a document or `None` if no document has the key.
+    Each entry records the block it's valid from, so that entries changed
+    by invalidated blocks can be dropped.
+
+    Parameters
+    ----------
+    key:
+        the document field used as primary key.
+    max_size:
+        maximum number of entries.
+    """
+
+    def __init__(self, key: str, max_size: int) -> None:
+        self.key = key
+        self.stats = CacheStats()
+        self._max_size = max_size
+        self._entries: "OrderedDict[Any, Tuple[Optional[Document], int]]" = (
+            OrderedDict()
+        )
+
+    def key_of(self, filter: Dict[str, Any]) -> Any:
+        """Returns the key if `filter` selects a document by primary key."""
+        if len(filter) != 1 or self.key not in filter:
+            return NO_KEY
+        value = filter[self.key]
+        if isinstance(value, dict):
+            return NO_KEY
+        try:
+            hash(value)
+        except TypeError:
+            return NO_KEY
+        return value
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._entries
+
+    def get(self, key: Any) -> Tuple[bool, Optional[Document]]:
+        """Returns whether `key` is cached and a copy of its document."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return False, None
+        self.stats.hits += 1
+        self._entries.move_to_end(key)
+        return True, copy.deepcopy(entry[0])
+
+    def put(self, key: Any, doc: Optional[Document], block: int):
+        """Set the document of `key`, valid from `block`."""
+        self._entries[key] = (copy.deepcopy(doc), block)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+        self.stats.size = len(self._entries)
+
+    def evict(self, key: Any):
+        self._entries.pop(key, None)
+        self.stats.size = len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.stats.size = 0
+
+    def invalidate(self, order_key: int):
+        """Drop entries that changed after block `order_key`."""
+        stale = [key for key, (_, block) in self._entries.items() if block > order_key]
+        for key in stale:
+            del self._entries[key]
+        self.stats.size = len(self._entries)
@@ -0,0 +1,75 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Generic, Optional
+
+from apibara.indexer.configuration import Data
+
+DEFAULT_INLINE_THRESHOLD = 64 * 1024
+
+
+class ProcessPoolDecoder(Generic[Data]):
+    """Decode data in a pool of worker processes.
+
+    Decoded data is sent back to the main process with pickle, so decoding
+    large messages only pays off if `transform` converts the data to
+    values that are cheaper to pickle than the raw message, for example
+    the list of rows the handler writes to storage.
+
+    Parameters
+    ----------
+    decode:
+        function to decode the raw data, must be a module-level function.
+    transform:
+        function applied to the decoded data in the worker process, must be
+        a module-level function. The handler receives the transformed data.
+    max_workers:
+        number of worker processes.
+    inline_threshold:
+        messages smaller than this size (in bytes) are decoded in the main
+        process, since sending them to a worker is more expensive than
+        decoding them.
+    """
+
+    def __init__(
+        self,
+        decode: Callable[[bytes], Data],
+        *,
+        transform: Optional[Callable[[Data], Any]] = None,
+        max_workers: Optional[int] = None,
+        inline_threshold: int = DEFAULT_INLINE_THRESHOLD,
+    ) -> None:
+        self._decode = decode
+        self._transform = transform
+        self._inline_threshold = inline_threshold
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    @property
+    def transform(self) -> Optional[Callable[[Data], Any]]:
+        """The function applied to the decoded data, if any."""
+        return self._transform
+
+    def submit(self, raw: bytes) -> "asyncio.Future[Any]":
+        """Start decoding `raw`, returns a future with the decoded data."""
+        loop = asyncio.get_running_loop()
+        if len(raw) < self._inline_threshold:
+            future = loop.create_future()
+            future.set_result(_decode_and_transform(self._decode, self._transform, raw))
+            return future
+        return loop.run_in_executor(
+            self._executor,
+            partial(_decode_and_transform, self._decode, self._transform, raw),
+        )
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        self._executor.shutdown()
+
+
+def _decode_and_transform(
+    decode: Callable[[bytes], Any], transform: Optional[Callable[[Any], Any]], raw
+):
+    data = decode(raw)
+    if transform is not None:
+        return transform(data)
+    return data
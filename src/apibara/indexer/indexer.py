@@ -61,6 +61,14 @@ class Indexer(Generic[Filter, Data], metaclass=ABCMeta):
     def decode_data(self, raw: bytes) -> Data:
         raise NotImplementedError()
 
+    def data_end_cursor(self, data: Data) -> Optional[Cursor]:
+        """Returns the cursor of the block contained in `data`.
+
+        The runner uses this cursor to tell blocks apart when the server
+        sends more than one block in the same message.
+        """
+        return None
+
     @abstractmethod
     async def handle_data(self, info: Info[UserContext, Filter], data: Data):
         raise NotImplementedError()
@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from typing import Generic, Optional, TypeVar
 
-from apibara.indexer.storage import Filter, Storage
+from apibara.indexer.backend import BaseStorage, Filter
 from apibara.protocol.proto.stream_pb2 import Cursor
 
 UserContext = TypeVar("UserContext")
@@ -20,7 +20,7 @@ class Info(Generic[UserContext, Filter]):
     """
 
     context: UserContext
-    storage: Storage
+    storage: BaseStorage
     cursor: Cursor
     end_cursor: Cursor
 
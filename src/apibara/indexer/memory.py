@@ -0,0 +1,615 @@
+import copy
+import operator
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from bson import ObjectId
+
+import apibara.cursor as cursor_utils
+from apibara.indexer.backend import (
+    BaseIndexerStorage,
+    BaseStorage,
+    Document,
+    DocumentCursor,
+    DocumentFilter,
+    Filter,
+    Projection,
+    Update,
+    _chain_filter,
+)
+from apibara.protocol.proto.stream_pb2 import Cursor
+
+MEMORY_URL_SCHEME = "memory://"
+
+_MISSING = object()
+
+_COMPARISONS: Dict[str, Callable[[Any, Any], bool]] = {
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+}
+
+
+def _apply_update(doc: Document, update: Update) -> Optional[Document]:
+    """Returns a copy of `doc` with `update` applied.
+
+    Only `$set`, `$inc` and `$unset` are supported, returns `None` if the
+    update contains other operators.
+    """
+    if not update or any(op not in ("$set", "$inc", "$unset") for op in update):
+        return None
+    updated = copy.deepcopy(doc)
+    for op, fields in update.items():
+        for path, value in fields.items():
+            *parents, key = path.split(".")
+            target = updated
+            for parent in parents:
+                child = target.setdefault(parent, {})
+                if not isinstance(child, dict):
+                    return None
+                target = child
+            if op == "$set":
+                target[key] = value
+            elif op == "$unset":
+                target.pop(key, None)
+            else:
+                current = target.get(key, 0)
+                if not _is_number(current) or not _is_number(value):
+                    return None
+                target[key] = current + value
+    return updated
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class InMemoryIndexerStorage(BaseIndexerStorage[Filter]):
+    """Indexer storage that keeps documents in memory.
+
+    Documents are versioned with the same `_chain` fields used by
+    `IndexerStorage`, so indexers behave the same with both storages.
+    Data is shared by all storages created in the process with the same
+    `url` and `indexer_id`, and lost when the process exits.
+
+    Filters support equality on (dotted) fields, the `$eq`, `$ne`, `$gt`,
+    `$gte`, `$lt`, `$lte`, `$in`, `$nin`, `$exists` and `$not` operators, and
+    `$and`, `$or` and `$nor`. Updates support `$set`, `$inc` and `$unset`.
+
+    Parameters
+    ----------
+    url:
+        storage url, for example `memory://test`.
+    indexer_id:
+        the indexer id.
+    indexes:
+        fields indexed for each collection. Queries with an equality
+        condition on an indexed field only scan the matching documents.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        indexer_id: str,
+        *,
+        indexes: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        if not url.startswith(MEMORY_URL_SCHEME):
+            raise ValueError(
+                f"in-memory storage url must start with {MEMORY_URL_SCHEME}"
+            )
+        self._indexer_id = indexer_id
+        self._key = (url, indexer_id)
+        self._indexes = indexes or {}
+        self.db = _database(self._key, self._indexes)
+
+    @contextmanager
+    def create_storage_for_block(self, cursor: Cursor) -> Iterator["InMemoryStorage"]:
+        yield InMemoryStorage(self.db, cursor)
+
+    @contextmanager
+    def create_storage_for_data(
+        self, cursor: Cursor, *, finalized: bool = False
+    ) -> Iterator["InMemoryStorage"]:
+        storage = InMemoryStorage(self.db, cursor)
+        yield storage
+        self._update_cursor(storage._cursor)
+
+    @contextmanager
+    def create_storage_for_invalidate(
+        self, cursor: Cursor
+    ) -> Iterator["InMemoryStorage"]:
+        storage = InMemoryStorage(self.db, cursor)
+        yield storage
+        self._update_cursor(cursor)
+
+    @contextmanager
+    def create_storage_for_pending(self, cursor: Cursor) -> Iterator["InMemoryStorage"]:
+        yield InMemoryStorage(self.db, cursor)
+
+    def invalidate(self, cursor: Cursor, session: Any = None):
+        """Invalidates all data generate after `cursor`."""
+        for collection in self.db.collections.values():
+            collection.invalidate(cursor.order_key)
+
+    def drop_database(self):
+        _databases.pop(self._key, None)
+        self.db = _database(self._key, self._indexes)
+
+    def _read_configuration(self) -> Optional[Document]:
+        return copy.deepcopy(self.db.configuration)
+
+    def _write_configuration(self, configuration: Document):
+        self.db.configuration = copy.deepcopy(configuration)
+
+    def _update_filter(self, filter: Filter, session: Any = None):
+        self._configuration()["filter"] = filter.encode()
+
+    def _update_cursor(self, cursor: Cursor):
+        self._configuration()["cursor"] = cursor_utils.to_json(cursor)
+
+    def _configuration(self) -> Document:
+        if self.db.configuration is None:
+            self.db.configuration = {"indexer_id": self._indexer_id}
+        return self.db.configuration
+
+
+class InMemoryStorage(BaseStorage):
+    """Chain-aware document storage backed by `InMemoryDatabase`.
+
+    Documents passed to and returned by the storage are copies, modifying
+    them doesn't change the stored documents.
+    """
+
+    def __init__(self, db: "InMemoryDatabase", cursor: Cursor) -> None:
+        self._db = db
+        self._cursor = cursor
+
+    async def find_one(
+        self, collection: str, filter: DocumentFilter, *, as_of: Optional[int] = None
+    ) -> Optional[Document]:
+        """Find the first document in `collection` matching `filter`.
+
+        If `as_of` is set, the document is searched in the documents as
+        they were at block `as_of`.
+        """
+        docs = self._current(collection, filter, as_of=as_of)
+        if not docs:
+            return None
+        return copy.deepcopy(docs[0])
+
+    async def find(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        sort: Optional[Dict[str, int]] = None,
+        projection: Optional[Projection] = None,
+        skip: int = 0,
+        limit: int = 0,
+        *,
+        as_of: Optional[int] = None,
+        batch_size: Optional[int] = None,
+    ) -> DocumentCursor:
+        """Find all documents in `collection` matching `filter`.
+
+        Arguments
+        ---------
+        - `collection`: the collection,
+        - `filter`: the filter,
+        - `sort`: keys used for sorting, e.g. `{"a": -1}` sorts documents by key `a` in descending order,
+        - `project`: filter document keys to reduce the document size,
+        - `skip`: number of documents to skip,
+        - `limit`: maximum number of documents returned,
+        - `as_of`: if set, return the documents as they were at this block,
+        - `batch_size`: number of documents fetched at a time.
+        """
+        docs = self._current(collection, filter, as_of=as_of)
+        return DocumentCursor(
+            iter(_select(docs, sort, projection, skip, limit)), batch_size=batch_size
+        )
+
+    async def insert_one(self, collection: str, doc: Document):
+        """Insert `doc` into `collection`."""
+        self._add_chain_information(doc)
+        doc.setdefault("_id", ObjectId())
+        self._db[collection].insert(copy.deepcopy(doc))
+
+    async def insert_many(self, collection: str, docs: Iterable[Document]):
+        """Insert multiple `docs` into `collection`."""
+        for doc in docs:
+            await self.insert_one(collection, doc)
+
+    async def delete_one(self, collection: str, filter: DocumentFilter):
+        """Delete the first document in `collection` matching `filter`."""
+        existing = await self._find_current(collection, filter)
+        if existing is not None:
+            self._db[collection].clamp(existing["_id"], self._cursor.order_key)
+
+    async def delete_many(self, collection: str, filter: DocumentFilter):
+        """Delete all documents in `collection` matching `filter`."""
+        docs = await self._find_all_current(collection, filter)
+        for id in [doc["_id"] for doc in docs]:
+            self._db[collection].clamp(id, self._cursor.order_key)
+
+    async def find_one_and_replace(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        replacement: Document,
+        upsert: bool = False,
+    ):
+        """Replace the first document in `collection` matching `filter` with `replacement`.
+        If `upsert = True`, insert `replacement` even if no document matched the `filter`.
+        """
+        existing = await self._find_current(collection, filter)
+        if existing is not None:
+            existing = copy.deepcopy(existing)
+            if existing["_chain"]["valid_from"] == self._cursor.order_key:
+                # the document was written at this block, replace it in place.
+                self._add_chain_information(replacement)
+                replacement["_id"] = existing["_id"]
+                self._db[collection].replace(copy.deepcopy(replacement))
+                return existing
+            self._db[collection].clamp(existing["_id"], self._cursor.order_key)
+
+        if existing is not None or upsert:
+            await self.insert_one(collection, replacement)
+
+        return existing
+
+    async def find_one_and_update(
+        self, collection: str, filter: DocumentFilter, update: Update
+    ):
+        """Update the first document in `collection` matching `filter` with `update`."""
+        existing = await self._find_current(collection, filter)
+        if existing is None:
+            return None
+        existing = copy.deepcopy(existing)
+        updated = _apply_update(existing, update)
+        if updated is None:
+            raise ValueError(f"unsupported update {update}")
+
+        if existing["_chain"]["valid_from"] == self._cursor.order_key:
+            # the document was written at this block, update it in place.
+            self._db[collection].replace(updated)
+            return existing
+
+        self._db[collection].clamp(existing["_id"], self._cursor.order_key)
+        del updated["_id"]
+        del updated["_chain"]
+        await self.insert_one(collection, updated)
+        existing["_id"] = updated["_id"]
+        existing["_chain"] = updated["_chain"]
+        return existing
+
+    def _current(
+        self, collection: str, filter: DocumentFilter, *, as_of: Optional[int] = None
+    ) -> List[Document]:
+        """Returns the current (or valid at `as_of`) documents matching `filter`."""
+        return self._db[collection].find({**filter, **_chain_filter(as_of)})
+
+    async def _find_current(
+        self, collection: str, filter: DocumentFilter
+    ) -> Optional[Document]:
+        """Returns the first current document matching `filter`, to modify it."""
+        docs = self._current(collection, filter)
+        if not docs:
+            return None
+        return docs[0]
+
+    async def _find_all_current(
+        self, collection: str, filter: DocumentFilter
+    ) -> List[Document]:
+        """Returns all current documents matching `filter`, to modify them."""
+        return self._current(collection, filter)
+
+    def _add_chain_information(self, doc: Document):
+        doc["_chain"] = {"valid_from": self._cursor.order_key, "valid_to": None}
+
+
+class InMemoryDatabase:
+    """The collections and configuration of an in-memory indexer storage."""
+
+    def __init__(self, indexes: Dict[str, List[str]]) -> None:
+        self._indexes = indexes
+        self.collections: Dict[str, InMemoryCollection] = {}
+        self.configuration: Optional[Document] = None
+
+    def __getitem__(self, name: str) -> "InMemoryCollection":
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = InMemoryCollection(self._indexes.get(name, []))
+            self.collections[name] = collection
+        return collection
+
+
+class InMemoryCollection:
+    """Documents by `_id`, with hashed indexes.
+
+    Documents are indexed by the block they're valid from and to, and by
+    the value of each indexed field.
+    """
+
+    def __init__(self, indexes: List[str]) -> None:
+        self.docs: Dict[Any, Document] = {}
+        self._order: Dict[Any, int] = {}
+        self._next_order = 0
+        self._valid_from: DefaultDict[int, Set[Any]] = defaultdict(set)
+        # the current documents are stored with key `None`.
+        self._valid_to: DefaultDict[Optional[int], Set[Any]] = defaultdict(set)
+        self._indexes: Dict[str, DefaultDict[Any, Set[Any]]] = {
+            field: defaultdict(set) for field in indexes
+        }
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def find(self, filter: DocumentFilter) -> List[Document]:
+        """Returns the documents matching `filter`, in insertion order."""
+        candidates = self._candidates(filter)
+        if candidates is None:
+            docs = list(self.docs.values())
+        elif 4 * len(candidates) > len(self.docs):
+            # cheaper than sorting the candidates.
+            docs = [doc for id, doc in self.docs.items() if id in candidates]
+        else:
+            docs = [self.docs[id] for id in sorted(candidates, key=self._order.get)]
+        return [doc for doc in docs if _matches(doc, filter)]
+
+    def insert(self, doc: Document):
+        if doc["_id"] in self.docs:
+            raise ValueError(f"duplicate document id {doc['_id']}")
+        self.docs[doc["_id"]] = doc
+        self._order[doc["_id"]] = self._next_order
+        self._next_order += 1
+        self._add_to_indexes(doc)
+
+    def replace(self, doc: Document):
+        self._remove_from_indexes(self.docs[doc["_id"]])
+        self.docs[doc["_id"]] = doc
+        self._add_to_indexes(doc)
+
+    def clamp(self, id: Any, order_key: Optional[int]):
+        """Set the block the document with the given `id` is valid to."""
+        doc = self.docs[id]
+        self._remove_from_indexes(doc)
+        doc["_chain"]["valid_to"] = order_key
+        self._add_to_indexes(doc)
+
+    def delete(self, id: Any):
+        self._remove_from_indexes(self.docs.pop(id))
+        del self._order[id]
+
+    def invalidate(self, order_key: int):
+        """Remove the changes made after block `order_key`."""
+        for block in [block for block in self._valid_from if block > order_key]:
+            for id in list(self._valid_from.get(block, ())):
+                self.delete(id)
+        for block in [
+            block for block in self._valid_to if block is not None and block > order_key
+        ]:
+            for id in list(self._valid_to.get(block, ())):
+                self.clamp(id, None)
+
+    def _candidates(self, filter: DocumentFilter) -> Optional[Set[Any]]:
+        """Returns the ids that can match `filter`, or `None` if all can."""
+        candidates = None
+        if "_chain.valid_to" in filter and filter["_chain.valid_to"] is None:
+            candidates = self._valid_to.get(None, set())
+        for field, index in self._indexes.items():
+            value = filter.get(field, _MISSING)
+            if isinstance(value, dict) and list(value) == ["$eq"]:
+                value = value["$eq"]
+            if value is _MISSING or value is None or not _is_hashable(value):
+                continue
+            ids = index.get(value, set())
+            candidates = ids if candidates is None else candidates & ids
+        return candidates
+
+    def _add_to_indexes(self, doc: Document):
+        id = doc["_id"]
+        for index, key in self._index_entries(doc):
+            index[key].add(id)
+
+    def _remove_from_indexes(self, doc: Document):
+        id = doc["_id"]
+        for index, key in self._index_entries(doc):
+            ids = index[key]
+            ids.discard(id)
+            if not ids:
+                del index[key]
+
+    def _index_entries(self, doc: Document) -> Iterator[Tuple[Dict[Any, Set], Any]]:
+        chain = doc["_chain"]
+        yield self._valid_from, chain["valid_from"]
+        yield self._valid_to, chain["valid_to"]
+        for field, index in self._indexes.items():
+            for value in _index_values(doc, field):
+                yield index, value
+
+
+_databases: Dict[Tuple[str, str], InMemoryDatabase] = {}
+
+
+def _database(key: Tuple[str, str], indexes: Dict[str, List[str]]) -> InMemoryDatabase:
+    db = _databases.get(key)
+    if db is None:
+        db = InMemoryDatabase(indexes)
+        _databases[key] = db
+    return db
+
+
+def _get_path(doc: Any, path: str) -> Any:
+    """Returns the value at the dotted `path`, or `_MISSING`."""
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+    return value
+
+
+def _matches(doc: Document, filter: DocumentFilter) -> bool:
+    for key, condition in filter.items():
+        if key == "$and":
+            matched = all(_matches(doc, f) for f in condition)
+        elif key == "$or":
+            matched = any(_matches(doc, f) for f in condition)
+        elif key == "$nor":
+            matched = not any(_matches(doc, f) for f in condition)
+        elif key.startswith("$"):
+            raise ValueError(f"unsupported query operator {key}")
+        else:
+            matched = _matches_condition(_get_path(doc, key), condition)
+        if not matched:
+            return False
+    return True
+
+
+def _matches_condition(value: Any, condition: Any) -> bool:
+    if (
+        isinstance(condition, dict)
+        and condition
+        and all(op.startswith("$") for op in condition)
+    ):
+        return all(_matches_operator(value, op, arg) for op, arg in condition.items())
+    return _equals(value, condition)
+
+
+def _matches_operator(value: Any, op: str, arg: Any) -> bool:
+    if op == "$eq":
+        return _equals(value, arg)
+    if op == "$ne":
+        return not _equals(value, arg)
+    if op == "$in":
+        return any(_equals(value, item) for item in arg)
+    if op == "$nin":
+        return not any(_equals(value, item) for item in arg)
+    if op == "$not":
+        return not _matches_condition(value, arg)
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    if op in _COMPARISONS:
+        if value is _MISSING:
+            return False
+        values = value if isinstance(value, list) else [value]
+        return any(_compare(op, item, arg) for item in values)
+    raise ValueError(f"unsupported query operator {op}")
+
+
+def _equals(value: Any, arg: Any) -> bool:
+    if arg is None:
+        return value is _MISSING or value is None
+    if value is _MISSING:
+        return False
+    # array fields match if any element matches.
+    if isinstance(value, list) and not isinstance(arg, list):
+        return arg in value
+    return value == arg
+
+
+def _compare(op: str, value: Any, arg: Any) -> bool:
+    try:
+        return _COMPARISONS[op](value, arg)
+    except TypeError:
+        return False
+
+
+def _index_values(doc: Document, field: str) -> List[Any]:
+    value = _get_path(doc, field)
+    if value is _MISSING or value is None:
+        return []
+    values = value if isinstance(value, list) else [value]
+    return [item for item in values if item is not None and _is_hashable(item)]
+
+
+def _is_hashable(value: Any) -> bool:
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _select(
+    docs: List[Document],
+    sort: Optional[Dict[str, int]],
+    projection: Optional[Projection],
+    skip: int,
+    limit: int,
+) -> List[Document]:
+    """Returns copies of `docs`, sorted, skipped, limited and projected."""
+    docs = list(docs)
+    if sort is not None:
+        # sort is stable, so sorting by the last key first sorts by all keys.
+        for field, order in reversed(list(sort.items())):
+            docs.sort(key=_sort_key(field), reverse=order < 0)
+    docs = docs[skip:]
+    if limit > 0:
+        docs = docs[:limit]
+    return [_project(doc, projection) for doc in docs]
+
+
+def _sort_key(field: str) -> Callable[[Document], Tuple[int, Any]]:
+    # missing and null values sort first, like in MongoDB.
+    def key(doc: Document) -> Tuple[int, Any]:
+        value = _get_path(doc, field)
+        if value is _MISSING or value is None:
+            return (0, 0)
+        return (1, value)
+
+    return key
+
+
+def _project(doc: Document, projection: Optional[Projection]) -> Document:
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    fields = {field: value for field, value in projection.items() if field != "_id"}
+    include_id = projection.get("_id", 1)
+    if any(fields.values()):
+        projected = {}
+        if include_id and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        for field in fields:
+            value = _get_path(doc, field)
+            if value is not _MISSING:
+                _set_path(projected, field, value)
+        return projected
+    for field in fields:
+        _unset_path(doc, field)
+    if not include_id:
+        doc.pop("_id", None)
+    return doc
+
+
+def _set_path(doc: Document, path: str, value: Any):
+    *parents, key = path.split(".")
+    for parent in parents:
+        doc = doc.setdefault(parent, {})
+    doc[key] = value
+
+
+def _unset_path(doc: Document, path: str):
+    *parents, key = path.split(".")
+    for parent in parents:
+        doc = doc.get(parent)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(key, None)
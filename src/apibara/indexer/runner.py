@@ -1,16 +1,26 @@
 import asyncio
+import hashlib
 import logging
-from dataclasses import dataclass
-from typing import Any, Generic, List, Optional, Tuple
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, Generic, List, Optional, Tuple
 
 from grpc import ssl_channel_credentials
-from grpc.aio import insecure_channel, secure_channel
+from grpc.aio import Channel, insecure_channel, secure_channel
 
+from apibara.indexer.cache import CacheStats
+from apibara.indexer.decoder import ProcessPoolDecoder
 from apibara.indexer.indexer import Indexer
 from apibara.indexer.info import Info, UserContext
+from apibara.indexer.memory import MEMORY_URL_SCHEME, InMemoryIndexerStorage
 from apibara.indexer.storage import Filter, IndexerStorage
-from apibara.protocol import StreamService, credentials_with_auth_token
-from apibara.protocol.proto.stream_pb2 import Cursor, DataFinality
+from apibara.protocol import BlockCache, StreamService, credentials_with_auth_token
+from apibara.protocol.proto.stream_pb2 import (
+    Cursor,
+    Data,
+    DataFinality,
+    StreamDataResponse,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +47,9 @@ class IndexerRunnerConfiguration:
         server authorization token.
     storage_url:
         MongoDB connection string, used to store the indexer  data and state.
+        Use `memory://<name>` to store them in memory with
+        `InMemoryIndexerStorage`, in that case the options specific to
+        MongoDB (`buffer_writes`, `undo_log`, `cache`, ...) are ignored.
     """
 
     stream_url: Optional[str] = None
@@ -45,6 +58,26 @@ class IndexerRunnerConfiguration:
     storage_url: Optional[str] = None
 
 
+@dataclass
+class IndexerRunnerMetrics:
+    """IndexerRunner metrics.
+
+    Parameters
+    ----------
+    read_ahead_depth:
+        number of messages received and decoded, waiting to be handled.
+        A value close to `read_ahead` means that the handler is the bottleneck.
+    storage_cache:
+        document cache statistics, by collection.
+    pending_skipped:
+        number of pending messages skipped because their data didn't change.
+    """
+
+    read_ahead_depth: int = 0
+    storage_cache: Dict[str, CacheStats] = field(default_factory=dict)
+    pending_skipped: int = 0
+
+
 class IndexerRunner(Generic[UserContext, Filter]):
     """Run an indexer, listening for new data and calling the provided callbacks.
 
@@ -58,6 +91,72 @@ class IndexerRunner(Generic[UserContext, Filter]):
         list of options passed to the gRPC channel.
     timeout:
         custom timeout for a message to arrive.
+    batch_size:
+        number of blocks requested in each message. Values larger than 1
+        speed up indexing historical data, the handler is still invoked once
+        per block but the indexer cursor is stored once per message.
+        Pending data and invalidations are always delivered one block at a time.
+    read_ahead:
+        maximum number of messages received and decoded while the handler
+        is processing the previous message. If not set, the next message is
+        received only after the previous one has been handled.
+    decoder:
+        decode data in worker processes instead of using `Indexer.decode_data`.
+        Use together with `read_ahead` to decode data while the handler is
+        processing the previous message. A decoder with a `transform` can't
+        be used with `batch_size > 1`, since `Indexer.data_end_cursor`
+        expects decoded data.
+    channel:
+        gRPC channel shared between runners. Each runner opens its own stream
+        on the channel, so that many indexers in the same process share one
+        connection to the server. The runner doesn't close the channel.
+    block_cache:
+        cache finalized data on disk. When the indexer restarts (for example
+        after resetting its state), data is read from the cache instead of
+        the server.
+    buffer_writes:
+        queue storage writes and send them in bulk after each message is
+        handled, instead of sending each write to the database immediately.
+    storage_executor:
+        run storage calls made by the indexer handlers, and invalidations, in
+        this executor, for example a `ThreadPoolExecutor` with one thread, so
+        that they don't block the event loop while data is received. See
+        `IndexerStorage` for the calls that still block the event loop.
+    undo_log:
+        record the changes made at each block that is not finalized, so that
+        invalidating data only touches the documents that changed.
+    transactions:
+        write the changes of each message and the indexer cursor in one
+        transaction. Requires a MongoDB replica set.
+    commit_blocks:
+        in transactional mode, commit finalized data every `commit_blocks`
+        messages.
+    commit_interval:
+        in transactional mode, commit finalized data at least every
+        `commit_interval` seconds.
+    retention:
+        how many blocks of history to keep before the finalized block. If `0`
+        only the latest version of documents is kept, if `None` all versions
+        are kept. `as_of` queries of deleted history raise `ValueError`.
+    finality_depth:
+        number of blocks after which data that is not finalized is assumed to
+        be final. See `IndexerStorage`.
+    cache:
+        cache the current version of documents of these collections, keyed by
+        the given document field. See `IndexerStorage`.
+    cache_size:
+        maximum number of documents cached for each collection.
+    pending_overlay:
+        keep the changes made by `handle_pending_data` in memory instead of
+        writing them to the database. `handle_pending_data` can't use
+        `aggregate` with this option. See `IndexerStorage`.
+    pending_mirror:
+        with `pending_overlay`, copy the pending changes to the
+        `_pending_<collection>` collections.
+    skip_unchanged_pending:
+        skip pending data identical to the previous pending data, instead of
+        discarding the previous changes and calling `handle_pending_data`
+        again. The handler must only depend on the data it receives.
     """
 
     def __init__(
@@ -67,9 +166,29 @@ class IndexerRunner(Generic[UserContext, Filter]):
         config: Optional[IndexerRunnerConfiguration] = None,
         client_options: Optional[List[Tuple[str, Any]]] = None,
         timeout: Optional[int] = None,
+        batch_size: int = 1,
+        read_ahead: Optional[int] = None,
+        decoder: Optional[ProcessPoolDecoder] = None,
+        channel: Optional[Channel] = None,
+        block_cache: Optional[BlockCache] = None,
+        buffer_writes: bool = False,
+        storage_executor: Optional[Executor] = None,
+        undo_log: bool = False,
+        transactions: bool = False,
+        commit_blocks: int = 1,
+        commit_interval: Optional[float] = None,
+        retention: Optional[int] = None,
+        finality_depth: int = 1_000,
+        cache: Optional[Dict[str, str]] = None,
+        cache_size: int = 10_000,
+        pending_overlay: bool = False,
+        pending_mirror: bool = False,
+        skip_unchanged_pending: bool = False,
         _reconnect_to_avoid_disconnection: Optional[int] = None,
         _force_filter_from_script: Optional[bool] = None,
     ) -> None:
+        if batch_size > 1 and decoder is not None and decoder.transform is not None:
+            raise ValueError("decoder transform is not supported with batch_size > 1")
         if config is None:
             config = IndexerRunnerConfiguration()
         if client_options is None:
@@ -79,6 +198,25 @@ class IndexerRunner(Generic[UserContext, Filter]):
         self._indexer_id = None
         self._indexer_storage = None
         self._timeout = timeout
+        self._batch_size = batch_size
+        self._read_ahead = read_ahead
+        self._decoder = decoder
+        self._shared_channel = channel
+        self._block_cache = block_cache
+        self._buffer_writes = buffer_writes
+        self._storage_executor = storage_executor
+        self._undo_log = undo_log
+        self._transactions = transactions
+        self._commit_blocks = commit_blocks
+        self._commit_interval = commit_interval
+        self._retention = retention
+        self._finality_depth = finality_depth
+        self._cache = cache
+        self._cache_size = cache_size
+        self._pending_overlay = pending_overlay
+        self._pending_mirror = pending_mirror
+        self._skip_unchanged_pending = skip_unchanged_pending
+        self.metrics = IndexerRunnerMetrics()
         self._client_options = client_options
         self._reconnect_to_avoid_disconnection = _reconnect_to_avoid_disconnection
         self._force_filter_from_script = _force_filter_from_script
@@ -94,7 +232,7 @@ class IndexerRunner(Generic[UserContext, Filter]):
         if self._config is None:
             raise RuntimeError("must provide config to IndexerRunner")
 
-        if self._config.stream_url is None:
+        if self._config.stream_url is None and self._shared_channel is None:
             raise RuntimeError("must provide a stream_url in config")
 
         if self._config.storage_url is None:
@@ -102,9 +240,28 @@ class IndexerRunner(Generic[UserContext, Filter]):
 
     def _setup_storage(self, indexer: Indexer):
         self._indexer_id = indexer.indexer_id()
-        self._indexer_storage = IndexerStorage(
-            self._config.storage_url, self._indexer_id
-        )
+        if self._config.storage_url.startswith(MEMORY_URL_SCHEME):
+            self._indexer_storage = InMemoryIndexerStorage(
+                self._config.storage_url, self._indexer_id
+            )
+        else:
+            self._indexer_storage = IndexerStorage(
+                self._config.storage_url,
+                self._indexer_id,
+                buffer_writes=self._buffer_writes,
+                executor=self._storage_executor,
+                undo_log=self._undo_log,
+                transactions=self._transactions,
+                commit_blocks=self._commit_blocks,
+                commit_interval=self._commit_interval,
+                retention=self._retention,
+                finality_depth=self._finality_depth,
+                cache=self._cache,
+                cache_size=self._cache_size,
+                pending_overlay=self._pending_overlay,
+                pending_mirror=self._pending_mirror,
+            )
+        self.metrics.storage_cache = self._indexer_storage.cache_stats()
 
     def _maybe_reset_state(self):
         if self._reset_state:
@@ -119,8 +276,11 @@ class IndexerRunner(Generic[UserContext, Filter]):
             try:
                 await self._connect_and_stream(indexer, ctx)
                 # stream never ends, except when testing
+                self._indexer_storage.commit()
                 return
             except Exception as exc:
+                # data of the open transaction is streamed again after reconnecting.
+                self._indexer_storage.abort()
                 logger.exception(f"indexer exception")
                 self._retry_count += 1
                 reconnect = await indexer.handle_reconnect(exc, self._retry_count)
@@ -133,12 +293,16 @@ class IndexerRunner(Generic[UserContext, Filter]):
 
         This method is provided so that it can be mocked in tests.
         """
-        channel = self._channel()
+        channel = self._shared_channel
+        if channel is None:
+            channel = self._channel()
         (client, stream) = StreamService(channel).stream_data(timeout=self._timeout)
         return (client, stream, channel)
 
     async def _connect_and_stream(self, indexer: Indexer, ctx: Optional[UserContext]):
         (client, stream, _channel) = self._stream_data()
+        if self._block_cache is not None:
+            (client, stream) = self._block_cache.wrap(client, stream)
 
         config = indexer.initial_configuration()
         has_stored = self._indexer_storage.update_with_stored_configuration(
@@ -147,7 +311,9 @@ class IndexerRunner(Generic[UserContext, Filter]):
         )
         if has_stored:
             # invalidate old pending data, if any
-            self._indexer_storage.invalidate(config.starting_cursor)
+            await self._indexer_storage._run(
+                self._indexer_storage.invalidate, config.starting_cursor
+            )
 
         logger.debug("indexer configuration read")
 
@@ -155,13 +321,14 @@ class IndexerRunner(Generic[UserContext, Filter]):
             filter=config.filter.encode(),
             finality=config.finality,
             cursor=config.starting_cursor,
-            batch_size=1,
+            batch_size=self._batch_size,
         )
 
         logger.debug("indexer configuration sent")
 
         previous_end_cursor = None
         pending_received = False
+        pending_fingerprint = None
         additional_filter = None
         runner_state = "default"  # or "resync"
 
@@ -169,153 +336,214 @@ class IndexerRunner(Generic[UserContext, Filter]):
         if self._reconnect_to_avoid_disconnection is not None:
             _blocks_before_reconnect = self._reconnect_to_avoid_disconnection
 
-        async for message in stream:
-            logger.debug("received message")
-            self._retry_count = 0
-
-            if message.data is not None:
-                assert (
-                    len(message.data.data) <= 1
-                ), "indexer runner requires batch_size == 1"
-
-                if runner_state == "resync":
-                    logger.debug("handle block resync")
-                    end_cursor = message.data.end_cursor
-                    cursor = message.data.cursor
-                    logger.debug(f"handle resync batch {cursor} - {end_cursor}")
-                    with self._indexer_storage.create_storage_for_data(
-                        message.data.end_cursor
-                    ) as storage:
-                        for batch in message.data.data:
-                            decoded_data = indexer.decode_data(batch)
-                            # only call handler if the batch is for the same block
-                            if (
-                                decoded_data.header.block_number
-                                == previous_end_cursor.order_key
-                            ):
-                                info = Info(
-                                    context=ctx,
-                                    storage=storage,
-                                    cursor=cursor,
-                                    end_cursor=end_cursor,
-                                )
-
-                                await indexer.handle_data(info, decoded_data)
-                                new_additional_filter = indexer._get_and_reset_filter()
-                                if new_additional_filter is not None:
-                                    raise RuntimeError(
-                                        "additional filter not supported when rescanning block"
+        reader = _MessageReader(
+            stream,
+            indexer.decode_data,
+            decoder=self._decoder,
+            read_ahead=self._read_ahead,
+            metrics=self.metrics,
+        )
+        try:
+            async for message, decoded in reader:
+                logger.debug("received message")
+                self._retry_count = 0
+
+                if message.HasField("data"):
+                    if runner_state == "resync":
+                        logger.debug("handle block resync")
+                        end_cursor = message.data.end_cursor
+                        cursor = message.data.cursor
+                        logger.debug(f"handle resync batch {cursor} - {end_cursor}")
+                        with self._indexer_storage.create_storage_for_data(
+                            message.data.end_cursor,
+                            finalized=message.data.finality
+                            == DataFinality.DATA_STATUS_FINALIZED,
+                        ) as storage:
+                            # only call handler if the batch is for the same block.
+                            # batches contain one block, compare the raw cursor
+                            # since the decoder may have transformed the data.
+                            if end_cursor.order_key == previous_end_cursor.order_key:
+                                for decoded_data in decoded:
+                                    info = Info(
+                                        context=ctx,
+                                        storage=storage,
+                                        cursor=cursor,
+                                        end_cursor=end_cursor,
                                     )
-                    # in any case, restart syncing from where it left off
-                    runner_state = "default"
-                    config.filter = config.filter.merge(additional_filter)
-                    self._indexer_storage._update_filter(config.filter)
-                    await client.configure(
-                        filter=config.filter.encode(),
-                        finality=config.finality,
-                        cursor=previous_end_cursor,
-                        batch_size=1,
-                    )
-                    continue
 
-                # invalidate any pending data, if any
-                should_invalidate = False
-                if pending_received and previous_end_cursor is not None:
-                    should_invalidate = True
+                                    await indexer.handle_data(info, decoded_data)
+                                    new_additional_filter = (
+                                        indexer._get_and_reset_filter()
+                                    )
+                                    if new_additional_filter is not None:
+                                        raise RuntimeError(
+                                            "additional filter not supported when rescanning block"
+                                        )
+                            await storage.flush()
+                        # in any case, restart syncing from where it left off
+                        runner_state = "default"
+                        config.filter = config.filter.merge(additional_filter)
+                        self._indexer_storage._update_filter(config.filter)
+                        await client.configure(
+                            filter=config.filter.encode(),
+                            finality=config.finality,
+                            cursor=previous_end_cursor,
+                            batch_size=self._batch_size,
+                        )
+                        reader.reconfigured()
+                        continue
 
-                is_pending = message.data.finality == DataFinality.DATA_STATUS_PENDING
-                pending_received = is_pending
+                    is_pending = (
+                        message.data.finality == DataFinality.DATA_STATUS_PENDING
+                    )
+                    if is_pending and self._skip_unchanged_pending:
+                        fingerprint = _data_fingerprint(message.data)
+                        if pending_received and fingerprint == pending_fingerprint:
+                            logger.debug("pending data unchanged, skip it")
+                            self.metrics.pending_skipped += 1
+                            continue
+                        pending_fingerprint = fingerprint
+
+                    # invalidate any pending data, if any
+                    should_invalidate = False
+                    if pending_received and previous_end_cursor is not None:
+                        should_invalidate = True
+
+                    pending_received = is_pending
+                    is_finalized = (
+                        message.data.finality == DataFinality.DATA_STATUS_FINALIZED
+                    )
 
-                end_cursor = message.data.end_cursor
-                cursor = message.data.cursor
+                    end_cursor = message.data.end_cursor
+                    cursor = message.data.cursor
 
-                logger.debug(f"handle batch {cursor} - {end_cursor}")
+                    logger.debug(f"handle batch {cursor} - {end_cursor}")
 
-                if (
-                    self._reconnect_to_avoid_disconnection is not None
-                    and not is_pending
-                ):
-                    _blocks_before_reconnect -= 1
+                    if (
+                        self._reconnect_to_avoid_disconnection is not None
+                        and not is_pending
+                    ):
+                        _blocks_before_reconnect -= len(message.data.data)
 
-                if is_pending:
-                    create_storage = (
-                        lambda cursor: self._indexer_storage.create_storage_for_pending(
+                    if is_pending:
+                        create_storage = lambda cursor: self._indexer_storage.create_storage_for_pending(
                             cursor
                         )
-                    )
-                else:
-                    create_storage = (
-                        lambda cursor: self._indexer_storage.create_storage_for_data(
-                            cursor
+                    else:
+                        create_storage = lambda cursor: self._indexer_storage.create_storage_for_data(
+                            cursor, finalized=is_finalized
                         )
-                    )
 
-                with create_storage(message.data.end_cursor) as storage:
-                    additional_filter = None
-                    if should_invalidate:
-                        self._indexer_storage.invalidate(
-                            previous_end_cursor, session=storage._session
-                        )
+                    with create_storage(message.data.end_cursor) as storage:
+                        additional_filter = None
+                        if should_invalidate:
+                            await self._indexer_storage._run(
+                                self._indexer_storage.discard_pending,
+                                previous_end_cursor,
+                                session=storage._session,
+                            )
+
+                        block_cursor = cursor
+                        for i, decoded_data in enumerate(decoded):
+                            if i == len(decoded) - 1:
+                                block_end_cursor = end_cursor
+                            else:
+                                block_end_cursor = self._data_end_cursor(
+                                    indexer, decoded_data
+                                )
+                            # values are versioned with the block they belong to
+                            storage._cursor = block_end_cursor
+                            info = Info(
+                                context=ctx,
+                                storage=storage,
+                                cursor=block_cursor,
+                                end_cursor=block_end_cursor,
+                            )
+                            if is_pending:
+                                await indexer.handle_pending_data(info, decoded_data)
+                                additional_filter = indexer._get_and_reset_filter()
+                                if additional_filter is not None:
+                                    raise RuntimeError(
+                                        "additional filter not supported for pending data"
+                                    )
+                            else:
+                                await indexer.handle_data(info, decoded_data)
+                                additional_filter = indexer._get_and_reset_filter()
+
+                            block_cursor = block_end_cursor
 
-                    for batch in message.data.data:
-                        decoded_data = indexer.decode_data(batch)
-                        info = Info(
-                            context=ctx,
-                            storage=storage,
-                            cursor=cursor,
-                            end_cursor=end_cursor,
-                        )
-                        if is_pending:
-                            await indexer.handle_pending_data(info, decoded_data)
-                            additional_filter = indexer._get_and_reset_filter()
                             if additional_filter is not None:
-                                raise RuntimeError(
-                                    "additional filter not supported for pending data"
+                                # skip the rest of the batch, it's streamed again
+                                # after the current block is rescanned.
+                                end_cursor = block_end_cursor
+                                logger.debug(
+                                    f"filter updated. rescanning block from {end_cursor.order_key - 1}"
+                                )
+                                runner_state = "resync"
+                                await client.configure(
+                                    filter=additional_filter.encode(),
+                                    finality=config.finality,
+                                    cursor=Cursor(order_key=end_cursor.order_key - 1),
+                                    batch_size=1,
                                 )
-                        else:
-                            await indexer.handle_data(info, decoded_data)
-                            additional_filter = indexer._get_and_reset_filter()
+                                reader.reconfigured()
+                                break
 
-                        if additional_filter is not None:
-                            logger.debug(
-                                f"filter updated. rescanning block from {end_cursor.order_key - 1}"
+                        await storage.flush()
+
+                    if not is_pending:
+                        previous_end_cursor = end_cursor
+
+                    if self._reconnect_to_avoid_disconnection is not None:
+                        if _blocks_before_reconnect <= 0:
+                            _blocks_before_reconnect = (
+                                self._reconnect_to_avoid_disconnection
                             )
-                            runner_state = "resync"
                             await client.configure(
-                                filter=additional_filter.encode(),
+                                filter=config.filter.encode(),
                                 finality=config.finality,
-                                cursor=Cursor(order_key=end_cursor.order_key - 1),
-                                batch_size=1,
+                                cursor=end_cursor,
+                                batch_size=self._batch_size,
                             )
+                            reader.reconfigured()
 
-                if not is_pending:
-                    previous_end_cursor = message.data.end_cursor
-
-                if self._reconnect_to_avoid_disconnection is not None:
-                    if _blocks_before_reconnect <= 0:
-                        _blocks_before_reconnect = (
-                            self._reconnect_to_avoid_disconnection
-                        )
-                        await client.configure(
-                            filter=config.filter.encode(),
-                            finality=config.finality,
-                            cursor=end_cursor,
-                            batch_size=1,
+                elif message.HasField("invalidate"):
+                    with self._indexer_storage.create_storage_for_invalidate(
+                        message.invalidate.cursor
+                    ) as storage:
+                        cursor = message.invalidate.cursor
+                        info = Info(
+                            context=ctx,
+                            storage=storage,
+                            cursor=cursor,
+                            end_cursor=cursor,
                         )
 
-            elif message.invalidate is not None:
-                with self._indexer_storage.create_storage_for_invalidate(
-                    message.invalidate.cursor
-                ) as storage:
-                    cursor = message.invalidate.cursor
-                    info = Info(
-                        context=ctx, storage=storage, cursor=cursor, end_cursor=cursor
-                    )
-
-                    self._indexer_storage.invalidate(cursor, session=storage._session)
+                        await self._indexer_storage._run(
+                            self._indexer_storage.invalidate,
+                            cursor,
+                            session=storage._session,
+                        )
 
-                    await indexer.handle_invalidate(info, cursor)
-                previous_end_cursor = message.invalidate.cursor
+                        await indexer.handle_invalidate(info, cursor)
+                        await storage.flush()
+                    previous_end_cursor = message.invalidate.cursor
+                    # the pending data may have been invalidated, handle it again.
+                    pending_fingerprint = None
+
+                elif message.HasField("heartbeat"):
+                    # don't keep a transaction open while waiting for data.
+                    self._indexer_storage.commit()
+        finally:
+            await reader.close()
+
+    def _data_end_cursor(self, indexer: Indexer, data: Any) -> Cursor:
+        end_cursor = indexer.data_end_cursor(data)
+        if end_cursor is None:
+            raise RuntimeError(
+                "indexer must implement data_end_cursor to use batch_size > 1"
+            )
+        return end_cursor
 
     def _channel(self):
         if self._config.stream_ssl:
@@ -327,3 +555,106 @@ class IndexerRunner(Generic[UserContext, Filter]):
                 options=self._client_options,
             )
         return insecure_channel(self._config.stream_url, options=self._client_options)
+
+
+def _data_fingerprint(data: Data) -> bytes:
+    """Returns a digest of the cursors and payloads of `data`."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(data.cursor.SerializeToString())
+    digest.update(data.end_cursor.SerializeToString())
+    for payload in data.data:
+        digest.update(len(payload).to_bytes(8, "little"))
+        digest.update(payload)
+    return digest.digest()
+
+
+class _MessageReader:
+    """Receives messages from the stream and decodes their data.
+
+    If `read_ahead` is set, messages are received and decoded in a background
+    task while the previous messages are being handled.
+    """
+
+    def __init__(
+        self,
+        stream: AsyncIterator[StreamDataResponse],
+        decode: Callable[[bytes], Any],
+        *,
+        decoder: Optional[ProcessPoolDecoder],
+        read_ahead: Optional[int],
+        metrics: IndexerRunnerMetrics,
+    ) -> None:
+        self._stream = stream
+        self._decode = decode
+        self._decoder = decoder
+        self._read_ahead = read_ahead
+        self._metrics = metrics
+        self._stream_id = None
+        self._stale_stream_id = None
+        self._receiver: Optional[asyncio.Task] = None
+
+    def reconfigured(self):
+        """Signal that the stream was reconfigured.
+
+        Messages already read ahead belong to the old stream and are dropped.
+        """
+        self._stale_stream_id = self._stream_id
+
+    def _decode_message(self, message: StreamDataResponse) -> List[Any]:
+        if self._decoder is not None:
+            # decoding starts now, the result is awaited in `_decoded`.
+            return [self._decoder.submit(batch) for batch in message.data.data]
+        return [self._decode(batch) for batch in message.data.data]
+
+    async def _decoded(self, decoded: List[Any]) -> List[Any]:
+        if self._decoder is not None:
+            return [await future for future in decoded]
+        return decoded
+
+    async def __aiter__(self):
+        if self._read_ahead is None:
+            async for message in self._stream:
+                self._stream_id = message.stream_id
+                yield message, await self._decoded(self._decode_message(message))
+            return
+
+        queue = asyncio.Queue(maxsize=self._read_ahead)
+        self._receiver = asyncio.create_task(self._receive(queue))
+        try:
+            while True:
+                item = await queue.get()
+                self._metrics.read_ahead_depth = queue.qsize()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                message, decoded = item
+                if (
+                    self._stale_stream_id is not None
+                    and message.stream_id <= self._stale_stream_id
+                ):
+                    logger.debug("drop message from previous stream")
+                    continue
+                self._stream_id = message.stream_id
+                yield message, await self._decoded(decoded)
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Stop receiving messages in the background, if reading ahead."""
+        receiver, self._receiver = self._receiver, None
+        if receiver is None:
+            return
+        receiver.cancel()
+        try:
+            await receiver
+        except asyncio.CancelledError:
+            pass
+
+    async def _receive(self, queue: asyncio.Queue):
+        try:
+            async for message in self._stream:
+                await queue.put((message, self._decode_message(message)))
+            await queue.put(None)
+        except Exception as exc:
+            await queue.put(exc)
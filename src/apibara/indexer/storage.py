@@ -1,118 +1,363 @@
+import asyncio
+import copy
+import functools
 import logging
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Any, Dict, Generic, Iterable, Iterator, Optional, TypeVar
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import ASCENDING, InsertOne, MongoClient, ReplaceOne, UpdateMany, UpdateOne
 from pymongo.client_session import ClientSession
 from pymongo.database import Database
 
 import apibara.cursor as cursor_utils
-from apibara.indexer.configuration import IndexerConfiguration
+from apibara.indexer.backend import (
+    BaseIndexerStorage,
+    BaseStorage,
+    Document,
+    DocumentCursor,
+    DocumentFilter,
+    Filter,
+    Projection,
+    Update,
+    _chain_filter,
+)
+from apibara.indexer.cache import NO_KEY, CacheStats, DocumentCache
+from apibara.indexer.memory import (
+    InMemoryDatabase,
+    InMemoryStorage,
+    _apply_update,
+    _select,
+)
 from apibara.protocol.proto.stream_pb2 import Cursor
 
-Document = Dict[str, Any]
-DocumentFilter = Dict[str, Any]
-Update = Dict[str, Any]
-Projection = Dict[str, Any]
-
-Filter = TypeVar("Filter")
+T = TypeVar("T")
 
 
 logger = logging.getLogger(__name__)
 
+_UNDO_LOG = "_apibara_undo"
+# aggregation stages that must be the first stage of a pipeline.
+_FIRST_STAGES = ("$geoNear", "$search", "$vectorSearch")
+
 
-class IndexerStorage(Generic[Filter]):
+class IndexerStorage(BaseIndexerStorage[Filter]):
     """
     Manage indexers storage.
+
+    Parameters
+    ----------
+    url:
+        the MongoDB connection url.
+    indexer_id:
+        the indexer id, used as database name.
+    buffer_writes:
+        queue writes in memory and send them with one `bulk_write` per
+        collection when the storage context exits. Reads flush the
+        writes queued for the collection first.
+    executor:
+        run the database calls made by `Storage`, and the invalidations made
+        by the runner, in this executor so that they don't block the event
+        loop. Use an executor with a single thread to keep calls in order.
+        The calls made when a storage context exits (updating the indexer
+        cursor, pruning the undo log, writing the pending mirror and
+        committing transactions) still block the event loop.
+    undo_log:
+        record the documents inserted and deleted at each block that is not
+        finalized, so that invalidating data only touches the documents
+        changed after the invalidated block. Records are removed once the
+        block is finalized, or when they're more than `finality_depth` blocks
+        behind the last block.
+    transactions:
+        write the changes of each storage context and the indexer cursor in
+        one transaction. Requires a MongoDB replica set.
+    commit_blocks:
+        in transactional mode, commit finalized data every `commit_blocks`
+        storage contexts instead of after each of them.
+    commit_interval:
+        in transactional mode, commit finalized data at least every
+        `commit_interval` seconds.
+    retention:
+        how many blocks of history to keep. Versions of documents that were
+        replaced or deleted more than `retention` blocks before the last
+        finalized block (or `finality_depth` blocks before the last block) are
+        deleted in a background thread. If `0`, only the
+        latest version of each document is kept once finalized. If `None`
+        (the default), all versions are kept. `as_of` queries before the
+        block up to which versions were deleted raise `ValueError`.
+    finality_depth:
+        number of blocks after which data that is not finalized is assumed to
+        be final. Undo records of older blocks are removed, invalidations
+        deeper than that visit the collections written after the invalidated
+        block instead of using the undo log. With `retention`, versions
+        replaced before that block can be deleted and are not restored by
+        deeper invalidations.
+    cache:
+        cache the current version of documents of these collections, the
+        value is the document field used as primary key. `Storage.find_one`
+        calls that filter by primary key only are served from the cache. The
+        cache is updated by the `Storage` write methods, documents written by
+        other means must not be cached.
+    cache_size:
+        maximum number of documents cached for each collection.
+    pending_overlay:
+        keep the changes made by pending data in memory, in a `PendingStorage`
+        layered over the indexer collections, instead of writing them to the
+        database and invalidating them when the next block is received.
+        `aggregate` is not supported on pending data with this option, it
+        raises `NotImplementedError`.
+    pending_mirror:
+        with `pending_overlay`, write the documents of the overlay to the
+        `_pending_<collection>` collections, so that they're visible to other
+        readers of the database. The collections are replaced by each pending
+        block and emptied when data is received.
     """
 
-    def __init__(self, url: Optional[str], indexer_id: str) -> None:
+    def __init__(
+        self,
+        url: Optional[str],
+        indexer_id: str,
+        *,
+        buffer_writes: bool = False,
+        executor: Optional[Executor] = None,
+        undo_log: bool = False,
+        transactions: bool = False,
+        commit_blocks: int = 1,
+        commit_interval: Optional[float] = None,
+        retention: Optional[int] = None,
+        finality_depth: int = 1_000,
+        cache: Optional[Dict[str, str]] = None,
+        cache_size: int = 10_000,
+        pending_overlay: bool = False,
+        pending_mirror: bool = False,
+    ) -> None:
         if url is None:
             raise ValueError("Storage url must be not None")
 
         self.db_name = indexer_id.replace("-", "_")
         self._indexer_id = indexer_id
+        self._buffer_writes = buffer_writes
+        self._executor = executor
 
         self._mongo = MongoClient(url)
         self.db = self._mongo[self.db_name]
+        self._registry = _CollectionRegistry(self.db)
+
+        self._undo_log = undo_log
+        # the undo log may contain records that can be pruned.
+        self._undo_log_dirty = undo_log
+        self._finality_depth = finality_depth
+        # undo records of blocks up to this block have been removed.
+        self._undo_log_horizon = -1
+        if undo_log:
+            self.db[_UNDO_LOG].create_index("block")
+
+        self._transactions = transactions
+        self._commit_group = _CommitGroup(commit_blocks, commit_interval)
+        self._transaction: Optional[ClientSession] = None
+        if transactions:
+            # indexes are created outside of transactions, create the indexes
+            # of existing collections now to avoid waiting on an open transaction.
+            self._registry.unknown()
+
+        self._caches = {
+            collection: DocumentCache(key, cache_size)
+            for collection, key in (cache or {}).items()
+        }
+
+        self._compactor: Optional[_Compactor] = None
+        if retention is not None:
+            self._compactor = _Compactor(self.db, retention)
+
+        self._pending_overlay = pending_overlay
+        self._pending_mirror = pending_mirror
+        # collections of the last pending data mirrored to the database.
+        self._mirrored: List[str] = []
 
     @contextmanager
     def create_storage_for_block(self, cursor: Cursor) -> Iterator["Storage"]:
-        with self._mongo.start_session() as session:
-            yield Storage(self.db, session=session, cursor=cursor)
+        with self._session() as session:
+            storage = self._create_storage(cursor, session)
+            yield storage
+            storage._flush()
 
     @contextmanager
-    def create_storage_for_data(self, cursor: Cursor) -> Iterator["Storage"]:
-        with self._mongo.start_session() as session:
-            yield Storage(self.db, session=session, cursor=cursor)
-            self._update_cursor(cursor, session)
+    def create_storage_for_data(
+        self, cursor: Cursor, *, finalized: bool = False
+    ) -> Iterator["Storage"]:
+        with self._session(group=finalized) as session:
+            # finalized data is never invalidated, so it doesn't need undo records.
+            storage = self._create_storage(
+                cursor, session, undo_log=self._undo_log and not finalized
+            )
+            yield storage
+            storage._flush()
+            # the storage cursor is moved forward when handling a batch of
+            # blocks, store the cursor of the last block handled.
+            self._update_cursor(storage._cursor, session)
+            if finalized:
+                self._prune_undo_log(storage._cursor, session)
+            elif self._undo_log:
+                self._cap_undo_log(storage._cursor, session)
+        if self._compactor is not None:
+            finalized_key = storage._cursor.order_key
+            if not finalized:
+                # the stream only reports finality with finalized data.
+                finalized_key -= self._finality_depth
+            self._compactor.finalized(finalized_key, self._registry.collections())
 
     @contextmanager
     def create_storage_for_invalidate(self, cursor: Cursor) -> Iterator["Storage"]:
-        with self._mongo.start_session() as session:
-            yield Storage(self.db, session=session, cursor=cursor)
+        with self._session() as session:
+            storage = self._create_storage(cursor, session)
+            yield storage
+            storage._flush()
             self._update_cursor(cursor, session)
 
     @contextmanager
-    def create_storage_for_pending(self, cursor: Cursor) -> Iterator["Storage"]:
-        with self._mongo.start_session() as session:
-            yield Storage(self.db, session=session, cursor=cursor)
+    def create_storage_for_pending(
+        self, cursor: Cursor
+    ) -> Iterator[Union["Storage", "PendingStorage"]]:
+        with self._session() as session:
+            if not self._pending_overlay:
+                storage = self._create_storage(cursor, session)
+                yield storage
+                storage._flush()
+                return
+            base = ReadOnlyStorage(
+                self.db,
+                session=session,
+                executor=self._executor,
+                compactor=self._compactor,
+            )
+            pending = PendingStorage(base, cursor)
+            yield pending
+            if self._pending_mirror:
+                self._mirror_pending(pending, session)
 
-    def _initialize_configuration(self, configuration: IndexerConfiguration[Filter]):
-        existing = self.db["_apibara"].find_one({"indexer_id": self._indexer_id})
-        if existing is not None:
+    def commit(self):
+        """Commit the open transaction, if any."""
+        if self._transaction is None:
             return
+        logger.debug("commit transaction")
+        session, self._transaction = self._transaction, None
+        self._commit_group.reset()
+        try:
+            session.commit_transaction()
+        finally:
+            session.end_session()
 
-        logger.debug("writing initial configuration to storage")
+    def abort(self):
+        """Abort the open transaction, if any, discarding its changes."""
+        if self._transaction is None:
+            return
+        # the caches may contain changes of the transaction.
+        self._clear_caches()
+        logger.debug("abort transaction")
+        session, self._transaction = self._transaction, None
+        self._commit_group.reset()
+        try:
+            session.abort_transaction()
+        finally:
+            session.end_session()
 
-        cursor = None
-        if configuration.starting_cursor is not None:
-            cursor = cursor_utils.to_json(configuration.starting_cursor)
+    @contextmanager
+    def _session(self, *, group: bool = False) -> Iterator[ClientSession]:
+        """Returns the session used by a storage context.
 
-        if configuration.filter is None:
-            raise RuntimeError("configuration filter must be defined")
+        In transactional mode the session is in a transaction, committed when
+        the context exits. If `group` is set, the transaction is committed
+        only when the commit group is full, so that it includes the changes
+        of the next contexts.
+        """
+        if not self._transactions:
+            with self._mongo.start_session() as session:
+                try:
+                    yield session
+                except BaseException:
+                    self._clear_caches()
+                    raise
+            return
 
-        filter = configuration.filter.encode()
+        if not group:
+            self.commit()
+        if self._transaction is None:
+            self._transaction = self._mongo.start_session()
+            self._transaction.start_transaction()
+        try:
+            yield self._transaction
+        except BaseException:
+            self.abort()
+            self._clear_caches()
+            raise
+        self._commit_group.add()
+        if not group or self._commit_group.is_full():
+            self.commit()
 
-        self.db["_apibara"].insert_one(
-            {
-                "indexer_id": self._indexer_id,
-                "cursor": cursor,
-                "filter": filter,
-            }
+    def _create_storage(
+        self, cursor: Cursor, session: ClientSession, *, undo_log: Optional[bool] = None
+    ) -> "Storage":
+        if undo_log is None:
+            undo_log = self._undo_log
+        if undo_log:
+            self._undo_log_dirty = True
+        return Storage(
+            self.db,
+            session=session,
+            cursor=cursor,
+            buffer_writes=self._buffer_writes,
+            executor=self._executor,
+            registry=self._registry,
+            undo_log=undo_log,
+            caches=self._caches,
+            compactor=self._compactor,
         )
 
-    def update_with_stored_configuration(
-        self,
-        initial: IndexerConfiguration[Filter],
-        *,
-        ignore_filter: Optional[bool] = None,
-    ):
-        logger.debug("update config with stored version")
+    def cache_stats(self) -> Dict[str, CacheStats]:
+        """Returns the document cache statistics, by collection."""
+        return {collection: cache.stats for collection, cache in self._caches.items()}
 
-        stored = self.db["_apibara"].find_one({"indexer_id": self._indexer_id})
-        if stored is None:
-            self._initialize_configuration(initial)
-            return False
+    async def _run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Call `fn`, in the storage executor if any."""
+        if self._executor is None:
+            return fn(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
 
-        if not ignore_filter:
-            logger.debug("loading filter from storage")
-            encoded_filter = stored.get("filter")
-            if encoded_filter is None:
-                raise RuntimeError("indexer filter is missing")
-            initial.filter.parse(encoded_filter)
-        else:
-            logger.debug("using filter from script")
+    def _clear_caches(self):
+        for cache in self._caches.values():
+            cache.clear()
 
-        cursor = stored.get("cursor")
-        if cursor is not None:
-            initial.starting_cursor = cursor_utils.from_json(cursor)
+    def _read_configuration(self) -> Optional[Document]:
+        return self.db["_apibara"].find_one({"indexer_id": self._indexer_id})
 
-        return True
+    def _write_configuration(self, configuration: Document):
+        self.db["_apibara"].insert_one(configuration)
 
     def _update_filter(self, filter: Filter, session: Optional[ClientSession] = None):
         """Set the indexer filter, overriding the previous filter."""
         logger.debug("update stored filter")
+        if session is None:
+            self.commit()
 
         self.db["_apibara"].update_one(
             {"indexer_id": self._indexer_id},
@@ -124,16 +369,22 @@ class IndexerStorage(Generic[Filter]):
         """Invalidates all data generate after `cursor`."""
         logger.debug(f"invalidate data after {cursor}")
         if session is None:
+            self.commit()
             with self._mongo.start_session() as session:
                 self._invalidate(cursor, session)
         else:
             self._invalidate(cursor, session)
 
     def _invalidate(self, cursor: Cursor, session: ClientSession):
-        for collection in self.db.list_collections(session=session):
-            name = collection["name"]
-            if name.startswith("_"):
-                continue
+        if self._undo_log and cursor.order_key >= self._undo_log_horizon:
+            self._rollback_undo_log(cursor, session)
+            # collections written before the indexer started may have changes
+            # that are not in the undo log.
+            collections = self._registry.unknown()
+        else:
+            collections = self._registry.written_after(cursor.order_key)
+
+        for name in collections:
             # remove items inserted after block_number
             self.db[name].delete_many(
                 {"_chain.valid_from": {"$gt": cursor.order_key}}, session=session
@@ -144,10 +395,99 @@ class IndexerStorage(Generic[Filter]):
                 {"$set": {"_chain.valid_to": None}},
                 session=session,
             )
+        self._registry.invalidated(cursor.order_key)
+        for cache in self._caches.values():
+            cache.invalidate(cursor.order_key)
+        # the pending data is always after the invalidated block.
+        if self._pending_mirror:
+            self._mirror_pending(None, session)
+
+    def _rollback_undo_log(self, cursor: Cursor, session: ClientSession):
+        """Revert the changes recorded after `cursor` in the undo log."""
+        after_cursor = {"block": {"$gt": cursor.order_key}}
+        inserted: Dict[str, List[Any]] = {}
+        clamped: Dict[str, List[Any]] = {}
+        for record in self.db[_UNDO_LOG].find(after_cursor, session=session):
+            name = record["collection"]
+            inserted.setdefault(name, []).extend(record["inserted"])
+            clamped.setdefault(name, []).extend(record["clamped"])
+
+        for name, ids in inserted.items():
+            if ids:
+                self.db[name].delete_many({"_id": {"$in": ids}}, session=session)
+        for name, ids in clamped.items():
+            if ids:
+                self.db[name].update_many(
+                    {"_id": {"$in": ids}},
+                    {"$set": {"_chain.valid_to": None}},
+                    session=session,
+                )
+        self.db[_UNDO_LOG].delete_many(after_cursor, session=session)
+
+    def _prune_undo_log(self, cursor: Cursor, session: ClientSession):
+        """Remove undo records of finalized blocks."""
+        if not self._undo_log_dirty:
+            return
+        self.db[_UNDO_LOG].delete_many(
+            {"block": {"$lte": cursor.order_key}}, session=session
+        )
+        self._undo_log_dirty = False
+
+    def _cap_undo_log(self, cursor: Cursor, session: ClientSession):
+        """Remove undo records more than `finality_depth` blocks behind `cursor`."""
+        horizon = cursor.order_key - self._finality_depth
+        if horizon <= self._undo_log_horizon:
+            return
+        self.db[_UNDO_LOG].delete_many({"block": {"$lte": horizon}}, session=session)
+        self._undo_log_horizon = horizon
+
+    def discard_pending(self, cursor: Cursor, session: Optional[ClientSession] = None):
+        """Discard the changes made by pending data received after `cursor`."""
+        if not self._pending_overlay:
+            self.invalidate(cursor, session=session)
+            return
+        # pending data never touches the indexer collections, only the mirror.
+        if session is None:
+            self.commit()
+        self._mirror_pending(None, session)
+
+    def _mirror_pending(
+        self, pending: Optional["PendingStorage"], session: Optional[ClientSession]
+    ):
+        """Replace the pending collections with the documents of `pending`."""
+        collections = [] if pending is None else pending.collections()
+        for collection in set(self._mirrored) | set(collections):
+            self.db[f"_pending_{collection}"].delete_many({}, session=session)
+        for collection in collections:
+            docs = pending.documents(collection)
+            if docs:
+                self.db[f"_pending_{collection}"].insert_many(docs, session=session)
+        self._mirrored = collections
 
     def drop_database(self):
         logger.debug("dropping database %s", self.db_name)
+        self.abort()
         self._mongo.drop_database(self.db_name)
+        self._clear_caches()
+        self._registry = _CollectionRegistry(self.db)
+        # load the (empty) registry now, not in the transaction of the
+        # first invalidation.
+        self._registry.unknown()
+        self._mirrored = []
+        self._undo_log_horizon = -1
+
+    def create_as_of_index(
+        self, collection: str, fields: Optional[List[str]] = None
+    ) -> str:
+        """Create the index used by `as_of` queries on `collection`.
+
+        `fields` are the fields the queries filter by equality, they're the
+        first keys of the compound index, followed by the `_chain` validity
+        range. Returns the name of the index.
+        """
+        keys = [(field, ASCENDING) for field in fields or []]
+        keys += [("_chain.valid_from", ASCENDING), ("_chain.valid_to", ASCENDING)]
+        return self.db[collection].create_index(keys)
 
     def _update_cursor(self, cursor: Cursor, session: Optional[ClientSession] = None):
         self.db["_apibara"].update_one(
@@ -158,21 +498,230 @@ class IndexerStorage(Generic[Filter]):
         )
 
 
+def _with_chain_match(
+    pipeline: List[Document], as_of: Optional[int] = None
+) -> List[Document]:
+    """Returns `pipeline` with a `$match` stage on the `_chain` validity range."""
+    match = {"$match": _chain_filter(as_of)}
+    first_stage = next(iter(pipeline[0]), None) if pipeline else None
+    if first_stage == "$searchMeta":
+        # it returns metadata only, its results can't be filtered.
+        raise ValueError(
+            "$searchMeta is not supported, its results include all versions"
+        )
+    if first_stage in _FIRST_STAGES:
+        return [pipeline[0], match, *pipeline[1:]]
+    return [match, *pipeline]
+
+
+class _CommitGroup:
+    """Decide when to commit a transaction that spans many storage contexts."""
+
+    def __init__(self, max_size: int, max_interval: Optional[float]) -> None:
+        self._max_size = max_size
+        self._max_interval = max_interval
+        self._size = 0
+        self._started_at: Optional[float] = None
+
+    def add(self):
+        if self._size == 0:
+            self._started_at = time.monotonic()
+        self._size += 1
+
+    def is_full(self) -> bool:
+        if self._size >= self._max_size:
+            return True
+        if self._max_interval is None or self._started_at is None:
+            return False
+        return time.monotonic() - self._started_at >= self._max_interval
+
+    def reset(self):
+        self._size = 0
+        self._started_at = None
+
+
+class _Compactor:
+    """Delete versions of documents that are no longer needed.
+
+    Versions that were replaced or deleted before the finalized block can't be
+    restored by an invalidation. They're deleted in batches in a background
+    thread, each run only visits the versions superseded since the previous run
+    thanks to the index on `_chain.valid_to`.
+    """
+
+    def __init__(self, db: Database, retention: int, batch_size: int = 1000) -> None:
+        self._db = db
+        self._retention = retention
+        self._batch_size = batch_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="apibara-compaction"
+        )
+        self._future: Optional[Future] = None
+        self._scheduled: Optional[Tuple[int, List[str]]] = None
+        self._finalized = -1
+        # versions replaced up to this block may have been deleted.
+        self.horizon = -1
+        self._lock = threading.Lock()
+
+    def finalized(self, order_key: int, collections: List[str]):
+        """Schedule compaction of data finalized at block `order_key`."""
+        with self._lock:
+            if order_key <= self._finalized:
+                return
+            self._finalized = order_key
+            self.horizon = order_key - self._retention
+            self._scheduled = (self.horizon, collections)
+            # a running compaction picks up the new threshold when done.
+            if self._future is None:
+                self._future = self._executor.submit(self._run)
+
+    def wait(self):
+        """Wait for the scheduled compaction to complete."""
+        with self._lock:
+            future = self._future
+        if future is not None:
+            future.result()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._scheduled is None:
+                    self._future = None
+                    return
+                threshold, collections = self._scheduled
+                self._scheduled = None
+            try:
+                for name in collections:
+                    self._compact(name, threshold)
+            except Exception:
+                # versions not deleted now are deleted by the next run.
+                logger.exception("history compaction failed")
+
+    def _compact(self, collection: str, threshold: int):
+        superseded = {"_chain.valid_to": {"$lte": threshold}}
+        while True:
+            docs = self._db[collection].find(
+                superseded, {"_id": 1}, limit=self._batch_size
+            )
+            ids = [doc["_id"] for doc in docs]
+            if not ids:
+                return
+            logger.debug(f"compaction: delete {len(ids)} versions from {collection}")
+            self._db[collection].delete_many({"_id": {"$in": ids}})
+
+
+class _CollectionRegistry:
+    """Track the last block written to each user collection.
+
+    Invalidation only needs to visit collections written after the
+    invalidated block. Collections that exist when the indexer starts are
+    visited by the first invalidation, since their last write is unknown.
+    Collections are indexed on the `_chain` validity range the first time
+    they're seen.
+    """
+
+    def __init__(self, db: Database) -> None:
+        self._db = db
+        # None means the collection was written at an unknown block.
+        self._last_write: Dict[str, Optional[int]] = {}
+        self._loaded = False
+
+    def __contains__(self, collection: str) -> bool:
+        return collection in self._last_write
+
+    def touch(self, collection: str, order_key: int):
+        """Record a write to `collection` at block `order_key`."""
+        if collection not in self._last_write:
+            self._create_indexes(collection)
+            self._last_write[collection] = order_key
+            return
+        last_write = self._last_write[collection]
+        if last_write is not None and last_write < order_key:
+            self._last_write[collection] = order_key
+
+    def written_after(self, order_key: int) -> List[str]:
+        """Returns the collections that may contain writes after `order_key`."""
+        if not self._loaded:
+            self._load()
+        return [
+            name
+            for name, last_write in self._last_write.items()
+            if last_write is None or last_write > order_key
+        ]
+
+    def collections(self) -> List[str]:
+        """Returns all user collections."""
+        if not self._loaded:
+            self._load()
+        return list(self._last_write)
+
+    def unknown(self) -> List[str]:
+        """Returns the collections written at an unknown block."""
+        if not self._loaded:
+            self._load()
+        return [
+            name for name, last_write in self._last_write.items() if last_write is None
+        ]
+
+    def invalidated(self, order_key: int):
+        """Record that all writes after `order_key` have been invalidated."""
+        for name, last_write in self._last_write.items():
+            if last_write is None or last_write > order_key:
+                self._last_write[name] = order_key
+
+    def _load(self):
+        # never in a session: listCollections is not allowed in transactions.
+        for collection in self._db.list_collections():
+            name = collection["name"]
+            if name.startswith("_") or name in self._last_write:
+                continue
+            self._create_indexes(name)
+            self._last_write[name] = None
+        self._loaded = True
+
+    def _create_indexes(self, collection: str):
+        if collection.startswith("_"):
+            return
+        self._db[collection].create_index("_chain.valid_from")
+        self._db[collection].create_index("_chain.valid_to")
+
+
 class ReadOnlyStorage:
-    """Chain-aware document storage, read methods."""
+    """Chain-aware document storage, read methods.
+
+    If `executor` is set, database calls run in the executor instead of
+    blocking the event loop. If `compactor` is set, `as_of` queries before
+    its horizon raise `ValueError`, since the versions they need may have
+    been deleted.
+    """
 
     def __init__(
-        self, db: Database, *, session: Optional[ClientSession] = None
+        self,
+        db: Database,
+        *,
+        session: Optional[ClientSession] = None,
+        executor: Optional[Executor] = None,
+        compactor: Optional[_Compactor] = None,
     ) -> None:
         self._db = db
         self._session = session
+        self._executor = executor
+        self._compactor = compactor
 
     async def find_one(
-        self, collection: str, filter: DocumentFilter
+        self, collection: str, filter: DocumentFilter, *, as_of: Optional[int] = None
     ) -> Optional[Document]:
-        """Find the first document in `collection` matching `filter`."""
-        self._add_current_block_to_filter(filter)
-        return self._db[collection].find_one(filter, session=self._session)
+        """Find the first document in `collection` matching `filter`.
+
+        If `as_of` is set, the document is searched in the documents as
+        they were at block `as_of`.
+        """
+        self._check_as_of(as_of)
+        await self._before_read(collection)
+        filter.update(_chain_filter(as_of))
+        return await self._run(
+            self._db[collection].find_one, filter, session=self._session
+        )
 
     async def find(
         self,
@@ -182,7 +731,10 @@ class ReadOnlyStorage:
         projection: Optional[Projection] = None,
         skip: int = 0,
         limit: int = 0,
-    ) -> Iterable[dict]:
+        *,
+        as_of: Optional[int] = None,
+        batch_size: Optional[int] = None,
+    ) -> DocumentCursor:
         """Find all documents in `collection` matching `filter`.
 
         Arguments
@@ -192,57 +744,270 @@ class ReadOnlyStorage:
         - `sort`: keys used for sorting, e.g. `{"a": -1}` sorts documents by key `a` in descending order,
         - `project`: filter document keys to reduce the document size,
         - `skip`: number of documents to skip,
-        - `limit`: maximum number of documents returned.
+        - `limit`: maximum number of documents returned,
+        - `as_of`: if set, return the documents as they were at this block,
+        - `batch_size`: number of documents fetched at a time.
+
+        Iterate the returned cursor with `async for` to fetch documents in
+        batches, in the storage executor if any. `as_of` queries before the
+        history deleted by `retention` raise `ValueError`.
+
+        Covered (index-only) queries are not supported: the filter on the
+        current documents is an equality on `_chain.valid_to` being null,
+        which MongoDB checks by fetching the documents even when all the
+        filtered and projected fields are in one index.
         """
-        self._add_current_block_to_filter(filter)
+        self._check_as_of(as_of)
+        await self._before_read(collection)
+        filter.update(_chain_filter(as_of))
         cursor = self._db[collection].find(
             filter, projection, skip, limit, session=self._session
         )
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
         if sort is not None:
             for field, order in sort.items():
                 cursor = cursor.sort(field, order)
-        return cursor
+        return DocumentCursor(cursor, batch_size=batch_size, run=self._run)
+
+    async def aggregate(
+        self,
+        collection: str,
+        pipeline: List[Document],
+        *,
+        as_of: Optional[int] = None,
+        allow_disk_use: bool = False,
+        batch_size: Optional[int] = None,
+    ) -> DocumentCursor:
+        """Run the aggregation `pipeline` on the current documents of `collection`.
+
+        Arguments
+        ---------
+        - `collection`: the collection,
+        - `pipeline`: the aggregation pipeline,
+        - `as_of`: if set, run the pipeline on the documents as they were at this block,
+        - `allow_disk_use`: let stages that need a lot of memory write temporary files,
+        - `batch_size`: number of results fetched at a time.
+
+        A `$match` stage that selects the current (or `as_of`) documents is
+        added at the start of the pipeline, the following stages only see
+        those documents. `$geoNear`, `$search` and `$vectorSearch` must be
+        the first stage, the `$match` stage is added after them: their limits
+        and scores include the versions that are not current. `$searchMeta`
+        is not supported. The results are returned as a `DocumentCursor`,
+        iterate it with `async for` to stream them.
+        """
+        self._check_as_of(as_of)
+        await self._before_read(collection)
+        pipeline = _with_chain_match(pipeline, as_of)
+        kwargs: Dict[str, Any] = {"allowDiskUse": allow_disk_use}
+        if batch_size is not None:
+            kwargs["batchSize"] = batch_size
+        cursor = await self._run(
+            self._db[collection].aggregate, pipeline, session=self._session, **kwargs
+        )
+        return DocumentCursor(cursor, batch_size=batch_size, run=self._run)
 
     def _add_current_block_to_filter(self, filter: DocumentFilter):
-        filter["_chain.valid_to"] = None
+        filter.update(_chain_filter())
+
+    def _check_as_of(self, as_of: Optional[int]):
+        if as_of is None or self._compactor is None:
+            return
+        if as_of < self._compactor.horizon:
+            raise ValueError(
+                f"history before block {self._compactor.horizon} was deleted "
+                f"by compaction, can't query block {as_of}"
+            )
+
+    async def _before_read(self, collection: str):
+        pass
+
+    async def _run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Call `fn`, in the storage executor if any."""
+        if self._executor is None:
+            return fn(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+
+class Storage(ReadOnlyStorage, BaseStorage):
+    """Chain-aware document storage.
+
+    When `buffer_writes` is set, writes are queued and sent with one ordered
+    `bulk_write` per collection by `flush`. Reads from a collection flush its
+    queued writes first, so they always see the writes of the current block.
+    Documents passed to the write methods must not be modified until they
+    are flushed.
 
+    When `undo_log` is set, the ids of the documents inserted and deleted at
+    each block are recorded and written to the undo log when the storage is
+    flushed.
 
-class Storage(ReadOnlyStorage):
-    """Chain-aware document storage."""
+    `caches` contains the document caches of the cached collections, they're
+    used by `find_one` and by the methods that update one document. Documents
+    loaded by `prefetch` are cached in the same way.
+    """
 
     def __init__(
-        self, db: Database, cursor: Cursor, *, session: Optional[ClientSession] = None
+        self,
+        db: Database,
+        cursor: Cursor,
+        *,
+        session: Optional[ClientSession] = None,
+        buffer_writes: bool = False,
+        executor: Optional[Executor] = None,
+        registry: Optional[_CollectionRegistry] = None,
+        undo_log: bool = False,
+        caches: Optional[Dict[str, DocumentCache]] = None,
+        compactor: Optional[_Compactor] = None,
     ) -> None:
-        super().__init__(db, session=session)
+        super().__init__(db, session=session, executor=executor, compactor=compactor)
         self._cursor = cursor
+        self._registry = registry
+        # prefetch adds caches that live as long as the storage.
+        self._caches = dict(caches or {})
+        self._buffer_writes = buffer_writes
+        self._queued: Dict[str, List[Any]] = {}
+        # undo records, by block and collection.
+        self._undo: Optional[Dict[Tuple[int, str], Document]] = None
+        if undo_log:
+            self._undo = {}
+
+    async def find_one(
+        self, collection: str, filter: DocumentFilter, *, as_of: Optional[int] = None
+    ) -> Optional[Document]:
+        """Find the first document in `collection` matching `filter`.
+
+        If `as_of` is set, the document is searched in the documents as
+        they were at block `as_of`.
+        """
+        cache, key = self._cache_key(collection, filter)
+        if cache is None or as_of is not None:
+            return await super().find_one(collection, filter, as_of=as_of)
+        hit, doc = cache.get(key)
+        if hit:
+            return doc
+        doc = await super().find_one(collection, filter)
+        self._cache_put(cache, key, doc)
+        return doc
+
+    async def prefetch(self, collection: str, key_field: str, values: Iterable[Any]):
+        """Fetch the current documents of `collection` with `key_field` in `values`.
+
+        The documents are fetched with one query. Following calls to `find_one`
+        that filter by `key_field` only are served without querying the
+        database, until the storage context exits. Documents are kept up to
+        date by the write methods.
+
+        Arguments
+        ---------
+        - `collection`: the collection,
+        - `key_field`: the document field used as key, it must be the same
+          for all calls with the same collection,
+        - `values`: the keys of the documents to fetch.
+        """
+        cache = self._caches.get(collection)
+        if cache is None:
+            cache = DocumentCache(key_field, max_size=sys.maxsize)
+            self._caches[collection] = cache
+        elif cache.key != key_field:
+            raise ValueError(
+                f"documents of {collection} are cached by {cache.key}, not {key_field}"
+            )
+
+        missing = {value for value in values if value not in cache}
+        if not missing:
+            return
+        docs = await self.find(collection, {key_field: {"$in": list(missing)}})
+        for doc in docs:
+            self._cache_put(cache, doc[key_field], doc)
+            missing.discard(doc[key_field])
+        for value in missing:
+            self._cache_put(cache, value, None)
 
     async def insert_one(self, collection: str, doc: Document):
         """Insert `doc` into `collection`."""
+        await self._touch(collection)
         self._add_chain_information(doc)
-        self._db[collection].insert_one(doc, session=self._session)
+        if self._undo is not None:
+            doc.setdefault("_id", ObjectId())
+            self._undo_record(collection)["inserted"].append(doc["_id"])
+        if self._buffer_writes:
+            doc.setdefault("_id", ObjectId())
+            self._queue(collection, InsertOne(doc))
+        else:
+            await self._run(self._db[collection].insert_one, doc, session=self._session)
+        self._cache_insert(collection, doc)
 
     async def insert_many(self, collection: str, docs: Iterable[Document]):
         """Insert multiple `docs` into `collection`."""
+        await self._touch(collection)
         for doc in docs:
             self._add_chain_information(doc)
-        self._db[collection].insert_many(docs, session=self._session)
+        if self._undo is not None:
+            record = self._undo_record(collection)
+            for doc in docs:
+                doc.setdefault("_id", ObjectId())
+                record["inserted"].append(doc["_id"])
+        if self._buffer_writes:
+            for doc in docs:
+                doc.setdefault("_id", ObjectId())
+                self._queue(collection, InsertOne(doc))
+        else:
+            await self._run(
+                self._db[collection].insert_many, docs, session=self._session
+            )
+        for doc in docs:
+            self._cache_insert(collection, doc)
 
     async def delete_one(self, collection: str, filter: DocumentFilter):
         """ "Delete the first document in `collection` matching `filter`."""
+        if self._undo is not None or collection in self._caches:
+            # the undo log and cache need the deleted document.
+            existing, _ = await self._clamp_one(collection, filter, coalesce=False)
+            if existing is not None:
+                self._cache_delete(collection, existing)
+            return
+        await self._touch(collection)
         self._add_current_block_to_filter(filter)
-        self._db[collection].update_one(
-            filter,
-            {"$set": {"_chain.valid_to": self._cursor.order_key}},
-            session=self._session,
+        update = {"$set": {"_chain.valid_to": self._cursor.order_key}}
+        if self._buffer_writes:
+            self._queue(collection, UpdateOne(filter, update))
+            return
+        await self._run(
+            self._db[collection].update_one, filter, update, session=self._session
         )
 
     async def delete_many(self, collection: str, filter: DocumentFilter):
         """Delete all documents in `collection` matching `filter`."""
+        await self._touch(collection)
+        cache, key = self._cache_key(collection, filter)
+        if cache is not None:
+            self._cache_put(cache, key, None)
+        elif collection in self._caches:
+            # the deleted documents are not known.
+            self._caches[collection].clear()
         self._add_current_block_to_filter(filter)
-        self._db[collection].update_many(
-            filter,
-            {"$set": {"_chain.valid_to": self._cursor.order_key}},
-            session=self._session,
+        update = {"$set": {"_chain.valid_to": self._cursor.order_key}}
+        if self._undo is not None:
+            # the undo log needs the ids of the deleted documents.
+            await self._flush_collection(collection)
+            docs = await self._run(
+                lambda: list(
+                    self._db[collection].find(filter, {"_id": 1}, session=self._session)
+                )
+            )
+            ids = [doc["_id"] for doc in docs]
+            self._undo_record(collection)["clamped"].extend(ids)
+            filter = {"_id": {"$in": ids}}
+        if self._buffer_writes:
+            self._queue(collection, UpdateMany(filter, update))
+            return
+        await self._run(
+            self._db[collection].update_many, filter, update, session=self._session
         )
 
     async def find_one_and_replace(
@@ -256,12 +1021,21 @@ class Storage(ReadOnlyStorage):
         If `upsert = True`, insert `replacement` even if no document matched the `filter`.
         """
         # Step 1. Update the old document (if any) by clamping its validity range
-        self._add_current_block_to_filter(filter)
-        existing = self._db[collection].find_one_and_update(
-            filter,
-            {"$set": {"_chain.valid_to": self._cursor.order_key}},
-            session=self._session,
-        )
+        existing, clamped = await self._clamp_one(collection, filter)
+
+        if existing is not None and not clamped:
+            # the document was written at this block, replace it in place.
+            self._add_chain_information(replacement)
+            replacement["_id"] = existing["_id"]
+            await self._write_by_id(
+                collection, ReplaceOne, replacement["_id"], replacement
+            )
+            self._cache_delete(collection, existing)
+            self._cache_insert(collection, replacement)
+            return existing
+
+        if existing is not None:
+            self._cache_delete(collection, existing)
 
         # Step 2. Insert the new document.
         # Insert only if the existing document exists or if upsert.
@@ -275,21 +1049,360 @@ class Storage(ReadOnlyStorage):
     ):
         """Update the first document in `collection` matching `filter` with `update`."""
         # Step 1. Update the old document (if any) by clamping its validity range
-        self._add_current_block_to_filter(filter)
-        existing = self._db[collection].find_one_and_update(
-            filter,
-            {"$set": {"_chain.valid_to": self._cursor.order_key}},
-            session=self._session,
-        )
+        existing, clamped = await self._clamp_one(collection, filter)
+        if existing is None:
+            return None
 
-        # Step 2. To simulate an update, first insert then call update on it.
-        if existing is not None:
-            del existing["_id"]
-            del existing["_chain"]
-            await self.insert_one(collection, existing)
-            self._db[collection].update_one(filter, update, session=self._session)
+        if not clamped:
+            # the document was written at this block, update it in place
+            # instead of creating a new version.
+            await self._write_by_id(collection, UpdateOne, existing["_id"], update)
+            self._cache_delete(collection, existing)
+            updated = _apply_update(existing, update)
+            if updated is not None:
+                self._cache_insert(collection, updated)
+            return existing
 
+        self._cache_delete(collection, existing)
+
+        # Step 2. Insert the new version, with the update applied if possible.
+        del existing["_id"]
+        del existing["_chain"]
+        updated = _apply_update(existing, update)
+        if updated is not None:
+            await self.insert_one(collection, updated)
+            existing["_id"] = updated["_id"]
+            existing["_chain"] = updated["_chain"]
+            return existing
+
+        # To simulate an update, first insert then call update on it.
+        await self.insert_one(collection, existing)
+        await self._write_by_id(collection, UpdateOne, existing["_id"], update)
+        # the new version is only known by the database.
+        self._cache_delete(collection, existing, evict=True)
         return existing
 
+    async def flush(self):
+        """Send the queued writes to the database.
+
+        Writes are flushed when the storage context exits, call this method
+        to flush them without blocking the event loop.
+        """
+        records = self._take_undo_records()
+        if records:
+            await self._run(
+                self._db[_UNDO_LOG].insert_many, records, session=self._session
+            )
+        for collection in list(self._queued):
+            await self._flush_collection(collection)
+
+    async def _clamp_one(
+        self, collection: str, filter: DocumentFilter, *, coalesce: bool = True
+    ) -> Tuple[Optional[Document], bool]:
+        """Set the end of the validity range of the first document matching `filter`.
+
+        Returns the document before the update and whether it was clamped.
+        If `coalesce` is set, documents written at the current block are
+        returned without clamping them, so that the caller updates them in
+        place.
+        """
+        await self._touch(collection)
+        cache, key = self._cache_key(collection, filter)
+        self._add_current_block_to_filter(filter)
+        block = self._cursor.order_key
+        update = {"$set": {"_chain.valid_to": block}}
+        hit = False
+        if cache is not None:
+            hit, existing = cache.get(key)
+
+        if hit:
+            if existing is None:
+                return None, False
+            if coalesce and existing["_chain"]["valid_from"] == block:
+                return existing, False
+            await self._write_by_id(collection, UpdateOne, existing["_id"], update)
+        elif not self._buffer_writes:
+            clamp_filter = filter
+            if coalesce:
+                clamp_filter = {**filter, "_chain.valid_from": {"$lt": block}}
+            existing = await self._run(
+                self._db[collection].find_one_and_update,
+                clamp_filter,
+                update,
+                session=self._session,
+            )
+            if existing is None and coalesce:
+                current = await self._run(
+                    self._db[collection].find_one,
+                    {**filter, "_chain.valid_from": block},
+                    session=self._session,
+                )
+                return current, False
+        else:
+            await self._flush_collection(collection)
+            existing = await self._run(
+                self._db[collection].find_one, filter, session=self._session
+            )
+            if existing is None:
+                return None, False
+            if coalesce and existing["_chain"]["valid_from"] == block:
+                return existing, False
+            self._queue(collection, UpdateOne({"_id": existing["_id"]}, update))
+
+        if existing is None:
+            return None, False
+        if self._undo is not None:
+            self._undo_record(collection)["clamped"].append(existing["_id"])
+        return existing, True
+
+    async def _write_by_id(
+        self, collection: str, operation: Callable, id: Any, update: Document
+    ):
+        """Update or replace the document with the given `_id`."""
+        if self._buffer_writes:
+            self._queue(collection, operation({"_id": id}, update))
+            return
+        method = self._db[collection].update_one
+        if operation is ReplaceOne:
+            method = self._db[collection].replace_one
+        await self._run(method, {"_id": id}, update, session=self._session)
+
+    def _cache_key(
+        self, collection: str, filter: DocumentFilter
+    ) -> Tuple[Optional[DocumentCache], Any]:
+        """Returns the collection cache and key, if `filter` is by primary key."""
+        cache = self._caches.get(collection)
+        if cache is None:
+            return None, NO_KEY
+        key = cache.key_of(filter)
+        if key is NO_KEY:
+            return None, NO_KEY
+        return cache, key
+
+    def _cache_put(self, cache: DocumentCache, key: Any, doc: Optional[Document]):
+        if doc is None:
+            cache.put(key, None, self._cursor.order_key)
+        else:
+            cache.put(key, doc, doc["_chain"]["valid_from"])
+
+    def _cache_insert(self, collection: str, doc: Document):
+        cache = self._caches.get(collection)
+        if cache is not None and cache.key in doc:
+            self._cache_put(cache, doc[cache.key], doc)
+
+    def _cache_delete(self, collection: str, doc: Document, *, evict: bool = False):
+        """Record that `doc` is no longer the current version of its key.
+
+        If `evict` is set, the key is removed from the cache instead.
+        """
+        cache = self._caches.get(collection)
+        if cache is None or cache.key not in doc:
+            return
+        if evict:
+            cache.evict(doc[cache.key])
+        else:
+            self._cache_put(cache, doc[cache.key], None)
+
+    async def _touch(self, collection: str):
+        if self._registry is None:
+            return
+        if collection in self._registry:
+            self._registry.touch(collection, self._cursor.order_key)
+        else:
+            # the first write to a collection creates its indexes.
+            await self._run(self._registry.touch, collection, self._cursor.order_key)
+
     def _add_chain_information(self, doc: Document):
         doc["_chain"] = {"valid_from": self._cursor.order_key, "valid_to": None}
+
+    async def _before_read(self, collection: str):
+        await self._flush_collection(collection)
+
+    def _undo_record(self, collection: str) -> Document:
+        key = (self._cursor.order_key, collection)
+        record = self._undo.get(key)
+        if record is None:
+            record = {
+                "block": self._cursor.order_key,
+                "collection": collection,
+                "inserted": [],
+                "clamped": [],
+            }
+            self._undo[key] = record
+        return record
+
+    def _take_undo_records(self) -> List[Document]:
+        if not self._undo:
+            return []
+        records = list(self._undo.values())
+        self._undo = {}
+        return records
+
+    def _queue(self, collection: str, operation: Any):
+        self._queued.setdefault(collection, []).append(operation)
+
+    async def _flush_collection(self, collection: str):
+        operations = self._queued.pop(collection, None)
+        if operations:
+            await self._run(
+                self._db[collection].bulk_write,
+                operations,
+                ordered=True,
+                session=self._session,
+            )
+
+    def _flush(self):
+        """Send all queued writes to the database, blocking."""
+        records = self._take_undo_records()
+        if records:
+            self._db[_UNDO_LOG].insert_many(records, session=self._session)
+        for collection, operations in self._queued.items():
+            self._db[collection].bulk_write(
+                operations, ordered=True, session=self._session
+            )
+        self._queued = {}
+
+
+class PendingStorage(InMemoryStorage):
+    """Chain-aware document storage for pending data.
+
+    Changes are kept in memory, in an overlay over the documents stored in
+    the database. Reads return the documents of the overlay and the stored
+    documents not changed by it. Stored documents are copied to the overlay
+    before they're changed, so the database is never modified and the
+    changes are discarded with the storage.
+
+    The overlay supports the same filters and updates as
+    `InMemoryIndexerStorage`. `base` reads the stored documents, it can be
+    any storage backend. Aggregation pipelines are not supported, since they
+    can't run on the merged overlay and stored documents.
+    """
+
+    def __init__(
+        self, base: Union[ReadOnlyStorage, BaseStorage], cursor: Cursor
+    ) -> None:
+        super().__init__(InMemoryDatabase({}), cursor)
+        self._base = base
+        self._session = base._session
+        # ids of the stored documents copied to the overlay.
+        self._shadowed: Dict[str, Set[Any]] = defaultdict(set)
+
+    async def find_one(
+        self, collection: str, filter: DocumentFilter, *, as_of: Optional[int] = None
+    ) -> Optional[Document]:
+        """Find the first document in `collection` matching `filter`.
+
+        If `as_of` is set, the document is searched in the documents as
+        they were at block `as_of`.
+        """
+        doc = await super().find_one(collection, filter, as_of=as_of)
+        if doc is not None:
+            return doc
+        return await self._base.find_one(
+            collection, self._base_filter(collection, filter), as_of=as_of
+        )
+
+    async def find(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        sort: Optional[Dict[str, int]] = None,
+        projection: Optional[Projection] = None,
+        skip: int = 0,
+        limit: int = 0,
+        *,
+        as_of: Optional[int] = None,
+        batch_size: Optional[int] = None,
+    ) -> DocumentCursor:
+        """Find all documents in `collection` matching `filter`.
+
+        Arguments
+        ---------
+        - `collection`: the collection,
+        - `filter`: the filter,
+        - `sort`: keys used for sorting, e.g. `{"a": -1}` sorts documents by key `a` in descending order,
+        - `project`: filter document keys to reduce the document size,
+        - `skip`: number of documents to skip,
+        - `limit`: maximum number of documents returned,
+        - `as_of`: if set, return the documents as they were at this block,
+        - `batch_size`: number of documents fetched at a time.
+
+        Documents of the overlay and stored documents are merged, so all
+        stored documents are fetched before the cursor is returned.
+        """
+        docs = self._current(collection, filter, as_of=as_of)
+        base_limit = skip + limit if limit > 0 else 0
+        stored = await self._base.find(
+            collection,
+            self._base_filter(collection, filter),
+            sort=sort,
+            limit=base_limit,
+            as_of=as_of,
+            batch_size=batch_size,
+        )
+        docs += await stored.to_list()
+        return DocumentCursor(
+            iter(_select(docs, sort, projection, skip, limit)), batch_size=batch_size
+        )
+
+    async def aggregate(
+        self,
+        collection: str,
+        pipeline: List[Document],
+        *,
+        as_of: Optional[int] = None,
+        allow_disk_use: bool = False,
+        batch_size: Optional[int] = None,
+    ) -> DocumentCursor:
+        """Not supported, raises `NotImplementedError`."""
+        raise NotImplementedError(
+            "aggregate is not supported on pending data with pending_overlay"
+        )
+
+    def collections(self) -> List[str]:
+        """Returns the collections changed by the overlay."""
+        return [name for name, c in self._db.collections.items() if len(c) > 0]
+
+    def documents(self, collection: str) -> List[Document]:
+        """Returns copies of the documents in the overlay.
+
+        Stored documents changed by the overlay are included, with
+        `_chain.valid_to` set to the pending block.
+        """
+        return [copy.deepcopy(doc) for doc in self._db[collection].docs.values()]
+
+    async def _find_current(
+        self, collection: str, filter: DocumentFilter
+    ) -> Optional[Document]:
+        doc = await super()._find_current(collection, filter)
+        if doc is not None:
+            return doc
+        stored = await self._base.find_one(
+            collection, self._base_filter(collection, filter)
+        )
+        if stored is None:
+            return None
+        return self._shadow(collection, stored)
+
+    async def _find_all_current(
+        self, collection: str, filter: DocumentFilter
+    ) -> List[Document]:
+        stored = await self._base.find(
+            collection, self._base_filter(collection, filter)
+        )
+        for doc in await stored.to_list():
+            self._shadow(collection, doc)
+        return await super()._find_all_current(collection, filter)
+
+    def _shadow(self, collection: str, doc: Document) -> Document:
+        """Copy a stored document to the overlay."""
+        self._shadowed[collection].add(doc["_id"])
+        self._db[collection].insert(doc)
+        return doc
+
+    def _base_filter(self, collection: str, filter: DocumentFilter) -> DocumentFilter:
+        """Returns the filter of stored documents not copied to the overlay."""
+        shadowed = self._shadowed.get(collection)
+        if not shadowed:
+            return dict(filter)
+        return {"$and": [filter, {"_id": {"$nin": list(shadowed)}}]}
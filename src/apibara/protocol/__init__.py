@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from typing import ClassVar
 
+from .archive import ArchiveReader, ArchiveWriter
+from .cache import BlockCache
 from .client import (
     BearerTokenAuth,
     StreamClient,
@@ -14,6 +16,7 @@ from .proto.stream_pb2 import (
     StreamDataRequest,
     StreamDataResponse,
 )
+from .server import LocalStreamServer
 
 
 @dataclass
@@ -0,0 +1,215 @@
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+
+from apibara.protocol.proto.stream_pb2 import Data
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+_INDEX_FILE = "index.bin"
+# order key, segment number, offset of the payload, payload length
+_INDEX_RECORD = struct.Struct("<QIQI")
+_LENGTH_PREFIX = struct.Struct("<I")
+
+
+def _segment_path(path: Path, segment: int) -> Path:
+    return path / f"segment-{segment:06d}.bin"
+
+
+class ArchiveWriter:
+    """Append raw stream data to an archive on disk.
+
+    An archive is a directory with segment files containing length-prefixed
+    payloads, and an index file with the order key (block number) and position
+    of each payload. Payloads must be appended in increasing order key.
+
+    Opening an existing archive appends to it.
+
+    Parameters
+    ----------
+    path:
+        the archive directory, created if it doesn't exist.
+    segment_size:
+        start a new segment file after the current one reaches this size.
+    """
+
+    def __init__(
+        self, path: Union[str, Path], *, segment_size: int = DEFAULT_SEGMENT_SIZE
+    ) -> None:
+        self._path = Path(path)
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._segment_size = segment_size
+
+        self._index = open(self._path / _INDEX_FILE, "a+b")
+        self._segment = 0
+        self._segment_file = None
+        self._offset = 0
+        self.last_order_key: Optional[int] = None
+        self._recover()
+
+    def _recover(self):
+        """Restore the writer position, discarding incomplete writes."""
+        size = self._index.seek(0, os.SEEK_END)
+        size -= size % _INDEX_RECORD.size
+
+        # the index may reach the disk before the segment it points to, drop
+        # the records of payloads that are not entirely on disk.
+        while size > 0:
+            self._index.seek(size - _INDEX_RECORD.size)
+            order_key, segment, offset, length = _INDEX_RECORD.unpack(
+                self._index.read(_INDEX_RECORD.size)
+            )
+            segment_path = _segment_path(self._path, segment)
+            segment_size = segment_path.stat().st_size if segment_path.exists() else 0
+            if offset + length <= segment_size:
+                self.last_order_key = order_key
+                self._segment = segment
+                self._offset = offset + length
+                break
+            size -= _INDEX_RECORD.size
+        self._index.truncate(size)
+
+        self._segment_file = open(_segment_path(self._path, self._segment), "a+b")
+        self._segment_file.truncate(self._offset)
+
+    def append(self, order_key: int, payload: bytes):
+        """Append `payload` with the given `order_key`."""
+        if self.last_order_key is not None and order_key <= self.last_order_key:
+            raise ValueError(
+                f"order key {order_key} must be greater than {self.last_order_key}"
+            )
+
+        if self._offset > 0 and self._offset >= self._segment_size:
+            self._segment_file.close()
+            self._segment += 1
+            self._offset = 0
+            self._segment_file = open(_segment_path(self._path, self._segment), "a+b")
+
+        self._segment_file.write(_LENGTH_PREFIX.pack(len(payload)))
+        self._segment_file.write(payload)
+        offset = self._offset + _LENGTH_PREFIX.size
+        self._index.write(
+            _INDEX_RECORD.pack(order_key, self._segment, offset, len(payload))
+        )
+        self._offset = offset + len(payload)
+        self.last_order_key = order_key
+
+    def append_data(
+        self, data: Data, order_key: Optional[Callable[[bytes], int]] = None
+    ):
+        """Append all items in `data`.
+
+        If the data contains more than one item, `order_key` is used to
+        compute the order key of each item.
+        """
+        if len(data.data) == 1 and order_key is None:
+            self.append(data.end_cursor.order_key, data.data[0])
+            return
+
+        if order_key is None:
+            raise ValueError("order_key is required to append batches of data")
+
+        for item in data.data:
+            self.append(order_key(item), item)
+
+    def flush(self):
+        """Write buffered data to disk. Segments are flushed before the index."""
+        self._segment_file.flush()
+        self._index.flush()
+
+    def close(self):
+        self.flush()
+        self._segment_file.close()
+        self._index.close()
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArchiveReader:
+    """Read data from an archive created by `ArchiveWriter`.
+
+    Segments are memory-mapped and payloads are returned as `memoryview`s
+    into them, so reading a range doesn't touch the other payloads.
+    Payloads are valid until the reader is closed.
+
+    Parameters
+    ----------
+    path:
+        the archive directory.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self._path = Path(path)
+        with open(self._path / _INDEX_FILE, "rb") as f:
+            self._index = f.read()
+        self._len = len(self._index) // _INDEX_RECORD.size
+        self._segments: List[Optional[mmap.mmap]] = []
+
+    def __len__(self) -> int:
+        return self._len
+
+    @property
+    def first_order_key(self) -> Optional[int]:
+        if self._len == 0:
+            return None
+        return self._record(0)[0]
+
+    @property
+    def last_order_key(self) -> Optional[int]:
+        if self._len == 0:
+            return None
+        return self._record(self._len - 1)[0]
+
+    def read(
+        self, start: Optional[int] = None, end: Optional[int] = None
+    ) -> Iterator[Tuple[int, memoryview]]:
+        """Iterate over the payloads with order key in `[start, end)`."""
+        i = 0 if start is None else self._bisect(start)
+        while i < self._len:
+            order_key, segment, offset, length = self._record(i)
+            if end is not None and order_key >= end:
+                return
+            yield order_key, self._segment(segment)[offset : offset + length]
+            i += 1
+
+    def close(self):
+        for segment in self._segments:
+            if segment is not None:
+                segment.close()
+        self._segments = []
+
+    def __enter__(self) -> "ArchiveReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _record(self, i: int) -> Tuple[int, int, int, int]:
+        return _INDEX_RECORD.unpack_from(self._index, i * _INDEX_RECORD.size)
+
+    def _bisect(self, order_key: int) -> int:
+        """Returns the position of the first record with key >= `order_key`."""
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < order_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _segment(self, segment: int) -> memoryview:
+        while len(self._segments) <= segment:
+            self._segments.append(None)
+        mapped = self._segments[segment]
+        if mapped is None:
+            with open(_segment_path(self._path, segment), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._segments[segment] = mapped
+        return memoryview(mapped)
@@ -0,0 +1,164 @@
+import hashlib
+from pathlib import Path
+from typing import Iterator, Optional, Tuple, Union
+
+from apibara.protocol.archive import ArchiveReader, ArchiveWriter
+from apibara.protocol.client import StreamClient, StreamIter
+from apibara.protocol.proto.stream_pb2 import (
+    Cursor,
+    Data,
+    DataFinality,
+    StreamDataResponse,
+)
+
+
+class BlockCache:
+    """On-disk cache of finalized data.
+
+    Finalized data received from the server is stored in an archive for
+    each filter and batch size, so that cached data is always replayed in
+    batches of the size requested by the stream. When a stream is configured with a cursor that is in the
+    cache, data is served from the cache until the first block that is not
+    cached, then the stream continues from the server. Only finalized data is
+    cached, so invalidations never affect cached data.
+
+    The wrapped client must only be configured through the cache.
+
+    Parameters
+    ----------
+    path:
+        directory used to store the cache.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self._path = Path(path)
+
+    def wrap(
+        self, client: StreamClient, stream: StreamIter
+    ) -> Tuple["_CachedStream", "_CachedStream"]:
+        """Returns a client and stream that read through the cache.
+
+        They are used in place of the values returned by `StreamService.stream_data`.
+        """
+        cached = _CachedStream(self, client, stream)
+        return cached, cached
+
+    def _archive_path(self, filter: Optional[bytes], batch_size: Optional[int]) -> Path:
+        # cached messages are replayed as they were received, so streams with
+        # a different batch size can't share an archive.
+        digest = hashlib.sha256(filter or b"")
+        digest.update(f"batch_size={batch_size}".encode())
+        return self._path / digest.hexdigest()[:16]
+
+
+class _CachedStream:
+    def __init__(
+        self, cache: BlockCache, client: StreamClient, stream: StreamIter
+    ) -> None:
+        self._cache = cache
+        self._client = client
+        self._stream = stream
+        self._iter = None
+        self.stream_id = 0
+        # stream id of the wrapped client, and the stream id it was configured for.
+        self._live_stream_id: Tuple[int, int] = (0, 0)
+        self._request = None
+        self._writer: Optional[ArchiveWriter] = None
+        self._reader: Optional[ArchiveReader] = None
+        self._cached: Optional[Iterator[Data]] = None
+
+    async def configure(
+        self,
+        *,
+        filter: Optional[bytes] = None,
+        batch_size: Optional[int] = None,
+        finality: Optional[DataFinality.ValueType] = None,
+        cursor: Optional[Cursor] = None,
+    ):
+        self.stream_id += 1
+        self._request = dict(
+            filter=filter, batch_size=batch_size, finality=finality, cursor=cursor
+        )
+        self._close()
+        path = self._cache._archive_path(filter, batch_size)
+        self._writer = ArchiveWriter(path)
+        self._writer.flush()
+        self._reader = ArchiveReader(path)
+        self._cached = self._read_cached(cursor)
+
+    def __aiter__(self):
+        self._iter = self._stream.__aiter__()
+        return self
+
+    async def __anext__(self) -> StreamDataResponse:
+        try:
+            return await self._next()
+        except BaseException:
+            # the stream ended or failed, it's not used anymore.
+            self._close()
+            raise
+
+    async def _next(self) -> StreamDataResponse:
+        if self._cached is not None:
+            data = next(self._cached, None)
+            if data is not None:
+                return StreamDataResponse(stream_id=self.stream_id, data=data)
+            await self._go_live()
+
+        message = await self._iter.__anext__()
+        # messages sent before the last configuration keep an old stream id.
+        live_stream_id, stream_id = self._live_stream_id
+        if message.stream_id != live_stream_id:
+            stream_id = 0
+        message.stream_id = stream_id
+        if (
+            stream_id == self.stream_id
+            and message.HasField("data")
+            and message.data.finality == DataFinality.DATA_STATUS_FINALIZED
+        ):
+            self._store(message.data)
+        return message
+
+    async def _go_live(self):
+        """Stream from the server, starting after the last cached data."""
+        self._close_reader()
+        await self._client.configure(**self._request)
+        # each configuration increments the stream id of the wrapped client.
+        self._live_stream_id = (self._live_stream_id[0] + 1, self.stream_id)
+
+    def _read_cached(self, cursor: Optional[Cursor]) -> Iterator[Data]:
+        start = 0 if cursor is None else cursor.order_key + 1
+        for _, payload in self._reader.read(start):
+            data = Data()
+            data.ParseFromString(payload)
+            # stop at the first gap in the cache
+            if cursor is None:
+                if data.HasField("cursor") and data.cursor.order_key > 0:
+                    return
+            elif data.cursor.order_key != cursor.order_key:
+                return
+            cursor = data.end_cursor
+            self._request["cursor"] = cursor
+            yield data
+
+    def _store(self, data: Data):
+        last_order_key = self._writer.last_order_key
+        if last_order_key is not None and data.end_cursor.order_key <= last_order_key:
+            return
+        self._writer.append(data.end_cursor.order_key, data.SerializeToString())
+        self._writer.flush()
+
+    def _close_reader(self):
+        # the generator must release its payloads before the reader is closed.
+        if self._cached is not None:
+            self._cached.close()
+            self._cached = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _close(self):
+        self._close_reader()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -1,12 +1,23 @@
 import asyncio
 from asyncio.queues import Queue
-from typing import AsyncIterable, Iterable, Optional, Tuple, Union
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import grpc
 from grpc.aio import Channel
 
 from apibara.protocol.proto.stream_pb2 import (
     Cursor,
+    Data,
     DataFinality,
     StreamDataRequest,
     StreamDataResponse,
@@ -15,6 +26,8 @@ from apibara.protocol.proto.stream_pb2_grpc import StreamStub
 
 DEFAULT_TIMEOUT = 45.0
 
+DEFAULT_PARTITION_CHUNK_SIZE = 1_000
+
 
 class BearerTokenAuth(grpc.AuthMetadataPlugin):
     def __init__(self, token: str):
@@ -53,6 +66,9 @@ class StreamService:
     def stream_data(self, timeout=None) -> Tuple["StreamClient", "StreamIter"]:
         """Start streaming data from the server.
 
+        Each call opens a new stream. Streams opened from services that use
+        the same channel are multiplexed over the same connection.
+
         Arguments
         ---------
         timeout: float
@@ -96,6 +112,129 @@ class StreamService:
         stream = StreamIter(ctx, iter, timeout)
         return stream
 
+    async def stream_data_partitioned(
+        self,
+        *,
+        start_block: int,
+        end_block: int,
+        order_key: Callable[[bytes], int],
+        partitions: int,
+        filter: Optional[bytes] = None,
+        batch_size: Optional[int] = None,
+        finality: Optional[DataFinality.ValueType] = None,
+        chunk_size: int = DEFAULT_PARTITION_CHUNK_SIZE,
+        buffered_chunks: Optional[int] = None,
+        timeout=None,
+    ) -> AsyncIterator[Data]:
+        """Stream immutable data in `[start_block, end_block)` over many streams.
+
+        The block range is split into chunks of `chunk_size` blocks, streamed
+        with `stream_data_immutable` by at most `partitions` concurrent
+        streams. A new chunk starts as soon as a stream completes its chunk.
+        Data is returned in order, chunks streamed ahead of the returned data
+        are buffered in memory.
+
+        A batch that crosses the end of its chunk is truncated, in this case
+        the `end_cursor` of the returned data only contains the `order_key`.
+
+        Arguments
+        ---------
+        start_block: int
+            first block in the range.
+        end_block: int
+            block after the last block in the range.
+        order_key: Callable[[bytes], int]
+            returns the order key (block number) of the raw data.
+        partitions: int
+            number of concurrent streams.
+        chunk_size: int
+            number of blocks streamed by each stream before starting the next
+            chunk.
+        buffered_chunks: int, optional
+            maximum number of chunks started ahead of the chunk being
+            returned, bounds the memory used to reorder data. Defaults to
+            twice the number of partitions.
+        timeout: float
+            timeout in seconds for waiting messages from the server.
+        """
+        chunks = _partition_range(start_block, end_block, chunk_size)
+        if buffered_chunks is None:
+            buffered_chunks = 2 * partitions
+        # the streams must be able to run ahead of the chunk being returned.
+        window = max(buffered_chunks, partitions)
+        semaphore = asyncio.Semaphore(partitions)
+        queues: Dict[int, Queue] = {}
+        tasks: Dict[int, asyncio.Task] = {}
+        started = 0
+        try:
+            for head in range(len(chunks)):
+                # chunks acquire the semaphore in order, so they start in order.
+                while started < min(head + window, len(chunks)):
+                    queue: Queue = Queue()
+                    queues[started] = queue
+                    tasks[started] = asyncio.create_task(
+                        self._stream_partition(
+                            semaphore,
+                            queue,
+                            *chunks[started],
+                            order_key=order_key,
+                            filter=filter,
+                            batch_size=batch_size,
+                            finality=finality,
+                            timeout=timeout,
+                        )
+                    )
+                    started += 1
+                queue = queues.pop(head)
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                await tasks.pop(head)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    async def _stream_partition(
+        self,
+        semaphore: asyncio.Semaphore,
+        queue: Queue,
+        range_start: int,
+        range_end: int,
+        *,
+        order_key: Callable[[bytes], int],
+        **kwargs,
+    ):
+        cursor = None
+        if range_start > 0:
+            cursor = Cursor(order_key=range_start - 1)
+        try:
+            async with semaphore:
+                stream = self.stream_data_immutable(cursor=cursor, **kwargs)
+                try:
+                    async for message in stream:
+                        if not message.HasField("data"):
+                            continue
+                        data = message.data
+                        if data.end_cursor.order_key < range_end - 1:
+                            queue.put_nowait(data)
+                            continue
+                        if data.end_cursor.order_key >= range_end:
+                            data = _truncate_data(data, range_end, order_key)
+                        if data is not None:
+                            queue.put_nowait(data)
+                        break
+                finally:
+                    # the server streams data after the chunk until cancelled.
+                    await stream.aclose()
+            queue.put_nowait(None)
+        except Exception as exc:
+            queue.put_nowait(exc)
+
 
 class StreamClient:
     def __init__(self, ctx: "_Context") -> None:
@@ -122,6 +261,13 @@ class StreamClient:
 
 
 class StreamIter:
+    """Iterate over the messages sent by the server.
+
+    A single watchdog timer enforces the timeout: it's reset every time a
+    message (including heartbeats) is received and raises `asyncio.TimeoutError`
+    if no message arrives for `timeout` seconds.
+    """
+
     def __init__(
         self, ctx: "_Context", inner: grpc.StreamStreamMultiCallable, timeout: float
     ) -> None:
@@ -129,18 +275,92 @@ class StreamIter:
         self._inner = inner
         self._timeout = timeout
         self._iter = None
+        self._deadline = 0.0
+        self._watchdog: Optional[asyncio.TimerHandle] = None
+        self._waiter: Optional[asyncio.Task] = None
+        self._timed_out = False
 
     def __aiter__(self) -> AsyncIterable[StreamDataResponse]:
         self._iter = self._inner.__aiter__()
         return self
 
     async def __anext__(self):
-        while True:
-            value = await asyncio.wait_for(
-                self._iter.__anext__(), timeout=self._timeout
-            )
-            if value.stream_id == self._ctx.stream_id:
-                return value
+        loop = asyncio.get_running_loop()
+        self._deadline = loop.time() + self._timeout
+        if self._watchdog is None:
+            self._watchdog = loop.call_at(self._deadline, self._check_deadline)
+        self._waiter = asyncio.current_task()
+        try:
+            while True:
+                value = await self._iter.__anext__()
+                self._deadline = loop.time() + self._timeout
+                if value.stream_id == self._ctx.stream_id:
+                    return value
+        except asyncio.CancelledError:
+            if not self._timed_out:
+                raise
+            self._timed_out = False
+            # the task was cancelled by the watchdog, not by the caller.
+            if hasattr(self._waiter, "uncancel"):
+                self._waiter.uncancel()
+            raise asyncio.TimeoutError() from None
+        except StopAsyncIteration:
+            if self._watchdog is not None:
+                self._watchdog.cancel()
+                self._watchdog = None
+            raise
+        finally:
+            self._waiter = None
+
+    async def aclose(self):
+        """Stop iterating, the call is cancelled so the server stops streaming."""
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if hasattr(self._inner, "cancel"):
+            self._inner.cancel()
+        elif hasattr(self._iter, "aclose"):
+            await self._iter.aclose()
+
+    def _check_deadline(self):
+        self._watchdog = None
+        # not waiting for a message, the timer is started again by `__anext__`.
+        if self._waiter is None:
+            return
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._deadline:
+            self._watchdog = loop.call_at(self._deadline, self._check_deadline)
+            return
+        self._timed_out = True
+        self._waiter.cancel()
+
+
+def _partition_range(start: int, end: int, size: int) -> List[Tuple[int, int]]:
+    """Split `[start, end)` in ranges of `size` blocks."""
+    size = max(1, size)
+    return [(lo, min(lo + size, end)) for lo in range(start, end, size)]
+
+
+def _truncate_data(
+    data: Data, end: int, order_key: Callable[[bytes], int]
+) -> Optional[Data]:
+    """Returns `data` without the items with order key after `end`."""
+    items = []
+    last_key = None
+    for item in data.data:
+        key = order_key(item)
+        if key >= end:
+            break
+        items.append(item)
+        last_key = key
+    if not items:
+        return None
+    return Data(
+        cursor=data.cursor,
+        end_cursor=Cursor(order_key=last_key),
+        finality=data.finality,
+        data=items,
+    )
 
 
 class _Context:
@@ -0,0 +1,292 @@
+import asyncio
+import bisect
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple, Union
+
+import grpc
+from grpc import aio
+
+from apibara.protocol.archive import ArchiveReader
+from apibara.protocol.proto.stream_pb2 import (
+    Cursor,
+    Data,
+    DataFinality,
+    Heartbeat,
+    Invalidate,
+    StreamDataRequest,
+    StreamDataResponse,
+)
+from apibara.protocol.proto.stream_pb2_grpc import (
+    StreamServicer,
+    add_StreamServicer_to_server,
+)
+
+DEFAULT_HEARTBEAT_INTERVAL = 5.0
+DEFAULT_STOP_GRACE = 1.0
+
+Blocks = Union[ArchiveReader, Iterable[Tuple[int, bytes]]]
+
+
+class LocalStreamServer:
+    """An in-process stream server that serves recorded data.
+
+    The server implements the `Stream` service and can be used to run
+    indexers and benchmarks without connecting to a real server. Data is
+    served in order key (block number) order, honoring the starting cursor,
+    batch size, finality and stream id of each request.
+
+    Parameters
+    ----------
+    blocks:
+        the data to serve, either an `ArchiveReader` or `(order_key, payload)` pairs.
+    finalized:
+        order key of the last finalized block. Data up to this block is sent as
+        finalized, the rest as accepted. If not set, all data is finalized.
+    pending:
+        order key of the pending block. It's sent alone, as pending data, to
+        streams that request pending data, and never to the other streams.
+        Blocks after it are not sent. If not set, there is no pending data.
+    heartbeat_interval:
+        interval between heartbeats sent after all data has been streamed.
+    latency:
+        delay, in seconds, before sending each message.
+    """
+
+    def __init__(
+        self,
+        blocks: Blocks,
+        *,
+        finalized: Optional[int] = None,
+        pending: Optional[int] = None,
+        heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+        latency: float = 0.0,
+    ) -> None:
+        self._servicer = _LocalStreamServicer(
+            _BlocksSource(blocks),
+            finalized=finalized,
+            pending=pending,
+            heartbeat_interval=heartbeat_interval,
+            latency=latency,
+        )
+        self._server: Optional[aio.Server] = None
+        self.address: Optional[str] = None
+
+    async def start(self, address: str = "127.0.0.1:0") -> str:
+        """Start the server, returns the address it's listening on."""
+        self._server = aio.server()
+        add_StreamServicer_to_server(self._servicer, self._server)
+        host = address.rsplit(":", 1)[0]
+        port = self._server.add_insecure_port(address)
+        await self._server.start()
+        self.address = f"{host}:{port}"
+        return self.address
+
+    async def stop(self, grace: Optional[float] = DEFAULT_STOP_GRACE):
+        """Stop the server.
+
+        Live streams are ended, then running calls have `grace` seconds to
+        complete before they're cancelled.
+        """
+        if self._server is not None:
+            self._servicer.broadcast(("stop", None))
+            await self._server.stop(grace=grace)
+            await self._server.wait_for_termination()
+            self._server = None
+
+    def invalidate(self, cursor: Cursor):
+        """Invalidate data after `cursor` on all live streams.
+
+        Streams send an invalidate message, then stream data again starting
+        after `cursor`.
+        """
+        self._servicer.broadcast(("invalidate", cursor))
+
+    def disconnect(self):
+        """Abort all live streams with an `INTERNAL` error."""
+        self._servicer.broadcast(("disconnect", None))
+
+    async def __aenter__(self) -> "LocalStreamServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+
+class _BlocksSource:
+    def __init__(self, blocks: Blocks) -> None:
+        if isinstance(blocks, ArchiveReader):
+            self._archive = blocks
+            self._keys = None
+            self._payloads = None
+        else:
+            self._archive = None
+            items = sorted(blocks, key=lambda item: item[0])
+            self._keys = [key for key, _ in items]
+            self._payloads = [payload for _, payload in items]
+
+    def read(self, start: int, end: Optional[int]) -> Iterator[Tuple[int, bytes]]:
+        """Iterate over the blocks in `[start, end)`."""
+        if self._archive is not None:
+            for key, payload in self._archive.read(start, end):
+                yield key, bytes(payload)
+            return
+        i = bisect.bisect_left(self._keys, start)
+        while i < len(self._keys) and (end is None or self._keys[i] < end):
+            yield self._keys[i], self._payloads[i]
+            i += 1
+
+
+class _LocalStreamServicer(StreamServicer):
+    def __init__(
+        self,
+        source: _BlocksSource,
+        *,
+        finalized: Optional[int],
+        pending: Optional[int],
+        heartbeat_interval: float,
+        latency: float,
+    ) -> None:
+        self._source = source
+        self._finalized = finalized
+        self._pending = pending
+        self._heartbeat_interval = heartbeat_interval
+        self._latency = latency
+        self._inboxes: List[asyncio.Queue] = []
+
+    def broadcast(self, event: Tuple[str, Optional[Cursor]]):
+        for inbox in self._inboxes:
+            inbox.put_nowait(event)
+
+    async def StreamData(self, request_iterator, context):
+        inbox = asyncio.Queue()
+        self._inboxes.append(inbox)
+        reader = asyncio.create_task(self._read_requests(request_iterator, inbox))
+        try:
+            request = None
+            next_key = 0
+            while True:
+                if request is None or not inbox.empty():
+                    if request is None:
+                        event, value = await inbox.get()
+                    else:
+                        event, value = inbox.get_nowait()
+                    if event == "configure":
+                        request = value
+                        next_key = self._first_key(request)
+                    elif event == "stop":
+                        return
+                    elif event == "disconnect":
+                        await context.abort(grpc.StatusCode.INTERNAL, "disconnected")
+                    elif event == "invalidate" and request is not None:
+                        await self._delay()
+                        yield StreamDataResponse(
+                            stream_id=request.stream_id,
+                            invalidate=Invalidate(cursor=value),
+                        )
+                        next_key = min(next_key, value.order_key + 1)
+                    continue
+
+                response = self._next_data(request, next_key)
+                if response is not None:
+                    await self._delay()
+                    next_key = response.data.end_cursor.order_key + 1
+                    yield response
+                    continue
+
+                # no more data, wait for new requests or events.
+                try:
+                    event = await asyncio.wait_for(
+                        inbox.get(), timeout=self._heartbeat_interval
+                    )
+                    inbox.put_nowait(event)
+                except asyncio.TimeoutError:
+                    yield StreamDataResponse(
+                        stream_id=request.stream_id, heartbeat=Heartbeat()
+                    )
+        finally:
+            self._inboxes.remove(inbox)
+            reader.cancel()
+            try:
+                await reader
+            except asyncio.CancelledError:
+                pass
+
+    async def StreamDataImmutable(self, request, context):
+        next_key = self._first_key(request)
+        while True:
+            response = self._next_data(request, next_key)
+            if response is None:
+                return
+            await self._delay()
+            next_key = response.data.end_cursor.order_key + 1
+            yield response
+
+    async def _read_requests(
+        self, request_iterator: AsyncIterator[StreamDataRequest], inbox: asyncio.Queue
+    ):
+        async for request in request_iterator:
+            inbox.put_nowait(("configure", request))
+
+    async def _delay(self):
+        if self._latency > 0:
+            await asyncio.sleep(self._latency)
+
+    def _first_key(self, request: StreamDataRequest) -> int:
+        if request.HasField("starting_cursor"):
+            return request.starting_cursor.order_key + 1
+        return 0
+
+    def _next_data(
+        self, request: StreamDataRequest, next_key: int
+    ) -> Optional[StreamDataResponse]:
+        finality = DataFinality.DATA_STATUS_ACCEPTED
+        if request.HasField("finality"):
+            finality = request.finality
+
+        end = None
+        if (
+            finality == DataFinality.DATA_STATUS_FINALIZED
+            and self._finalized is not None
+        ):
+            end = self._finalized + 1
+        elif self._pending is not None:
+            end = self._pending
+
+        batch_size = max(request.batch_size, 1)
+        items = []
+        for key, payload in self._source.read(next_key, end):
+            items.append((key, payload))
+            if len(items) >= batch_size:
+                break
+
+        data_finality = None
+        if (
+            not items
+            and finality == DataFinality.DATA_STATUS_PENDING
+            and self._pending is not None
+            and next_key <= self._pending
+        ):
+            items = list(self._source.read(self._pending, self._pending + 1))
+            data_finality = DataFinality.DATA_STATUS_PENDING
+
+        if not items:
+            return None
+
+        last_key = items[-1][0]
+        if data_finality is None:
+            data_finality = DataFinality.DATA_STATUS_FINALIZED
+            if self._finalized is not None and last_key > self._finalized:
+                data_finality = DataFinality.DATA_STATUS_ACCEPTED
+
+        cursor = None
+        if next_key > 0:
+            cursor = Cursor(order_key=next_key - 1)
+        return StreamDataResponse(
+            stream_id=request.stream_id,
+            data=Data(
+                cursor=cursor,
+                end_cursor=Cursor(order_key=last_key),
+                finality=data_finality,
+                data=[payload for _, payload in items],
+            ),
+        )
@@ -2,5 +2,6 @@ import apibara.starknet.felt as felt
 from apibara.starknet.cursor import *
 from apibara.starknet.filter import *
 from apibara.starknet.indexer import *
+from apibara.starknet.lazy import LazyBlock
 from apibara.starknet.proto.starknet_pb2 import Block
 from apibara.starknet.proto.types_pb2 import FieldElement
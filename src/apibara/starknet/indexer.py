@@ -1,13 +1,30 @@
+from typing import Optional
+
+import apibara.starknet.felt as felt
 from apibara.indexer.indexer import Indexer
+from apibara.protocol.proto.stream_pb2 import Cursor
+from apibara.starknet.cursor import starknet_cursor
 from apibara.starknet.filter import Filter
 from apibara.starknet.proto.starknet_pb2 import Block
 
 
+def decode_block(raw: bytes) -> Block:
+    """Decode a StarkNet block from its wire representation."""
+    block = Block()
+    block.ParseFromString(raw)
+    return block
+
+
 class StarkNetIndexer(Indexer[Filter, Block]):
     def encode_filter(self, filter: Filter) -> bytes:
         return filter.encode()
 
     def decode_data(self, raw: bytes) -> Block:
-        block = Block()
-        block.ParseFromString(raw)
-        return block
+        return decode_block(raw)
+
+    def data_end_cursor(self, data: Block) -> Optional[Cursor]:
+        header = data.header
+        block_hash = b""
+        if header.HasField("block_hash"):
+            block_hash = felt.to_int(header.block_hash).to_bytes(32, "big")
+        return starknet_cursor(header.block_number, block_hash)
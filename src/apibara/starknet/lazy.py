@@ -0,0 +1,190 @@
+from typing import Dict, List, Optional, Tuple, Type
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from google.protobuf.message import Message
+
+from apibara.starknet.proto import starknet_pb2
+from apibara.starknet.proto.starknet_pb2 import Block
+
+_PACKAGE = "apibara.starknet.v1alpha2.lazy"
+
+
+def _message_class(descriptor) -> Type[Message]:
+    # `GetMessageClass` was added in protobuf 4.22
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(descriptor)
+    return message_factory.MessageFactory().GetPrototype(descriptor)
+
+
+def _block_field_projections() -> Dict[str, Type[Message]]:
+    """Returns one message type for each field in `Block`.
+
+    Each message type contains only one of the fields of `Block`, so that
+    parsing a block with it skips all the other fields.
+    """
+    block = descriptor_pb2.DescriptorProto()
+    Block.DESCRIPTOR.CopyToProto(block)
+
+    file = descriptor_pb2.FileDescriptorProto(
+        name="apibara/starknet/lazy.proto",
+        package=_PACKAGE,
+        syntax="proto3",
+        dependency=[starknet_pb2.DESCRIPTOR.name],
+    )
+    for field in block.field:
+        message = file.message_type.add(name=f"Block_{field.name}")
+        message.field.add().CopyFrom(field)
+
+    pool = descriptor_pool.Default()
+    pool.AddSerializedFile(file.SerializeToString())
+    return {
+        field.name: _message_class(
+            pool.FindMessageTypeByName(f"{_PACKAGE}.Block_{field.name}")
+        )
+        for field in block.field
+    }
+
+
+_PROJECTIONS = _block_field_projections()
+
+_FIELD_NUMBERS = {field.name: field.number for field in Block.DESCRIPTOR.fields}
+
+
+def _read_varint(raw, pos: int) -> Tuple[int, int]:
+    """Returns the varint starting at `pos` and the position after it."""
+    value = 0
+    shift = 0
+    while True:
+        byte = raw[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _scan_fields(raw) -> Dict[int, List[Tuple[int, int]]]:
+    """Returns the (start, end) spans of each top-level field in `raw`.
+
+    Spans include the field tag, so that parsing the concatenated spans of
+    a field with its projection message yields that field only. Adjacent
+    entries of repeated fields are merged into one span.
+    """
+    spans: Dict[int, List[Tuple[int, int]]] = {}
+    pos = 0
+    size = len(raw)
+    while pos < size:
+        start = pos
+        # all the tags of `Block` fit in one byte.
+        tag = raw[pos]
+        if tag < 0x80:
+            pos += 1
+        else:
+            tag, pos = _read_varint(raw, pos)
+        wire_type = tag & 0x7
+        if wire_type == 2:
+            length, pos = _read_varint(raw, pos)
+            pos += length
+        elif wire_type == 0:
+            _, pos = _read_varint(raw, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError(f"unsupported wire type {wire_type} at offset {start}")
+        if pos > size:
+            raise ValueError(f"truncated field at offset {start}")
+
+        field_spans = spans.setdefault(tag >> 3, [])
+        if field_spans and field_spans[-1][1] == start:
+            field_spans[-1] = (field_spans[-1][0], pos)
+        else:
+            field_spans.append((start, pos))
+    return spans
+
+
+class LazyBlock:
+    """A StarkNet block that is decoded only when its fields are accessed.
+
+    The first access scans the top-level wire tags of the block once and
+    records where each field is encoded. Each field is then parsed from its
+    own bytes the first time it's accessed, without reading the content of
+    the other fields. Indexers that only use some
+    fields (for example `header` and `events`) never pay the cost of decoding
+    the others.
+
+    Use it by returning a `LazyBlock` from `StarkNetIndexer.decode_data`.
+
+    Arguments
+    ---------
+    raw : bytes
+        the wire-encoded block.
+    """
+
+    __slots__ = ("_raw", "_fields", "_spans")
+
+    def __init__(self, raw: bytes) -> None:
+        self._raw = raw
+        self._fields: Dict[str, Message] = {}
+        self._spans: Optional[Dict[int, List[Tuple[int, int]]]] = None
+
+    @property
+    def status(self):
+        return self._field("status").status
+
+    @property
+    def header(self):
+        return self._field("header").header
+
+    @property
+    def transactions(self):
+        return self._field("transactions").transactions
+
+    @property
+    def state_update(self):
+        return self._field("state_update").state_update
+
+    @property
+    def events(self):
+        return self._field("events").events
+
+    @property
+    def l2_to_l1_messages(self):
+        return self._field("l2_to_l1_messages").l2_to_l1_messages
+
+    @property
+    def empty(self):
+        return self._field("empty").empty
+
+    def HasField(self, name: str) -> bool:
+        return self._field(name).HasField(name)
+
+    def SerializeToString(self) -> bytes:
+        return bytes(self._raw)
+
+    def to_block(self) -> Block:
+        """Returns the fully decoded block."""
+        block = Block()
+        block.ParseFromString(self._raw)
+        return block
+
+    def _field(self, name: str) -> Message:
+        message = self._fields.get(name)
+        if message is None:
+            if self._spans is None:
+                self._spans = _scan_fields(self._raw)
+            spans = self._spans.get(_FIELD_NUMBERS[name], [])
+            message = _PROJECTIONS[name]()
+            if len(spans) == 1:
+                start, end = spans[0]
+                message.ParseFromString(self._raw[start:end])
+            elif spans:
+                message.ParseFromString(
+                    b"".join(self._raw[start:end] for start, end in spans)
+                )
+            self._fields[name] = message
+        return message
+
+    def __reduce__(self):
+        return (LazyBlock, (self._raw,))
@@ -1,11 +1,19 @@
 import json
+import time
 from pathlib import Path
 
 import pytest
+from pymongo import MongoClient
+from testcontainers.core.container import DockerContainer
+from testcontainers.core.waiting_utils import wait_for_logs
 from testcontainers.mongodb import MongoDbContainer
 
 from apibara.indexer.storage import IndexerStorage
 
+REPLICA_SET_INITIATE = (
+    "rs.initiate({_id: 'rs0', members: [{_id: 0, host: 'localhost:27017'}]})"
+)
+
 
 def fixture_path(filename):
     return Path(__file__).parent / "fixtures" / filename
@@ -26,7 +34,42 @@ def storage():
         storage.drop_database()
 
 
+@pytest.fixture(scope="function")
+def buffered_storage():
+    with MongoDbContainer("mongo:latest") as mongo:
+        connection_url = mongo.get_connection_url()
+        storage = IndexerStorage(
+            connection_url, "python-sdk-test-db", buffer_writes=True
+        )
+        yield storage
+        # cleanup database
+        storage.drop_database()
+
+
 @pytest.fixture(scope="function")
 def mongo_db():
     with MongoDbContainer("mongo:latest") as mongo:
         yield mongo.get_connection_url()
+
+
+@pytest.fixture(scope="function")
+def mongo_replica_set():
+    """A single member replica set, required to use transactions."""
+    container = (
+        DockerContainer("mongo:latest")
+        .with_command("--replSet rs0 --bind_ip_all")
+        .with_exposed_ports(27017)
+    )
+    with container as mongo:
+        wait_for_logs(mongo, "Waiting for connections")
+        mongo.exec(["mongosh", "--quiet", "--eval", REPLICA_SET_INITIATE])
+        host = mongo.get_container_host_ip()
+        port = mongo.get_exposed_port(27017)
+        url = f"mongodb://{host}:{port}/?directConnection=true"
+        client = MongoClient(url)
+        for _ in range(100):
+            if client.admin.command("hello").get("isWritablePrimary"):
+                break
+            time.sleep(0.1)
+        client.close()
+        yield url
@@ -0,0 +1,45 @@
+from apibara.indexer.cache import NO_KEY, DocumentCache
+
+
+def test_document_cache_lru():
+    cache = DocumentCache("address", max_size=2)
+    assert cache.key_of({"address": "0x1"}) == "0x1"
+    assert cache.key_of({"address": {"$in": ["0x1"]}}) is NO_KEY
+    assert cache.key_of({"address": "0x1", "token": "eth"}) is NO_KEY
+
+    cache.put("0x1", {"address": "0x1"}, 100)
+    cache.put("0x2", None, 100)
+    assert cache.get("0x2") == (True, None)
+    assert cache.get("0x1") == (True, {"address": "0x1"})
+    cache.put("0x3", {"address": "0x3"}, 101)
+    # 0x1 was used more recently than 0x2
+    assert cache.get("0x2") == (False, None)
+    assert cache.get("0x1")[0]
+
+    assert cache.stats.hits == 3
+    assert cache.stats.misses == 1
+    assert cache.stats.evictions == 1
+    assert cache.stats.size == 2
+    assert cache.stats.hit_rate == 0.75
+
+
+def test_document_cache_invalidate():
+    cache = DocumentCache("address", max_size=10)
+    cache.put("0x1", {"address": "0x1"}, 100)
+    cache.put("0x2", {"address": "0x2"}, 102)
+    cache.put("0x3", None, 103)
+    cache.invalidate(101)
+    assert cache.get("0x1")[0]
+    assert not cache.get("0x2")[0]
+    assert not cache.get("0x3")[0]
+    assert cache.stats.size == 1
+
+
+def test_document_cache_returns_copies():
+    cache = DocumentCache("address", max_size=10)
+    doc = {"address": "0x1", "balance": {"eth": 1}}
+    cache.put("0x1", doc, 100)
+    doc["balance"]["eth"] = 2
+    _, cached = cache.get("0x1")
+    cached["balance"]["eth"] = 3
+    assert cache.get("0x1")[1]["balance"]["eth"] == 1
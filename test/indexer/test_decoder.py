@@ -0,0 +1,37 @@
+import pytest
+
+from apibara.indexer.decoder import ProcessPoolDecoder
+from apibara.starknet.indexer import decode_block
+from apibara.starknet.proto.starknet_pb2 import Block, BlockHeader
+
+
+def block_number(block: Block) -> int:
+    return block.header.block_number
+
+
+def encoded_block(block_number: int) -> bytes:
+    return Block(header=BlockHeader(block_number=block_number)).SerializeToString()
+
+
+@pytest.mark.asyncio
+async def test_decode_in_worker_preserves_order():
+    decoder = ProcessPoolDecoder(
+        decode_block, transform=block_number, max_workers=2, inline_threshold=0
+    )
+    try:
+        futures = [decoder.submit(encoded_block(i)) for i in range(20)]
+        assert [await f for f in futures] == list(range(20))
+    finally:
+        decoder.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_decode_small_messages_inline():
+    decoder = ProcessPoolDecoder(decode_block, max_workers=1)
+    try:
+        future = decoder.submit(encoded_block(42))
+        assert future.done()
+        block = await future
+        assert block.header.block_number == 42
+    finally:
+        decoder.shutdown()
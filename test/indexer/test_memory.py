@@ -0,0 +1,210 @@
+import pytest
+
+from apibara.indexer import (
+    IndexerConfiguration,
+    IndexerRunner,
+    IndexerRunnerConfiguration,
+)
+from apibara.indexer.memory import InMemoryIndexerStorage
+from apibara.protocol.server import LocalStreamServer
+from apibara.starknet import Filter, StarkNetIndexer, starknet_cursor
+from apibara.starknet.proto.starknet_pb2 import Block, BlockHeader
+
+
+@pytest.fixture
+def storage():
+    storage = InMemoryIndexerStorage(
+        "memory://test", "test", indexes={"capibaras": ["name"]}
+    )
+    storage.drop_database()
+    yield storage
+    storage.drop_database()
+
+
+@pytest.mark.asyncio
+async def test_insert_and_find(storage: InMemoryIndexerStorage):
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_many(
+            "capibaras",
+            [
+                {"name": "bob", "age": 3, "tags": ["a", "b"]},
+                {"name": "charlie", "age": 4, "info": {"color": "brown"}},
+                {"name": "dylan", "age": 8},
+            ],
+        )
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        assert len(list(await s.find("capibaras", {}))) == 3
+        bob = await s.find_one("capibaras", {"name": "bob"})
+        assert bob["age"] == 3
+        assert bob["_chain"] == {"valid_from": 100, "valid_to": None}
+
+        found = await s.find("capibaras", {"age": {"$gte": 4, "$lt": 8}})
+        assert [doc["name"] for doc in found] == ["charlie"]
+        found = await s.find("capibaras", {"info.color": "brown"})
+        assert [doc["name"] for doc in found] == ["charlie"]
+        found = await s.find("capibaras", {"tags": "b"})
+        assert [doc["name"] for doc in found] == ["bob"]
+        found = await s.find("capibaras", {"info": {"$exists": False}})
+        assert [doc["name"] for doc in found] == ["bob", "dylan"]
+        found = await s.find(
+            "capibaras", {"$or": [{"name": "bob"}, {"age": {"$in": [8, 9]}}]}
+        )
+        assert [doc["name"] for doc in found] == ["bob", "dylan"]
+
+        found = await s.find(
+            "capibaras", {}, sort={"age": -1}, projection={"name": 1}, skip=1, limit=1
+        )
+        assert [{k: v for k, v in doc.items() if k != "_id"} for doc in found] == [
+            {"name": "charlie"}
+        ]
+
+        # returned documents are copies.
+        bob["age"] = 10
+        assert (await s.find_one("capibaras", {"name": "bob"}))["age"] == 3
+
+
+@pytest.mark.asyncio
+async def test_delete(storage: InMemoryIndexerStorage):
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_many(
+            "capibaras",
+            [
+                {"name": "bob", "age": 3},
+                {"name": "charlie", "age": 4},
+                {"name": "dylan", "age": 8},
+            ],
+        )
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        await s.delete_one("capibaras", {"name": "bob"})
+        await s.delete_many("capibaras", {"age": {"$gte": 4}})
+
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        assert list(await s.find("capibaras", {})) == []
+
+    assert len(storage.db["capibaras"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_update_and_replace(storage: InMemoryIndexerStorage):
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_one("capibaras", {"name": "bob", "age": 3})
+        # same block, updated in place.
+        await s.find_one_and_update("capibaras", {"name": "bob"}, {"$inc": {"age": 1}})
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        existing = await s.find_one_and_update(
+            "capibaras", {"name": "bob"}, {"$set": {"age": 5}}
+        )
+        assert existing["age"] == 4
+        await s.find_one_and_replace(
+            "capibaras", {"name": "bob"}, {"name": "bob", "age": 6}
+        )
+        await s.find_one_and_replace(
+            "capibaras", {"name": "alice"}, {"name": "alice", "age": 1}, upsert=True
+        )
+
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        bob = await s.find_one("capibaras", {"name": "bob"})
+        assert bob["age"] == 6
+        assert bob["_chain"]["valid_from"] == 101
+        assert await s.find_one("capibaras", {"name": "alice"}) is not None
+
+        with pytest.raises(ValueError):
+            await s.find_one_and_update(
+                "capibaras", {"name": "bob"}, {"$push": {"tags": "a"}}
+            )
+
+    # one version at block 100, one at block 101.
+    assert len(storage.db["capibaras"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_invalidate(storage: InMemoryIndexerStorage):
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_one("capibaras", {"name": "bob", "age": 3})
+        await s.insert_one("capibaras", {"name": "charlie", "age": 4})
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        await s.find_one_and_update("capibaras", {"name": "bob"}, {"$inc": {"age": 1}})
+        await s.delete_one("capibaras", {"name": "charlie"})
+        await s.insert_one("capibaras", {"name": "dylan", "age": 8})
+
+    storage.invalidate(starknet_cursor(100))
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        found = await s.find("capibaras", {}, sort={"name": 1})
+        assert [(doc["name"], doc["age"]) for doc in found] == [
+            ("bob", 3),
+            ("charlie", 4),
+        ]
+        assert await s.find_one("capibaras", {"name": "dylan"}) is None
+
+
+class MockIndexer(StarkNetIndexer):
+    def indexer_id(self):
+        return "test"
+
+    def initial_configuration(self):
+        return IndexerConfiguration(
+            filter=Filter().with_header(weak=True),
+            starting_cursor=starknet_cursor(0),
+        )
+
+    async def handle_data(self, info, data):
+        await info.storage.insert_one(
+            "blocks", {"block_number": data.header.block_number}
+        )
+        if data.header.block_number == 9:
+            raise StopIndexer()
+
+
+class StopIndexer(Exception):
+    pass
+
+
+@pytest.mark.asyncio
+async def test_runner_with_memory_storage():
+    encoded = [
+        (i, Block(header=BlockHeader(block_number=i)).SerializeToString())
+        for i in range(0, 10)
+    ]
+    async with LocalStreamServer(encoded) as server:
+        runner = IndexerRunner(
+            reset_state=True,
+            config=IndexerRunnerConfiguration(
+                stream_url=server.address,
+                stream_ssl=False,
+                storage_url="memory://runner",
+            ),
+        )
+        with pytest.raises(StopIndexer):
+            await runner.run(MockIndexer())
+
+    storage = InMemoryIndexerStorage("memory://runner", "test")
+    with storage.create_storage_for_block(starknet_cursor(10)) as s:
+        blocks = [doc["block_number"] for doc in await s.find("blocks", {})]
+    assert blocks == list(range(1, 10))
+    storage.drop_database()
+
+
+@pytest.mark.asyncio
+async def test_find_as_of(storage: InMemoryIndexerStorage):
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_one("capibaras", {"name": "bob", "age": 3})
+        await s.insert_one("capibaras", {"name": "charlie", "age": 4})
+
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        await s.find_one_and_update("capibaras", {"name": "bob"}, {"$inc": {"age": 1}})
+        await s.delete_one("capibaras", {"name": "charlie"})
+
+    with storage.create_storage_for_block(starknet_cursor(103)) as s:
+        assert await s.find_one("capibaras", {"name": "bob"}, as_of=99) is None
+        assert (await s.find_one("capibaras", {"name": "bob"}, as_of=101))["age"] == 3
+        assert (await s.find_one("capibaras", {"name": "bob"}, as_of=102))["age"] == 4
+
+        found = await s.find("capibaras", {}, sort={"name": 1}, as_of=101)
+        assert [d["name"] for d in found] == ["bob", "charlie"]
+        found = await s.find("capibaras", {}, sort={"name": 1}, as_of=102)
+        assert [d["name"] for d in found] == ["bob"]
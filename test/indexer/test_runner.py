@@ -1,5 +1,5 @@
 import asyncio
-from test.conftest import mongo_db
+from test.conftest import mongo_db, mongo_replica_set
 from unittest.mock import ANY, MagicMock, call
 
 import pytest
@@ -9,14 +9,18 @@ from apibara.indexer import (
     IndexerConfiguration,
     IndexerRunner,
     IndexerRunnerConfiguration,
+    ProcessPoolDecoder,
 )
+from apibara.indexer.memory import MEMORY_URL_SCHEME
 from apibara.protocol.proto.stream_pb2 import (
     Cursor,
     Data,
     DataFinality,
     StreamDataResponse,
 )
+from apibara.protocol.server import LocalStreamServer
 from apibara.starknet import EventFilter, Filter, StarkNetIndexer, starknet_cursor
+from apibara.starknet.indexer import decode_block
 from apibara.starknet.proto.starknet_pb2 import Block, BlockHeader
 
 
@@ -43,6 +47,36 @@ class MockIndexer(StarkNetIndexer):
         )
 
 
+class StopIndexer(Exception):
+    pass
+
+
+def block_number(block):
+    return block.header.block_number
+
+
+@pytest.fixture(params=["mongodb", "memory"])
+def storage_url(request):
+    """Storage url of the runner, the in-memory storage doesn't need Docker."""
+    if request.param == "memory":
+        return "memory://test"
+    return request.getfixturevalue("mongo_db")
+
+
+def is_mongo(storage_url):
+    return not storage_url.startswith(MEMORY_URL_SCHEME)
+
+
+async def stored_blocks(runner):
+    """Returns the current documents written by `MockIndexer`."""
+    with runner._indexer_storage.create_storage_for_block(starknet_cursor(0)) as s:
+        return await (await s.find("blocks", {})).to_list()
+
+
+def stored_cursor(runner):
+    return runner._indexer_storage._read_configuration()["cursor"]
+
+
 def future(value):
     fut = asyncio.Future()
     fut.set_result(value)
@@ -99,12 +133,32 @@ def new_data(
     )
 
 
+def new_batch(
+    start_block, end_block, stream_id=1, finality=DataFinality.DATA_STATUS_FINALIZED
+):
+    start = starknet_cursor(start_block)
+    end = starknet_cursor(end_block)
+    blocks = [
+        Block(header=BlockHeader(block_number=block_number))
+        for block_number in range(start_block + 1, end_block + 1)
+    ]
+    return StreamDataResponse(
+        stream_id=stream_id,
+        data=Data(
+            cursor=start,
+            end_cursor=end,
+            finality=finality,
+            data=[block.SerializeToString() for block in blocks],
+        ),
+    )
+
+
 @pytest.mark.asyncio
-async def test_runner_invokes_indexer(mongo_db):
+async def test_runner_invokes_indexer(storage_url):
     runner = MockIndexerRunner(
         reset_state=True,
         config=IndexerRunnerConfiguration(
-            stream_url="http://localhost:5000", storage_url=mongo_db
+            stream_url="http://localhost:5000", storage_url=storage_url
         ),
     )
 
@@ -128,11 +182,11 @@ async def test_runner_invokes_indexer(mongo_db):
 
 
 @pytest.mark.asyncio
-async def test_invalidate_between_pending_blocks(mongo_db):
+async def test_invalidate_between_pending_blocks(storage_url):
     runner = MockIndexerRunner(
         reset_state=True,
         config=IndexerRunnerConfiguration(
-            stream_url="http://localhost:5000", storage_url=mongo_db
+            stream_url="http://localhost:5000", storage_url=storage_url
         ),
     )
 
@@ -157,20 +211,16 @@ async def test_invalidate_between_pending_blocks(mongo_db):
 
     await runner.run(indexer)
 
-    client = MongoClient(mongo_db)
-    db = client["test"]
-    col = db["blocks"]
-    docs = [d for d in col.find()]
-    assert len(docs) == 4
+    assert len(await stored_blocks(runner)) == 4
 
 
 @pytest.mark.asyncio
-async def test_reconnect_to_avoid_disconnect(mongo_db):
+async def test_reconnect_to_avoid_disconnect(storage_url):
     runner = MockIndexerRunner(
         reset_state=True,
         _reconnect_to_avoid_disconnection=5,
         config=IndexerRunnerConfiguration(
-            stream_url="http://localhost:5000", storage_url=mongo_db
+            stream_url="http://localhost:5000", storage_url=storage_url
         ),
     )
 
@@ -197,12 +247,12 @@ async def test_reconnect_to_avoid_disconnect(mongo_db):
 
 
 @pytest.mark.asyncio
-async def test_reconnect_to_avoid_disconnect_does_not_count_pending_blocks(mongo_db):
+async def test_reconnect_to_avoid_disconnect_does_not_count_pending_blocks(storage_url):
     runner = MockIndexerRunner(
         reset_state=True,
         _reconnect_to_avoid_disconnection=5,
         config=IndexerRunnerConfiguration(
-            stream_url="http://localhost:5000", storage_url=mongo_db
+            stream_url="http://localhost:5000", storage_url=storage_url
         ),
     )
 
@@ -239,3 +289,325 @@ async def test_reconnect_to_avoid_disconnect_does_not_count_pending_blocks(mongo
             call(filter=ANY, finality=ANY, cursor=starknet_cursor(10), batch_size=1),
         ]
     )
+
+
+@pytest.mark.asyncio
+async def test_runner_handles_batches(storage_url):
+    runner = MockIndexerRunner(
+        reset_state=True,
+        batch_size=5,
+        config=IndexerRunnerConfiguration(
+            stream_url="http://localhost:5000", storage_url=storage_url
+        ),
+    )
+
+    indexer = MockIndexer()
+    cursors = []
+
+    async def handle_data(info, data):
+        cursors.append((info.cursor.order_key, info.end_cursor.order_key))
+        await indexer._handle_data(info, data)
+
+    indexer.handle_data = handle_data
+
+    runner.client.configure = MagicMock(return_value=future(None))
+    runner.stream.put_iter(
+        [
+            new_batch(0, 5, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_batch(5, 8, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            None,
+        ]
+    )
+
+    await runner.run(indexer)
+
+    runner.client.configure.assert_called_once_with(
+        filter=ANY, finality=ANY, cursor=starknet_cursor(0), batch_size=5
+    )
+    assert cursors == [(i, i + 1) for i in range(0, 8)]
+
+    blocks = sorted(
+        (d["block_number"], d["_chain"]["valid_from"])
+        for d in await stored_blocks(runner)
+    )
+    assert blocks == [(i, i) for i in range(1, 9)]
+    assert stored_cursor(runner)["order_key"] == 8
+
+
+@pytest.mark.asyncio
+async def test_read_ahead_drops_messages_from_previous_stream(storage_url):
+    runner = MockIndexerRunner(
+        reset_state=True,
+        read_ahead=4,
+        _reconnect_to_avoid_disconnection=2,
+        config=IndexerRunnerConfiguration(
+            stream_url="http://localhost:5000", storage_url=storage_url
+        ),
+    )
+
+    indexer = MockIndexer()
+    blocks = []
+
+    async def handle_data(info, data):
+        blocks.append(data.header.block_number)
+
+    indexer.handle_data = handle_data
+
+    runner.client.configure = MagicMock(return_value=future(None))
+    runner.stream.put_iter(
+        [
+            new_data(0, 1, stream_id=1, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_data(1, 2, stream_id=1, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            # received before the runner reconfigured the stream
+            new_data(2, 3, stream_id=1, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_data(2, 3, stream_id=2, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_data(3, 4, stream_id=2, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            None,
+        ]
+    )
+
+    await runner.run(indexer)
+
+    assert blocks == [1, 2, 3, 4]
+    assert runner.metrics.read_ahead_depth == 0
+
+
+@pytest.mark.asyncio
+async def test_read_ahead_stops_receiving_on_error(storage_url):
+    runner = MockIndexerRunner(
+        reset_state=True,
+        read_ahead=4,
+        config=IndexerRunnerConfiguration(
+            stream_url="http://localhost:5000", storage_url=storage_url
+        ),
+    )
+
+    indexer = MockIndexer()
+
+    async def handle_data(info, data):
+        raise StopIndexer()
+
+    indexer.handle_data = handle_data
+
+    runner.client.configure = MagicMock(return_value=future(None))
+    # the stream never ends, the receiver waits for the next message.
+    runner.stream.put_iter([new_data(0, 1, finality=DataFinality.DATA_STATUS_ACCEPTED)])
+
+    with pytest.raises(StopIndexer):
+        await runner.run(indexer)
+
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    assert pending == []
+
+
+@pytest.mark.asyncio
+async def test_runner_with_process_pool_decoder(storage_url):
+    # decode all messages in the worker processes.
+    decoder = ProcessPoolDecoder(
+        decode_block, transform=block_number, max_workers=2, inline_threshold=0
+    )
+    runner = MockIndexerRunner(
+        reset_state=True,
+        read_ahead=4,
+        decoder=decoder,
+        config=IndexerRunnerConfiguration(
+            stream_url="http://localhost:5000", storage_url=storage_url
+        ),
+    )
+
+    indexer = MockIndexer()
+    blocks = []
+
+    async def handle_data(info, data):
+        blocks.append(data)
+
+    indexer.handle_data = handle_data
+
+    runner.client.configure = MagicMock(return_value=future(None))
+    runner.stream.put_iter(
+        [
+            new_data(i, i + 1, finality=DataFinality.DATA_STATUS_ACCEPTED)
+            for i in range(0, 10)
+        ]
+        + [None]
+    )
+
+    try:
+        await runner.run(indexer)
+    finally:
+        decoder.shutdown()
+
+    assert blocks == list(range(1, 11))
+
+
+def test_runner_rejects_transform_with_batch_size():
+    decoder = ProcessPoolDecoder(decode_block, transform=block_number, max_workers=1)
+    try:
+        with pytest.raises(ValueError):
+            IndexerRunner(batch_size=2, decoder=decoder)
+    finally:
+        decoder.shutdown()
+
+
+def test_runners_share_channel():
+    channel = MagicMock()
+    runners = [
+        IndexerRunner(
+            channel=channel,
+            config=IndexerRunnerConfiguration(storage_url="mongodb://localhost"),
+        )
+        for _ in range(2)
+    ]
+
+    for runner in runners:
+        runner._check_config()
+        (_client, _stream, runner_channel) = runner._stream_data()
+        assert runner_channel is channel
+
+    # one stream for each runner
+    assert channel.stream_stream.return_value.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_runner_with_local_server(storage_url):
+    encoded = [
+        (i, Block(header=BlockHeader(block_number=i)).SerializeToString())
+        for i in range(0, 30)
+    ]
+    async with LocalStreamServer(encoded, finalized=19) as server:
+        runner = IndexerRunner(
+            reset_state=True,
+            batch_size=10,
+            read_ahead=2,
+            config=IndexerRunnerConfiguration(
+                stream_url=server.address, stream_ssl=False, storage_url=storage_url
+            ),
+        )
+
+        indexer = MockIndexer()
+        invalidated = []
+
+        async def handle_data(info, data):
+            await indexer._handle_data(info, data)
+            if data.header.block_number == 25 and not invalidated:
+                server.invalidate(starknet_cursor(22))
+            if data.header.block_number == 29 and invalidated:
+                raise StopIndexer()
+
+        async def handle_invalidate(info, cursor):
+            invalidated.append(cursor.order_key)
+
+        indexer.handle_data = handle_data
+        indexer.handle_invalidate = handle_invalidate
+
+        with pytest.raises(StopIndexer):
+            await runner.run(indexer)
+
+    assert invalidated == [22]
+    blocks = sorted(d["block_number"] for d in await stored_blocks(runner))
+    assert blocks == list(range(1, 30))
+
+
+@pytest.mark.asyncio
+async def test_pending_overlay_between_pending_blocks(storage_url):
+    runner = MockIndexerRunner(
+        reset_state=True,
+        pending_overlay=True,
+        pending_mirror=True,
+        config=IndexerRunnerConfiguration(
+            stream_url="http://localhost:5000", storage_url=storage_url
+        ),
+    )
+
+    indexer = MockIndexer()
+    runner.client.configure = MagicMock(return_value=future(None))
+
+    runner.stream.put_iter(
+        [
+            new_data(0, 1, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_data(1, 2, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_data(2, 3, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_data(3, 4, finality=DataFinality.DATA_STATUS_PENDING),
+            new_data(3, 4, finality=DataFinality.DATA_STATUS_PENDING),
+            None,
+        ]
+    )
+
+    await runner.run(indexer)
+
+    blocks = sorted(d["block_number"] for d in await stored_blocks(runner))
+    if not is_mongo(storage_url):
+        # the in-memory storage writes pending data, it has no overlay.
+        assert blocks == [1, 2, 3, 4]
+        return
+    # pending data is never written to the indexer collections.
+    assert blocks == [1, 2, 3]
+    db = MongoClient(storage_url)["test"]
+    assert db["blocks"].count_documents({}) == 3
+    assert [d["block_number"] for d in db["_pending_blocks"].find()] == [4]
+
+
+@pytest.mark.asyncio
+async def test_skip_unchanged_pending(storage_url):
+    runner = MockIndexerRunner(
+        reset_state=True,
+        skip_unchanged_pending=True,
+        config=IndexerRunnerConfiguration(
+            stream_url="http://localhost:5000", storage_url=storage_url
+        ),
+    )
+
+    indexer = MockIndexer()
+    indexer.handle_pending_data = MagicMock(return_value=future(None))
+    runner.client.configure = MagicMock(return_value=future(None))
+
+    runner.stream.put_iter(
+        [
+            new_data(0, 1, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_data(1, 2, finality=DataFinality.DATA_STATUS_PENDING),
+            new_data(1, 2, finality=DataFinality.DATA_STATUS_PENDING),
+            new_data(1, 2, finality=DataFinality.DATA_STATUS_PENDING),
+            new_data(1, 3, finality=DataFinality.DATA_STATUS_PENDING),
+            new_data(1, 2, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            None,
+        ]
+    )
+
+    await runner.run(indexer)
+
+    assert indexer.handle_pending_data.call_count == 2
+    assert runner.metrics.pending_skipped == 2
+
+
+@pytest.mark.asyncio
+async def test_runner_with_transactions(mongo_replica_set):
+    runner = MockIndexerRunner(
+        reset_state=True,
+        transactions=True,
+        commit_blocks=2,
+        config=IndexerRunnerConfiguration(
+            stream_url="http://localhost:5000", storage_url=mongo_replica_set
+        ),
+    )
+
+    indexer = MockIndexer()
+    runner.client.configure = MagicMock(return_value=future(None))
+
+    runner.stream.put_iter(
+        [
+            new_data(0, 1, finality=DataFinality.DATA_STATUS_FINALIZED),
+            new_data(1, 2, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            new_data(2, 3, finality=DataFinality.DATA_STATUS_PENDING),
+            # invalidates the pending data in a transaction.
+            new_data(2, 3, finality=DataFinality.DATA_STATUS_ACCEPTED),
+            None,
+        ]
+    )
+
+    await runner.run(indexer)
+
+    db = MongoClient(mongo_replica_set)["test"]
+    blocks = sorted(d["block_number"] for d in db["blocks"].find())
+    assert blocks == [1, 2, 3]
+    stored = db["_apibara"].find_one({"indexer_id": "test"})
+    assert stored["cursor"]["order_key"] == 3
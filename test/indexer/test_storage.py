@@ -1,8 +1,19 @@
-from test.conftest import storage
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from test.conftest import buffered_storage, mongo_db, storage
 
 import pytest
 
-from apibara.indexer.storage import IndexerStorage
+from apibara.indexer.backend import DocumentCursor
+from apibara.indexer.memory import InMemoryIndexerStorage
+from apibara.indexer.storage import (
+    IndexerStorage,
+    PendingStorage,
+    _apply_update,
+    _CommitGroup,
+    _with_chain_match,
+)
 from apibara.starknet import starknet_cursor
 
 
@@ -164,3 +175,636 @@ async def test_invalidate(storage: IndexerStorage):
         assert names == ["charlie", "dylan", "elon", "fran", "galois"]
         charlie = await s.find_one("capibaras", {"name": "charlie"})
         assert charlie["age"] == 5
+
+
+@pytest.mark.asyncio
+async def test_buffered_writes_read_your_writes(buffered_storage: IndexerStorage):
+    with buffered_storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_many(
+            "capibaras",
+            [
+                {"name": "bob", "age": 3},
+                {"name": "charlie", "age": 4},
+            ],
+        )
+        assert s._queued
+        bob = await s.find_one("capibaras", {"name": "bob"})
+        assert bob["age"] == 3
+        assert not s._queued
+
+        await s.find_one_and_update("capibaras", {"name": "bob"}, {"$set": {"age": 5}})
+        await s.delete_one("capibaras", {"name": "charlie"})
+        assert buffered_storage.db["capibaras"].count_documents({}) == 2
+
+    with buffered_storage.create_storage_for_block(starknet_cursor(101)) as s:
+        capybaras = list(await s.find("capibaras", {}))
+        assert [(c["name"], c["age"]) for c in capybaras] == [("bob", 5)]
+
+
+@pytest.mark.asyncio
+async def test_buffered_writes_invalidate(buffered_storage: IndexerStorage):
+    with buffered_storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_many(
+            "capibaras",
+            [
+                {"name": "bob", "age": 3},
+                {"name": "charlie", "age": 4},
+            ],
+        )
+
+    with buffered_storage.create_storage_for_block(starknet_cursor(101)) as s:
+        await s.insert_one("capibaras", {"name": "dylan", "age": 8})
+        await s.find_one_and_replace(
+            "capibaras", {"name": "bob"}, {"name": "bob", "age": 10}
+        )
+        await s.delete_many("capibaras", {"age": {"$gte": 4}})
+
+    buffered_storage.invalidate(starknet_cursor(100))
+
+    with buffered_storage.create_storage_for_block(starknet_cursor(101)) as s:
+        capybaras = list(await s.find("capibaras", {}, sort={"name": 1}))
+        assert [(c["name"], c["age"]) for c in capybaras] == [
+            ("bob", 3),
+            ("charlie", 4),
+        ]
+
+
+@pytest.mark.asyncio
+async def test_storage_executor(mongo_db):
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage") as executor:
+        storage = IndexerStorage(mongo_db, "python-sdk-test-db", executor=executor)
+        threads = []
+        create_indexes = storage._registry._create_indexes
+
+        def record_create_indexes(collection):
+            threads.append(threading.current_thread().name)
+            create_indexes(collection)
+
+        storage._registry._create_indexes = record_create_indexes
+
+        with storage.create_storage_for_block(starknet_cursor(100)) as s:
+            await s.insert_one("capibaras", {"name": "bob", "age": 3})
+            await s.find_one_and_update(
+                "capibaras", {"name": "bob"}, {"$set": {"age": 4}}
+            )
+        # the indexes of new collections are created in the executor.
+        assert len(threads) == 1 and threads[0].startswith("storage")
+
+        with storage.create_storage_for_block(starknet_cursor(101)) as s:
+            capybaras = await s.find("capibaras", {})
+            assert [c["age"] for c in capybaras] == [4]
+            bob = await s.find_one("capibaras", {"name": "bob"})
+            assert bob["age"] == 4
+
+        with storage.create_storage_for_block(starknet_cursor(102)) as s:
+            await s.insert_one("capibaras", {"name": "charlie", "age": 5})
+        await storage._run(storage.invalidate, starknet_cursor(101))
+        with storage.create_storage_for_block(starknet_cursor(102)) as s:
+            capybaras = await s.find("capibaras", {})
+            assert [c["name"] for c in capybaras] == ["bob"]
+
+        storage.drop_database()
+
+
+@pytest.mark.asyncio
+async def test_invalidate_skips_clean_collections(storage: IndexerStorage):
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_one("capibaras", {"name": "bob", "age": 3})
+        await s.insert_one("owners", {"name": "alice"})
+
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        await s.insert_one("capibaras", {"name": "charlie", "age": 4})
+
+    index_names = storage.db["capibaras"].index_information().keys()
+    assert "_chain.valid_from_1" in index_names
+    assert "_chain.valid_to_1" in index_names
+
+    assert storage._registry.written_after(101) == ["capibaras"]
+    storage.invalidate(starknet_cursor(101))
+    assert storage._registry.written_after(101) == []
+
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        capybaras = list(await s.find("capibaras", {}))
+        assert [c["name"] for c in capybaras] == ["bob"]
+
+
+@pytest.mark.asyncio
+async def test_invalidate_after_restart(mongo_db):
+    storage = IndexerStorage(mongo_db, "python-sdk-test-db")
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_one("capibaras", {"name": "bob", "age": 3})
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        await s.insert_one("capibaras", {"name": "charlie", "age": 4})
+
+    # collections written before the restart are visited by the first invalidate.
+    restarted = IndexerStorage(mongo_db, "python-sdk-test-db")
+    assert restarted._registry.written_after(101) == ["capibaras"]
+    restarted.invalidate(starknet_cursor(101))
+    assert restarted._registry.written_after(101) == []
+
+    with restarted.create_storage_for_block(starknet_cursor(102)) as s:
+        capybaras = list(await s.find("capibaras", {}))
+        assert [c["name"] for c in capybaras] == ["bob"]
+
+    restarted.drop_database()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("buffer_writes", [False, True])
+async def test_undo_log_invalidate(mongo_db, buffer_writes):
+    storage = IndexerStorage(
+        mongo_db, "python-sdk-test-db", undo_log=True, buffer_writes=buffer_writes
+    )
+    with storage.create_storage_for_data(starknet_cursor(100), finalized=True) as s:
+        await s.insert_many(
+            "capibaras",
+            [
+                {"name": "bob", "age": 3},
+                {"name": "charlie", "age": 4},
+                {"name": "dylan", "age": 8},
+            ],
+        )
+    # finalized blocks are not recorded.
+    assert storage.db["_apibara_undo"].count_documents({}) == 0
+
+    with storage.create_storage_for_data(starknet_cursor(101)) as s:
+        await s.insert_one("capibaras", {"name": "elon", "age": 3})
+        await s.delete_one("capibaras", {"name": "bob"})
+        await s.find_one_and_update(
+            "capibaras", {"name": "charlie"}, {"$set": {"age": 5}}
+        )
+
+    with storage.create_storage_for_data(starknet_cursor(102)) as s:
+        await s.delete_many("capibaras", {"age": {"$gte": 5}})
+        await s.find_one_and_replace(
+            "capibaras", {"name": "elon"}, {"name": "elon", "age": 4}
+        )
+
+    storage.invalidate(starknet_cursor(101))
+    assert storage.db["_apibara_undo"].count_documents({"block": {"$gt": 101}}) == 0
+
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        capybaras = list(await s.find("capibaras", {}, sort={"name": 1}))
+        assert [(c["name"], c["age"]) for c in capybaras] == [
+            ("charlie", 5),
+            ("dylan", 8),
+            ("elon", 3),
+        ]
+
+    # records are pruned once the block is finalized.
+    with storage.create_storage_for_data(starknet_cursor(102), finalized=True):
+        pass
+    assert storage.db["_apibara_undo"].count_documents({}) == 0
+
+    storage.drop_database()
+
+
+def test_commit_group():
+    group = _CommitGroup(3, None)
+    group.add()
+    group.add()
+    assert not group.is_full()
+    group.add()
+    assert group.is_full()
+    group.reset()
+    assert not group.is_full()
+
+    group = _CommitGroup(100, 0.01)
+    group.add()
+    assert not group.is_full()
+    time.sleep(0.02)
+    assert group.is_full()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("buffer_writes", [False, True])
+async def test_coalesce_updates_in_block(mongo_db, buffer_writes):
+    storage = IndexerStorage(
+        mongo_db, "python-sdk-test-db", buffer_writes=buffer_writes
+    )
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_one("pools", {"name": "eth-usdc", "reserve": 10})
+        await s.find_one_and_update(
+            "pools", {"name": "eth-usdc"}, {"$inc": {"reserve": 1}}
+        )
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        for _ in range(5):
+            await s.find_one_and_update(
+                "pools", {"name": "eth-usdc"}, {"$inc": {"reserve": 1}}
+            )
+        await s.find_one_and_replace(
+            "pools", {"name": "eth-usdc"}, {"name": "eth-usdc", "reserve": 20}
+        )
+        await s.find_one_and_update(
+            "pools", {"name": "eth-usdc"}, {"$push": {"log": 1}}
+        )
+
+    versions = list(storage.db["pools"].find({}, sort=[("_chain.valid_from", 1)]))
+    assert [(v["reserve"], v["_chain"]) for v in versions] == [
+        (11, {"valid_from": 100, "valid_to": 101}),
+        (20, {"valid_from": 101, "valid_to": None}),
+    ]
+    assert versions[1]["log"] == [1]
+
+    storage.invalidate(starknet_cursor(100))
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        pool = await s.find_one("pools", {"name": "eth-usdc"})
+        assert pool["reserve"] == 11
+
+    storage.drop_database()
+
+
+def test_apply_update():
+    doc = {"a": 1, "b": {"c": 2}, "d": "x"}
+    updated = _apply_update(
+        doc, {"$set": {"b.e": 3}, "$inc": {"a": 2, "b.c": 1}, "$unset": {"d": ""}}
+    )
+    assert updated == {"a": 3, "b": {"c": 3, "e": 3}}
+    assert doc == {"a": 1, "b": {"c": 2}, "d": "x"}
+    assert _apply_update(doc, {"$push": {"f": 1}}) is None
+    assert _apply_update(doc, {"$inc": {"d": 1}}) is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("retention", [0, 2])
+async def test_retention(mongo_db, retention):
+    storage = IndexerStorage(mongo_db, "python-sdk-test-db", retention=retention)
+    with storage.create_storage_for_data(starknet_cursor(100), finalized=True) as s:
+        await s.insert_one("pools", {"name": "eth-usdc", "reserve": 0})
+    for block in range(101, 106):
+        with storage.create_storage_for_data(
+            starknet_cursor(block), finalized=block <= 104
+        ) as s:
+            await s.find_one_and_update(
+                "pools", {"name": "eth-usdc"}, {"$set": {"reserve": block}}
+            )
+    storage._compactor.wait()
+
+    versions = storage.db["pools"].find({}, sort=[("_chain.valid_from", 1)])
+    reserves = [v["reserve"] for v in versions]
+    # version 104 was replaced at block 105, which is not finalized.
+    assert reserves == [0, 101, 102, 103, 104, 105][4 - retention :]
+
+    storage.drop_database()
+
+
+@pytest.mark.asyncio
+async def test_retention_finality_depth(mongo_db):
+    storage = IndexerStorage(
+        mongo_db, "python-sdk-test-db", retention=0, finality_depth=2
+    )
+    # no data is finalized, blocks up to 103 are assumed final.
+    with storage.create_storage_for_data(starknet_cursor(100)) as s:
+        await s.insert_one("pools", {"name": "eth-usdc", "reserve": 0})
+    for block in range(101, 106):
+        with storage.create_storage_for_data(starknet_cursor(block)) as s:
+            await s.find_one_and_update(
+                "pools", {"name": "eth-usdc"}, {"$set": {"reserve": block}}
+            )
+    storage._compactor.wait()
+
+    versions = storage.db["pools"].find({}, sort=[("_chain.valid_from", 1)])
+    assert [v["reserve"] for v in versions] == [103, 104, 105]
+
+    storage.drop_database()
+
+
+@pytest.mark.asyncio
+async def test_as_of_before_retention(mongo_db):
+    storage = IndexerStorage(mongo_db, "python-sdk-test-db", retention=1)
+    for block in range(100, 104):
+        with storage.create_storage_for_data(
+            starknet_cursor(block), finalized=True
+        ) as s:
+            await s.insert_one("pools", {"name": f"pool-{block}"})
+    storage._compactor.wait()
+
+    with storage.create_storage_for_block(starknet_cursor(104)) as s:
+        assert await s.find_one("pools", {"name": "pool-100"}, as_of=102) is not None
+        # versions replaced before block 102 may have been deleted.
+        with pytest.raises(ValueError):
+            await s.find_one("pools", {"name": "pool-100"}, as_of=101)
+        with pytest.raises(ValueError):
+            await s.find("pools", {}, as_of=101)
+        with pytest.raises(ValueError):
+            await s.aggregate("pools", [], as_of=101)
+
+    storage.drop_database()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("buffer_writes", [False, True])
+async def test_document_cache(mongo_db, buffer_writes):
+    storage = IndexerStorage(
+        mongo_db,
+        "python-sdk-test-db",
+        buffer_writes=buffer_writes,
+        cache={"balances": "address"},
+    )
+    stats = storage.cache_stats()["balances"]
+
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_one("balances", {"address": "0x1", "balance": 10})
+        assert (await s.find_one("balances", {"address": "0x1"}))["balance"] == 10
+        assert await s.find_one("balances", {"address": "0x2"}) is None
+        assert stats.hits == 1
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        for _ in range(3):
+            await s.find_one_and_update(
+                "balances", {"address": "0x1"}, {"$inc": {"balance": 1}}
+            )
+        await s.find_one_and_update(
+            "balances", {"address": "0x2"}, {"$inc": {"balance": 1}}
+        )
+        assert (await s.find_one("balances", {"address": "0x1"}))["balance"] == 13
+        assert stats.misses == 1
+
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        await s.delete_one("balances", {"address": "0x1"})
+        assert await s.find_one("balances", {"address": "0x1"}) is None
+
+    # the cache matches the database.
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        docs = list(await s.find("balances", {}))
+        assert docs == []
+
+    storage.invalidate(starknet_cursor(100))
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        assert (await s.find_one("balances", {"address": "0x1"}))["balance"] == 10
+        assert stats.misses == 2
+
+    storage.drop_database()
+
+
+@pytest.mark.asyncio
+async def test_prefetch(storage: IndexerStorage):
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_many(
+            "pools",
+            [
+                {"address": "0x1", "reserve": 10},
+                {"address": "0x2", "reserve": 20},
+            ],
+        )
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        await s.prefetch("pools", "address", ["0x1", "0x2", "0x3"])
+        # change the database, reads are served from the prefetched documents.
+        storage.db["pools"].update_many({}, {"$set": {"reserve": 0}})
+        assert (await s.find_one("pools", {"address": "0x1"}))["reserve"] == 10
+        assert await s.find_one("pools", {"address": "0x3"}) is None
+
+        await s.find_one_and_update(
+            "pools", {"address": "0x2"}, {"$inc": {"reserve": 1}}
+        )
+        assert (await s.find_one("pools", {"address": "0x2"}))["reserve"] == 21
+
+        with pytest.raises(ValueError):
+            await s.prefetch("pools", "name", ["a"])
+
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        assert (await s.find_one("pools", {"address": "0x1"}))["reserve"] == 0
+
+
+@pytest.mark.asyncio
+async def test_pending_overlay(mongo_db):
+    storage = IndexerStorage(
+        mongo_db, "test", pending_overlay=True, pending_mirror=True
+    )
+    storage.drop_database()
+
+    with storage.create_storage_for_data(starknet_cursor(100)) as s:
+        await s.insert_many(
+            "capibaras",
+            [
+                {"name": "bob", "age": 3},
+                {"name": "charlie", "age": 4},
+                {"name": "dylan", "age": 8},
+            ],
+        )
+
+    with storage.create_storage_for_pending(starknet_cursor(101)) as s:
+        await s.insert_one("capibaras", {"name": "alice", "age": 1})
+        await s.find_one_and_update("capibaras", {"name": "bob"}, {"$inc": {"age": 1}})
+        await s.delete_many("capibaras", {"age": {"$gte": 8}})
+
+        found = await s.find("capibaras", {}, sort={"name": 1})
+        assert [(d["name"], d["age"]) for d in found] == [
+            ("alice", 1),
+            ("bob", 4),
+            ("charlie", 4),
+        ]
+        assert (await s.find_one("capibaras", {"name": "bob"}))["age"] == 4
+        assert await s.find_one("capibaras", {"name": "dylan"}) is None
+
+    # pending changes are only visible in the mirror.
+    stored = list(storage.db["capibaras"].find({"_chain.valid_to": None}))
+    assert sorted(d["name"] for d in stored) == ["bob", "charlie", "dylan"]
+    mirror = list(storage.db["_pending_capibaras"].find({"_chain.valid_to": None}))
+    assert sorted(d["name"] for d in mirror) == ["alice", "bob"]
+
+    storage.discard_pending(starknet_cursor(100))
+    assert storage.db["_pending_capibaras"].count_documents({}) == 0
+
+    # invalidations also discard the mirrored pending data.
+    with storage.create_storage_for_pending(starknet_cursor(101)) as s:
+        await s.insert_one("capibaras", {"name": "alice", "age": 1})
+    assert storage.db["_pending_capibaras"].count_documents({}) == 1
+    storage.invalidate(starknet_cursor(100))
+    assert storage.db["_pending_capibaras"].count_documents({}) == 0
+    storage.drop_database()
+
+
+@pytest.fixture
+def memory_base():
+    storage = InMemoryIndexerStorage("memory://test", "pending-test")
+    storage.drop_database()
+    with storage.create_storage_for_data(starknet_cursor(100)) as s:
+        yield s
+    storage.drop_database()
+
+
+@pytest.mark.asyncio
+async def test_pending_storage_reads_through(memory_base):
+    await memory_base.insert_many(
+        "capibaras", [{"name": "bob", "age": 3}, {"name": "charlie", "age": 4}]
+    )
+    pending = PendingStorage(memory_base, starknet_cursor(101))
+
+    assert (await pending.find_one("capibaras", {"name": "bob"}))["age"] == 3
+    found = await pending.find("capibaras", {"age": {"$gte": 3}}, sort={"age": -1})
+    assert [d["name"] for d in found] == ["charlie", "bob"]
+    # reads don't copy documents to the overlay.
+    assert pending.collections() == []
+
+
+@pytest.mark.asyncio
+async def test_pending_storage_overlay(memory_base):
+    await memory_base.insert_many(
+        "capibaras",
+        [
+            {"name": "bob", "age": 3},
+            {"name": "charlie", "age": 4},
+            {"name": "dylan", "age": 8},
+        ],
+    )
+    pending = PendingStorage(memory_base, starknet_cursor(101))
+    await pending.insert_one("capibaras", {"name": "alice", "age": 1})
+    await pending.find_one_and_update(
+        "capibaras", {"name": "bob"}, {"$inc": {"age": 1}}
+    )
+    await pending.find_one_and_replace(
+        "capibaras", {"name": "charlie"}, {"name": "charlie", "age": 9}
+    )
+    await pending.delete_one("capibaras", {"name": "dylan"})
+
+    found = await pending.find("capibaras", {}, sort={"name": 1}, skip=1, limit=2)
+    assert [(d["name"], d["age"]) for d in found] == [("bob", 4), ("charlie", 9)]
+    assert await pending.find_one("capibaras", {"name": "dylan"}) is None
+    assert await pending.find_one("capibaras", {"age": 3}) is None
+
+    # the base storage is never modified.
+    stored = await memory_base.find("capibaras", {}, sort={"name": 1})
+    assert [(d["name"], d["age"]) for d in stored] == [
+        ("bob", 3),
+        ("charlie", 4),
+        ("dylan", 8),
+    ]
+
+    # stored documents changed by the overlay are closed at the pending block.
+    docs = pending.documents("capibaras")
+    current = sorted(d["name"] for d in docs if d["_chain"]["valid_to"] is None)
+    assert current == ["alice", "bob", "charlie"]
+    closed = sorted(d["name"] for d in docs if d["_chain"]["valid_to"] == 101)
+    assert closed == ["bob", "charlie", "dylan"]
+
+
+@pytest.mark.asyncio
+async def test_pending_storage_aggregate(memory_base):
+    pending = PendingStorage(memory_base, starknet_cursor(101))
+    with pytest.raises(NotImplementedError, match="pending_overlay"):
+        await pending.aggregate("capibaras", [{"$match": {"age": 3}}])
+
+
+@pytest.mark.asyncio
+async def test_find_as_of(storage: IndexerStorage):
+    with storage.create_storage_for_data(starknet_cursor(100)) as s:
+        await s.insert_one("capibaras", {"name": "bob", "age": 3})
+        await s.insert_one("capibaras", {"name": "charlie", "age": 4})
+
+    with storage.create_storage_for_data(starknet_cursor(102)) as s:
+        await s.find_one_and_update("capibaras", {"name": "bob"}, {"$inc": {"age": 1}})
+        await s.delete_one("capibaras", {"name": "charlie"})
+
+    name = storage.create_as_of_index("capibaras", ["name"])
+    assert name in storage.db["capibaras"].index_information()
+
+    with storage.create_storage_for_block(starknet_cursor(103)) as s:
+        assert await s.find_one("capibaras", {"name": "bob"}, as_of=99) is None
+        assert (await s.find_one("capibaras", {"name": "bob"}, as_of=101))["age"] == 3
+        assert (await s.find_one("capibaras", {"name": "bob"}, as_of=102))["age"] == 4
+        assert (await s.find_one("capibaras", {"name": "bob"}))["age"] == 4
+
+        found = await s.find("capibaras", {}, sort={"name": 1}, as_of=101)
+        assert [d["name"] for d in found] == ["bob", "charlie"]
+        found = await s.find("capibaras", {}, sort={"name": 1}, as_of=102)
+        assert [d["name"] for d in found] == ["bob"]
+
+
+@pytest.mark.asyncio
+async def test_find_async_iteration(storage: IndexerStorage):
+    with storage.create_storage_for_block(starknet_cursor(100)) as s:
+        await s.insert_many("capibaras", [{"age": age} for age in range(10)])
+
+    with storage.create_storage_for_block(starknet_cursor(101)) as s:
+        cursor = await s.find("capibaras", {}, sort={"age": 1}, batch_size=3)
+        assert [doc["age"] async for doc in cursor] == list(range(10))
+
+        async with await s.find("capibaras", {}, batch_size=3) as cursor:
+            async for doc in cursor:
+                break
+        assert list(cursor) == []
+
+
+@pytest.mark.asyncio
+async def test_document_cursor_batches():
+    batches = []
+
+    async def run(fn):
+        batch = fn()
+        batches.append(len(batch))
+        return batch
+
+    cursor = DocumentCursor(iter(range(7)), batch_size=3, run=run)
+    assert await cursor.to_list() == list(range(7))
+    assert batches == [3, 3, 1]
+
+
+@pytest.mark.asyncio
+async def test_aggregate(storage: IndexerStorage):
+    with storage.create_storage_for_data(starknet_cursor(100)) as s:
+        await s.insert_many(
+            "transfers",
+            [
+                {"token": "a", "amount": 1},
+                {"token": "a", "amount": 2},
+                {"token": "b", "amount": 5},
+            ],
+        )
+
+    with storage.create_storage_for_data(starknet_cursor(101)) as s:
+        await s.delete_one("transfers", {"token": "b"})
+        await s.insert_one("transfers", {"token": "a", "amount": 4})
+
+    pipeline = [
+        {"$group": {"_id": "$token", "total": {"$sum": "$amount"}}},
+        {"$sort": {"_id": 1}},
+    ]
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        cursor = await s.aggregate("transfers", pipeline, allow_disk_use=True)
+        assert [(d["_id"], d["total"]) async for d in cursor] == [("a", 7)]
+
+        cursor = await s.aggregate("transfers", pipeline, as_of=100, batch_size=1)
+        assert [(d["_id"], d["total"]) async for d in cursor] == [("a", 3), ("b", 5)]
+
+
+def test_with_chain_match():
+    near = {"$geoNear": {"near": [0, 0], "distanceField": "d"}}
+    assert _with_chain_match([near]) == [near, {"$match": {"_chain.valid_to": None}}]
+    assert _with_chain_match([]) == [{"$match": {"_chain.valid_to": None}}]
+
+    # the match stage goes after stages that must be first, before the others.
+    search = {"$search": {"text": {"query": "bob", "path": "name"}}}
+    limit = {"$limit": 10}
+    pipeline = _with_chain_match([search, limit], as_of=100)
+    assert pipeline[0] == search
+    assert pipeline[1]["$match"]["_chain.valid_from"] == {"$lte": 100}
+    assert pipeline[2] == limit
+    assert _with_chain_match([limit])[1] == limit
+
+    with pytest.raises(ValueError):
+        _with_chain_match([{"$searchMeta": {"count": {"type": "total"}}}])
+
+
+@pytest.mark.asyncio
+async def test_undo_log_finality_depth(mongo_db):
+    storage = IndexerStorage(
+        mongo_db, "python-sdk-test-db", undo_log=True, finality_depth=2
+    )
+    for block in range(100, 105):
+        with storage.create_storage_for_data(starknet_cursor(block)) as s:
+            await s.insert_one("capibaras", {"name": f"bob-{block}", "age": block})
+
+    # records are removed even if no block is finalized.
+    records = storage.db["_apibara_undo"].find({})
+    assert sorted(r["block"] for r in records) == [103, 104]
+
+    # invalidating deeper than the undo log visits the collections instead.
+    storage.invalidate(starknet_cursor(101))
+    with storage.create_storage_for_block(starknet_cursor(102)) as s:
+        capybaras = list(await s.find("capibaras", {}, sort={"age": 1}))
+        assert [c["name"] for c in capybaras] == ["bob-100", "bob-101"]
+
+    storage.drop_database()
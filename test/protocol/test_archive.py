@@ -0,0 +1,71 @@
+import pytest
+
+from apibara.protocol.archive import ArchiveReader, ArchiveWriter
+from apibara.protocol.proto.stream_pb2 import Cursor, Data
+
+
+def payload(order_key: int) -> bytes:
+    return f"block-{order_key}".encode() * order_key
+
+
+def test_archive_read_range(tmp_path):
+    with ArchiveWriter(tmp_path, segment_size=256) as writer:
+        for order_key in range(0, 100, 2):
+            writer.append(order_key, payload(order_key))
+
+    assert len(list(tmp_path.glob("segment-*.bin"))) > 1
+
+    with ArchiveReader(tmp_path) as reader:
+        assert len(reader) == 50
+        assert reader.first_order_key == 0
+        assert reader.last_order_key == 98
+
+        items = [(key, bytes(data)) for key, data in reader.read(11, 21)]
+        assert items == [(key, payload(key)) for key in range(12, 21, 2)]
+
+        assert [key for key, _ in reader.read(95)] == [96, 98]
+        assert len(list(reader.read())) == 50
+
+
+def test_archive_append_after_reopen(tmp_path):
+    with ArchiveWriter(tmp_path) as writer:
+        writer.append(1, payload(1))
+        writer.append_data(
+            Data(end_cursor=Cursor(order_key=2), data=[payload(2)]),
+        )
+
+    # simulate a crash while writing a payload.
+    with open(tmp_path / "segment-000000.bin", "ab") as f:
+        f.write(b"garbage")
+
+    with ArchiveWriter(tmp_path) as writer:
+        assert writer.last_order_key == 2
+        with pytest.raises(ValueError):
+            writer.append(2, payload(2))
+        writer.append_data(
+            Data(data=[b"3", b"4"]),
+            order_key=int,
+        )
+
+    with ArchiveReader(tmp_path) as reader:
+        items = [(key, bytes(data)) for key, data in reader.read()]
+        assert items == [(1, payload(1)), (2, payload(2)), (3, b"3"), (4, b"4")]
+
+
+def test_archive_recover_index_ahead_of_segment(tmp_path):
+    with ArchiveWriter(tmp_path) as writer:
+        for order_key in range(1, 4):
+            writer.append(order_key, payload(order_key))
+
+    # simulate a crash after the index was written but not the segment.
+    segment = tmp_path / "segment-000000.bin"
+    with open(segment, "r+b") as f:
+        f.truncate(segment.stat().st_size - 1)
+
+    with ArchiveWriter(tmp_path) as writer:
+        assert writer.last_order_key == 2
+        writer.append(3, b"3")
+
+    with ArchiveReader(tmp_path) as reader:
+        items = [(key, bytes(data)) for key, data in reader.read()]
+        assert items == [(1, payload(1)), (2, payload(2)), (3, b"3")]
@@ -0,0 +1,113 @@
+import pytest
+from grpc.aio import insecure_channel
+
+from apibara.protocol import BlockCache, StreamService
+from apibara.protocol.proto.stream_pb2 import Cursor, Heartbeat, StreamDataResponse
+from apibara.protocol.server import LocalStreamServer
+
+
+def blocks(count, prefix=b""):
+    return [(i, prefix + str(i).encode()) for i in range(count)]
+
+
+async def collect(server, cache, count, cursor=None, batch_size=2):
+    items = []
+    async with insecure_channel(server.address) as channel:
+        (client, stream) = StreamService(channel).stream_data(timeout=1.0)
+        (client, stream) = cache.wrap(client, stream)
+        await client.configure(filter=b"f", batch_size=batch_size, cursor=cursor)
+        async for message in stream:
+            if message.HasField("data"):
+                assert message.stream_id == 1
+                assert len(message.data.data) <= batch_size
+                items.extend(message.data.data)
+                if len(items) >= count:
+                    return items
+
+
+@pytest.mark.asyncio
+async def test_block_cache_read_through(tmp_path):
+    cache = BlockCache(tmp_path)
+
+    async with LocalStreamServer(blocks(20), finalized=13) as server:
+        items = await collect(server, cache, 20)
+    assert items == [str(i).encode() for i in range(20)]
+
+    # finalized data is served from the cache, the rest from the server.
+    async with LocalStreamServer(blocks(20, b"live-"), finalized=13) as server:
+        items = await collect(server, cache, 20)
+    assert items[:14] == [str(i).encode() for i in range(14)]
+    assert items[14:] == [b"live-" + str(i).encode() for i in range(14, 20)]
+
+    async with LocalStreamServer(blocks(20, b"live-"), finalized=13) as server:
+        items = await collect(server, cache, 10, cursor=Cursor(order_key=5))
+    assert items[:8] == [str(i).encode() for i in range(6, 14)]
+    assert items[8:] == [b"live-14", b"live-15"]
+
+
+@pytest.mark.asyncio
+async def test_block_cache_batch_size(tmp_path):
+    cache = BlockCache(tmp_path)
+
+    async with LocalStreamServer(blocks(20), finalized=13) as server:
+        items = await collect(server, cache, 20, batch_size=2)
+    assert items == [str(i).encode() for i in range(20)]
+
+    # data cached with another batch size is not replayed.
+    async with LocalStreamServer(blocks(20, b"live-"), finalized=13) as server:
+        items = await collect(server, cache, 20, batch_size=1)
+    assert items == [b"live-" + str(i).encode() for i in range(20)]
+
+    async with LocalStreamServer(blocks(20, b"other-"), finalized=13) as server:
+        items = await collect(server, cache, 20, batch_size=1)
+    assert items[:14] == [b"live-" + str(i).encode() for i in range(14)]
+
+    async with LocalStreamServer(blocks(20, b"other-"), finalized=13) as server:
+        items = await collect(server, cache, 20, batch_size=2)
+    assert items[:14] == [str(i).encode() for i in range(14)]
+
+
+class FakeClient:
+    def __init__(self):
+        self.requests = []
+
+    async def configure(self, **request):
+        self.requests.append(request)
+
+
+class FakeStream:
+    def __init__(self, messages):
+        self._messages = iter(messages)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = next(self._messages, None)
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+
+@pytest.mark.asyncio
+async def test_block_cache_keeps_stale_stream_ids(tmp_path):
+    def heartbeat(stream_id):
+        return StreamDataResponse(stream_id=stream_id, heartbeat=Heartbeat())
+
+    inner = FakeClient()
+    # the second message was sent before the wrapped client was configured again.
+    stream = FakeStream([heartbeat(1), heartbeat(1), heartbeat(2)])
+    (client, stream) = BlockCache(tmp_path).wrap(inner, stream)
+
+    await client.configure(filter=b"f")
+    messages = stream.__aiter__()
+    assert (await messages.__anext__()).stream_id == 1
+    await client.configure(filter=b"f")
+    assert (await messages.__anext__()).stream_id == 0
+    assert (await messages.__anext__()).stream_id == 2
+    assert len(inner.requests) == 2
+
+    with pytest.raises(StopAsyncIteration):
+        await messages.__anext__()
+    # the archive is closed when the stream ends.
+    assert client._writer is None
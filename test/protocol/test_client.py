@@ -0,0 +1,178 @@
+import asyncio
+import time
+
+import pytest
+
+from apibara.protocol.client import StreamIter, StreamService, _Context
+from apibara.protocol.proto.stream_pb2 import (
+    Cursor,
+    Data,
+    Heartbeat,
+    StreamDataResponse,
+)
+
+
+class MockInnerStream:
+    def __init__(self, items):
+        self._items = items
+
+    async def __aiter__(self):
+        for delay, item in self._items:
+            await asyncio.sleep(delay)
+            yield item
+
+
+def heartbeat(stream_id):
+    return StreamDataResponse(stream_id=stream_id, heartbeat=Heartbeat())
+
+
+@pytest.mark.asyncio
+async def test_stream_iter_skips_other_streams():
+    ctx = _Context()
+    ctx.stream_id = 2
+    inner = MockInnerStream(
+        [(0, heartbeat(1)), (0, heartbeat(2)), (0, heartbeat(1)), (0, heartbeat(2))]
+    )
+    stream = StreamIter(ctx, inner, timeout=1.0)
+    messages = [message async for message in stream]
+    assert [m.stream_id for m in messages] == [2, 2]
+
+
+@pytest.mark.asyncio
+async def test_stream_iter_timeout_is_reset_by_messages():
+    ctx = _Context()
+    # each message arrives before the timeout, but the sum of delays is larger
+    inner = MockInnerStream(
+        [(0.05, heartbeat(1)) for _ in range(6)] + [(0.05, heartbeat(0))]
+    )
+    stream = StreamIter(ctx, inner, timeout=0.1)
+    messages = [message async for message in stream]
+    assert len(messages) == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_iter_timeout():
+    ctx = _Context()
+    inner = MockInnerStream([(0, heartbeat(0)), (1.0, heartbeat(0))])
+    stream = StreamIter(ctx, inner, timeout=0.1)
+    stream = stream.__aiter__()
+    await stream.__anext__()
+    with pytest.raises(asyncio.TimeoutError):
+        await stream.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_stream_iter_timeout_only_while_waiting():
+    ctx = _Context()
+    inner = MockInnerStream([(0, heartbeat(0)), (0, heartbeat(0))])
+    stream = StreamIter(ctx, inner, timeout=0.1).__aiter__()
+    await stream.__anext__()
+    # simulate a slow handler
+    await asyncio.sleep(0.2)
+    await stream.__anext__()
+
+
+class MockImmutableStreamService(StreamService):
+    """Streams blocks up to `head`, encoding the block number as data."""
+
+    def __init__(self, head: int, latency: float = 0.0):
+        self.head = head
+        self.latency = latency
+        self.cursors = []
+        self.active = 0
+        self.max_active = 0
+
+    async def stream_data_immutable(self, *, cursor=None, batch_size=None, **kwargs):
+        self.cursors.append(cursor)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            async for message in self._messages(cursor, batch_size):
+                yield message
+        finally:
+            self.active -= 1
+
+    async def _messages(self, cursor, batch_size):
+        block = 0 if cursor is None else cursor.order_key + 1
+        while block <= self.head:
+            await asyncio.sleep(self.latency)
+            items = list(range(block, min(block + batch_size, self.head + 1)))
+            yield StreamDataResponse(heartbeat=Heartbeat())
+            yield StreamDataResponse(
+                data=Data(
+                    cursor=Cursor(order_key=max(block - 1, 0)),
+                    end_cursor=Cursor(order_key=items[-1]),
+                    data=[str(i).encode() for i in items],
+                )
+            )
+            block = items[-1] + 1
+
+
+@pytest.mark.asyncio
+async def test_stream_data_partitioned_is_ordered():
+    service = MockImmutableStreamService(head=100)
+    blocks = []
+    async for data in service.stream_data_partitioned(
+        start_block=0,
+        end_block=20,
+        order_key=int,
+        partitions=3,
+        batch_size=3,
+        chunk_size=7,
+    ):
+        blocks.extend(int(item) for item in data.data)
+        assert data.end_cursor.order_key == blocks[-1]
+
+    assert blocks == list(range(0, 20))
+    assert [c.order_key if c else None for c in service.cursors] == [None, 6, 13]
+
+
+async def partitioned_blocks(service, partitions, **kwargs):
+    blocks = []
+    async for data in service.stream_data_partitioned(
+        start_block=0,
+        end_block=200,
+        order_key=int,
+        partitions=partitions,
+        batch_size=1,
+        chunk_size=10,
+        **kwargs,
+    ):
+        blocks.extend(int(item) for item in data.data)
+    return blocks
+
+
+@pytest.mark.asyncio
+async def test_stream_data_partitioned_overlaps_streams():
+    timings = {}
+    for partitions in (1, 4):
+        service = MockImmutableStreamService(head=1000, latency=0.002)
+        started = time.monotonic()
+        blocks = await partitioned_blocks(service, partitions)
+        timings[partitions] = time.monotonic() - started
+        assert blocks == list(range(0, 200))
+        assert service.max_active == partitions
+        assert len(service.cursors) == 20
+
+    # streams keep running while the data of the first chunk is returned.
+    assert timings[4] < timings[1] / 2
+
+
+@pytest.mark.asyncio
+async def test_stream_data_partitioned_stops_streams():
+    service = MockImmutableStreamService(head=1000, latency=0.001)
+    stream = service.stream_data_partitioned(
+        start_block=0,
+        end_block=200,
+        order_key=int,
+        partitions=4,
+        batch_size=1,
+        chunk_size=10,
+    )
+    async for _ in stream:
+        break
+    await stream.aclose()
+
+    assert service.active == 0
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    assert pending == []
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+from grpc import StatusCode
+from grpc.aio import AioRpcError, insecure_channel
+
+from apibara.protocol import StreamService
+from apibara.protocol.proto.stream_pb2 import Cursor, DataFinality
+from apibara.protocol.server import LocalStreamServer
+
+
+def blocks(count):
+    return [(i, str(i).encode()) for i in range(count)]
+
+
+async def next_message(stream, kind="data"):
+    async for message in stream:
+        if message.HasField(kind):
+            return message
+
+
+@pytest.mark.asyncio
+async def test_local_server_stream_data():
+    async with LocalStreamServer(blocks(20), finalized=9) as server:
+        async with insecure_channel(server.address) as channel:
+            (client, stream) = StreamService(channel).stream_data(timeout=1.0)
+            await client.configure(filter=b"", batch_size=3, cursor=Cursor(order_key=4))
+
+            message = await next_message(stream)
+            assert message.stream_id == 1
+            assert message.data.cursor.order_key == 4
+            assert list(message.data.data) == [b"5", b"6", b"7"]
+            assert message.data.finality == DataFinality.DATA_STATUS_FINALIZED
+
+            # a new request replaces the stream
+            await client.configure(
+                filter=b"", batch_size=5, cursor=Cursor(order_key=14)
+            )
+            message = await next_message(stream)
+            assert message.stream_id == 2
+            assert list(message.data.data) == [b"15", b"16", b"17", b"18", b"19"]
+            assert message.data.finality == DataFinality.DATA_STATUS_ACCEPTED
+
+            server.invalidate(Cursor(order_key=17))
+            message = await next_message(stream, "invalidate")
+            assert message.invalidate.cursor.order_key == 17
+            message = await next_message(stream)
+            assert list(message.data.data) == [b"18", b"19"]
+
+            server.disconnect()
+            with pytest.raises(AioRpcError) as exc:
+                await next_message(stream)
+            assert exc.value.code() == StatusCode.INTERNAL
+
+
+@pytest.mark.asyncio
+async def test_local_server_heartbeat_and_finality():
+    async with LocalStreamServer(
+        blocks(10), finalized=4, heartbeat_interval=0.05
+    ) as server:
+        async with insecure_channel(server.address) as channel:
+            (client, stream) = StreamService(channel).stream_data(timeout=1.0)
+            await client.configure(
+                filter=b"",
+                batch_size=10,
+                finality=DataFinality.DATA_STATUS_FINALIZED,
+            )
+            message = await next_message(stream)
+            assert message.data.end_cursor.order_key == 4
+            message = await next_message(stream, "heartbeat")
+            assert message.stream_id == 1
+
+
+@pytest.mark.asyncio
+async def test_local_server_stream_data_immutable():
+    async with LocalStreamServer(blocks(10)) as server:
+        async with insecure_channel(server.address) as channel:
+            stream = StreamService(channel).stream_data_immutable(
+                filter=b"", batch_size=4, cursor=Cursor(order_key=2)
+            )
+            items = []
+            async for message in stream:
+                items.extend(message.data.data)
+            assert items == [str(i).encode() for i in range(3, 10)]
+
+
+@pytest.mark.asyncio
+async def test_local_server_pending_data():
+    async with LocalStreamServer(blocks(10), finalized=4, pending=8) as server:
+        async with insecure_channel(server.address) as channel:
+            (client, stream) = StreamService(channel).stream_data(timeout=1.0)
+            await client.configure(
+                filter=b"",
+                batch_size=10,
+                cursor=Cursor(order_key=5),
+                finality=DataFinality.DATA_STATUS_PENDING,
+            )
+            message = await next_message(stream)
+            assert list(message.data.data) == [b"6", b"7"]
+            assert message.data.finality == DataFinality.DATA_STATUS_ACCEPTED
+            message = await next_message(stream)
+            assert list(message.data.data) == [b"8"]
+            assert message.data.finality == DataFinality.DATA_STATUS_PENDING
+
+            # streams of accepted data stop before the pending block.
+            await client.configure(
+                filter=b"",
+                batch_size=10,
+                cursor=Cursor(order_key=5),
+                finality=DataFinality.DATA_STATUS_ACCEPTED,
+            )
+            message = await next_message(stream)
+            assert list(message.data.data) == [b"6", b"7"]
+            server.invalidate(Cursor(order_key=7))
+            message = await next_message(stream, "invalidate")
+            assert message.stream_id == 2
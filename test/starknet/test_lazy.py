@@ -0,0 +1,76 @@
+import pickle
+
+import apibara.starknet.felt as felt
+from apibara.starknet.lazy import LazyBlock
+from apibara.starknet.proto.starknet_pb2 import (
+    Block,
+    BlockHeader,
+    BlockStatus,
+    EventWithTransaction,
+)
+
+
+def example_block() -> Block:
+    block = Block(
+        status=BlockStatus.BLOCK_STATUS_ACCEPTED_ON_L2,
+        header=BlockHeader(block_number=123, block_hash=felt.from_int(0xABC)),
+    )
+    for i in range(3):
+        tx = block.transactions.add()
+        tx.transaction.meta.hash.CopyFrom(felt.from_int(i))
+        event = block.events.add()
+        event.event.from_address.CopyFrom(felt.from_int(i))
+        event.event.keys.extend([felt.from_int(i + 100)])
+    return block
+
+
+def test_lazy_block_fields():
+    block = example_block()
+    lazy = LazyBlock(block.SerializeToString())
+
+    assert lazy.status == block.status
+    assert lazy.header == block.header
+    assert list(lazy.events) == list(block.events)
+    assert list(lazy.transactions) == list(block.transactions)
+    assert not lazy.HasField("state_update")
+    assert lazy.HasField("header")
+    assert len(lazy.l2_to_l1_messages) == 0
+    assert lazy.to_block() == block
+
+
+def test_lazy_block_pickle():
+    block = example_block()
+    lazy = LazyBlock(block.SerializeToString())
+    assert lazy.header.block_number == 123
+
+    restored = pickle.loads(pickle.dumps(lazy))
+    assert restored.header.block_number == 123
+    assert restored.to_block() == block
+
+
+def test_lazy_block_discards_other_fields():
+    block = example_block()
+    lazy = LazyBlock(block.SerializeToString())
+    assert lazy.header.block_number == 123
+
+    # the parsed field doesn't keep a copy of the rest of the block.
+    assert lazy._fields["header"].ByteSize() == Block(header=block.header).ByteSize()
+
+
+def test_lazy_block_interleaved_fields():
+    block = example_block()
+    # repeated fields can be split in multiple runs on the wire.
+    raw = b"".join(
+        [
+            Block(events=block.events[:1]).SerializeToString(),
+            Block(header=block.header).SerializeToString(),
+            Block(events=block.events[1:]).SerializeToString(),
+            Block(status=block.status).SerializeToString(),
+        ]
+    )
+    lazy = LazyBlock(raw)
+
+    assert lazy.status == block.status
+    assert lazy.header == block.header
+    assert list(lazy.events) == list(block.events)
+    assert len(lazy.transactions) == 0